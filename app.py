@@ -1,8 +1,30 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import pandas as pd
 import sqlalchemy
-from sqlalchemy import create_engine, text
-import urllib.parse
+from sqlalchemy import text
+import os
+import re
+import time
+import threading
+import uuid
+import contextvars
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from conexion import crear_engine, es_error_de_conexion
+from migraciones import aplicar_migraciones, restaurar_semilla_config
+from instrumentacion import instrumentar, iniciar_traza, fijar_seccion
+from replica import crear_replica, SinConexion
+from notificaciones import crear_escucha
+from costeo import (SQL_RECETAS_COSTEO, SQL_CONVERSIONES, SQL_PRODUCTOS, SQL_CONFIG, SQL_VOLUMEN_MES,
+                    Configuracion, cierre_conversiones, calcular_costo_lineas,
+                    rango_mes, volumen_referencia, calcular_ficha,
+                    completar_catalogo, simular_escenarios, ESCENARIO_BASE)
+from operaciones import (validar_costos_fijos, cargar_costos_fijos, cargar_productos_csv,
+                         sincronizar_materias_primas, crear_variante, clonar_receta, clonar_receta_a_linea,
+                         recalcular_costos_pendientes, registrar_produccion)
 
 # --- CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(page_title="ERP Perfumería - Final", layout="wide")
@@ -10,120 +32,432 @@ st.set_page_config(page_title="ERP Perfumería - Final", layout="wide")
 # ==============================================================================
 # 🔐 CONEXIÓN A BASE DE DATOS (VIA TRANSACTION POOLER - PUERTO 6543)
 # ==============================================================================
+# Credenciales y URL en conexion.py; esquema y datos semilla en migraciones.py
+
+@st.cache_resource
+def get_engine():
+    return instrumentar(crear_engine())
+
+@st.cache_resource
+def preparar_base_datos():
+    """Prueba de conexión y migraciones: una sola vez por proceso, no en cada rerun.
+    Con ERP_MIGRAR_AL_INICIAR=0 las migraciones se corren aparte (python migraciones.py)."""
+    eng = get_engine()
+    if os.environ.get("ERP_MIGRAR_AL_INICIAR", "1") != "0":
+        return aplicar_migraciones(eng)
+    with eng.connect() as conn:
+        return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+# --- RÉPLICA LOCAL Y MODO SIN CONEXIÓN (replica.py) ---
+@st.cache_resource
+def get_replica():
+    return crear_replica()
+
+@st.cache_resource
+def get_estado_conexion():
+    # Compartido por todas las sesiones: si la DB no responde, no responde para nadie
+    return {'sin_conexion_desde': None, 'reintentar_en': 0.0, 'error': None}
+
+REINTENTO_CONEXION_S = float(os.environ.get("ERP_REINTENTO_CONEXION", 30))
+
+# Los recursos compartidos se resuelven una vez por rerun en el hilo principal (estado_conexion,
+# replica, cache_lecturas): las tareas de leer_en_paralelo corren sin ScriptRunContext y no
+# deben llamar a los getters de st.cache_resource.
+def en_linea():
+    return estado_conexion['sin_conexion_desde'] is None
+
+def marcar_sin_conexion(e):
+    """Pasa a modo local; la conexión se vuelve a probar cada REINTENTO_CONEXION_S segundos,
+    no en cada consulta (con el circuit breaker abierto, insistir alarga el bloqueo)."""
+    if estado_conexion['sin_conexion_desde'] is None: estado_conexion['sin_conexion_desde'] = time.time()
+    estado_conexion['error'] = str(e)
+    estado_conexion['reintentar_en'] = time.time() + REINTENTO_CONEXION_S
+
+traza = iniciar_traza("inicio")  # consultas de este rerun (panel de depuración)
+engine = get_engine()
+replica = get_replica()
+estado_conexion = get_estado_conexion()
 
-# 1. CREDENCIALES EXACTAS PARA EL POOLER
-# Nota: Si el host 'aws-0' no funciona, cámbialo a 'aws-1' según lo que diga Supabase
-DB_HOST = "aws-1-us-east-1.pooler.supabase.com" 
-DB_NAME = "postgres"
-DB_USER = "postgres.nzlysybivtiumentgpvi" # <--- Usuario especial del pooler
-DB_PORT = "6543" 
-DB_PASS = ".pJUb+(3pnYqBH1yhM" # <--- ¡La que creaste recientemente!
-
-# 2. CONSTRUCCIÓN DE URL SEGURA
 try:
-    encoded_password = urllib.parse.quote_plus(DB_PASS)
-    # Importante: Usamos postgresql+psycopg2 y sslmode require
-    DB_URL = f"postgresql+psycopg2://{DB_USER}:{encoded_password}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=require"
-
-    @st.cache_resource
-    def get_engine():
-        # pool_pre_ping ayuda a detectar si la conexión se cerró por inactividad
-        return create_engine(DB_URL, pool_pre_ping=True)
-
-    engine = get_engine()
-    
-    # Test de conexión
-    with engine.connect() as conn:
-        conn.execute(text("SELECT 1"))
-    st.sidebar.success("✅ Conectado a la Nube (Puerto 6543)")
+    if not en_linea():
+        if time.time() < estado_conexion['reintentar_en']: raise SinConexion(estado_conexion['error'])
+        with engine.connect() as conn: conn.execute(text("SELECT 1"))
+        estado_conexion['sin_conexion_desde'] = None
+    version_esquema = preparar_base_datos()
+    st.sidebar.success(f"✅ Conectado a la Nube (Puerto 6543) · esquema v{version_esquema}")
 
 except Exception as e:
-    st.error("❌ Error de Conexión")
-    if "Circuit breaker open" in str(e):
-        st.warning("⚠️ Supabase bloqueó el acceso temporalmente por demasiados errores. Espera 15 minutos sin intentar conectar.")
+    if replica is not None and replica.tiene_datos() and (isinstance(e, SinConexion) or es_error_de_conexion(e)):
+        # Fichas, recetas y configuración siguen disponibles desde la réplica local
+        if not isinstance(e, SinConexion): marcar_sin_conexion(e)
+        st.sidebar.warning("📴 Sin conexión a la base de datos: modo local. Las lecturas salen de la réplica "
+                           "y los cambios quedan en cola hasta reconectar.")
+        if "Circuit breaker open" in str(e):
+            st.sidebar.caption("Supabase bloqueó el acceso temporalmente; se reintentará solo, sin insistir.")
     else:
-        st.info("Asegúrate de haber seleccionado 'Transaction Pooler' en Supabase y que la contraseña sea correcta.")
-    st.code(str(e))
-    st.stop()
+        st.error("❌ Error de Conexión")
+        if "Circuit breaker open" in str(e):
+            st.warning("⚠️ Supabase bloqueó el acceso temporalmente por demasiados errores. Espera 15 minutos sin intentar conectar.")
+        else:
+            st.info("Asegúrate de haber seleccionado 'Transaction Pooler' en Supabase y que la contraseña sea correcta.")
+        st.code(str(e))
+        st.stop()
 # ==============================================================================
 # LÓGICA DE NEGOCIO Y CONVERSIONES
 # ==============================================================================
-def run_query(query, params=None):
-    with engine.connect() as conn:
-        if params: conn.execute(text(query), params)
-        else: conn.execute(text(query))
-        conn.commit()
+# --- CACHÉ DE LECTURAS VERSIONADA ---
+# Tablas de referencia que cambian poco. Cada una lleva un contador de versión que
+# run_query incrementa al escribir en ella; la versión forma parte de la llave de caché.
+TABLAS_CACHEABLES = {'materias_primas', 'productos', 'lineas_produccion', 'conversiones',
+                     'config_admin', 'config_ventas', 'config_mod', 'config_global', 'costos_fijos'}
+RE_TABLAS_LECTURA = re.compile(r"\b(?:FROM|JOIN)\s+([a-z_][a-z0-9_]*)", re.IGNORECASE)
+RE_TABLA_ESCRITURA = re.compile(r"^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE\s+TABLE)\s+([a-z_][a-z0-9_]*)", re.IGNORECASE)
+
+# Acotada a ERP_CACHE_MAX_ENTRADAS resultados (LRU): cada búsqueda, página y tamaño de página
+# distintos son una entrada nueva y, sin tope, se acumularían mientras viva el proceso.
+CACHE_MAX_ENTRADAS = max(1, int(os.environ.get("ERP_CACHE_MAX_ENTRADAS", 500)))
+
+@st.cache_resource
+def get_cache_lecturas():
+    # Compartida por todas las sesiones del proceso
+    return {'versiones': defaultdict(int), 'datos': OrderedDict(), 'hits': 0, 'misses': 0, 'desalojos': 0,
+            'lock': threading.Lock()}
+
+cache_lecturas = get_cache_lecturas()
+
+def _guardar_en_cache(cache, llave, valor):
+    """Inserta y desaloja las entradas usadas hace más tiempo (llamar con cache['lock'] tomado)."""
+    cache['datos'][llave] = valor
+    cache['datos'].move_to_end(llave)
+    while len(cache['datos']) > CACHE_MAX_ENTRADAS:
+        cache['datos'].popitem(last=False)
+        cache['desalojos'] += 1
+
+def _llave_params(params):
+    if not params: return ()
+    return tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple, set)) else v) for k, v in params.items()))
+
+def invalidar_tablas(tablas):
+    """Tras escribir: sube la versión de las tablas, descarta lo cacheado que depende de ellas y
+    las marca en la réplica para leerlas de la DB hasta el próximo refresco."""
+    if replica is not None: replica.marcar_sucias(tablas)
+    _descartar_cache(tablas)
+
+def _descartar_cache(tablas, cache=None):
+    if cache is None: cache = cache_lecturas
+    with cache['lock']:
+        for t in tablas: cache['versiones'][t] += 1
+        for k in [k for k, (deps, _) in cache['datos'].items() if deps & set(tablas)]:
+            del cache['datos'][k]
+
+def _conectar():
+    """engine.connect() que pasa a modo local si la DB no responde."""
+    if not en_linea(): raise SinConexion("Sin conexión a la base de datos.")
+    try:
+        return engine.connect()
+    except Exception as e:
+        if es_error_de_conexion(e): marcar_sin_conexion(e)
+        raise
 
-def get_data(query, params=None):
-    with engine.connect() as conn:
+def run_query(query, params=None):
+    m = RE_TABLA_ESCRITURA.match(query)
+    tabla = m.group(1).lower() if m else None
+    try:
+        conn = _conectar()
+    except Exception as e:
+        # Sin conexión y sin haber ejecutado nada: a la cola durable, se reproduce al reconectar.
+        # Si la conexión cae a mitad de la escritura no se encola (no se sabe si se aplicó).
+        if replica is None or not (isinstance(e, SinConexion) or es_error_de_conexion(e)): raise
+        replica.encolar(query, params, tabla)
+    else:
+        with conn:
+            if params: conn.execute(text(query), params)
+            else: conn.execute(text(query))
+            conn.commit()
+    if tabla: invalidar_tablas({tabla})
+
+@contextmanager
+def transaccion(tablas=()):
+    """Conexión con BEGIN/COMMIT único (ROLLBACK si algo falla); invalida la caché de las tablas al confirmar.
+    Sin conexión no se encola: estas operaciones leen y escriben dentro de la misma transacción."""
+    if not en_linea():
+        raise SinConexion("Sin conexión a la base de datos: esta operación se podrá hacer al reconectar.")
+    with _conectar() as conn, conn.begin():
+        yield conn
+    if tablas: invalidar_tablas(set(tablas))
+
+def _leer_db(query, params=None):
+    with _conectar() as conn:
         return pd.read_sql(text(query), conn, params=params)
 
-def calcular_sin_iva(monto, tiene_iva):
-    return monto / 1.12 if (tiene_iva and monto > 0) else monto
-
-def obtener_costo_convertido(mp_id, unidad_destino):
-    """Calcula el costo neto (sin IVA) y aplica conversiones de unidad."""
-    df_mp = get_data("SELECT costo_unitario, unidad_medida, tiene_iva FROM materias_primas WHERE id=:id", {'id': mp_id})
-    if df_mp.empty: return 0.0
-    
-    # 1. Obtenemos el costo base
-    costo_base = float(df_mp.iloc[0]['costo_unitario'])
-    unidad_base = df_mp.iloc[0]['unidad_medida']
-    tiene_iva = bool(df_mp.iloc[0]['tiene_iva'])
-    
-    # 2. APLICAMOS LÓGICA DE IVA (Si tiene, lo quitamos: Q / 1.12)
-    if tiene_iva:
-        costo_base = costo_base / 1.12
-    
-    # Si la unidad es la misma, no hay conversión
-    if unidad_base == unidad_destino or unidad_destino is None:
-        return costo_base
-    
-    # Buscar factor en tabla conversiones
-    conv = get_data("SELECT factor_multiplicador FROM conversiones WHERE unidad_origen=:u1 AND unidad_destino=:u2", 
-                    {'u1': unidad_base, 'u2': unidad_destino})
-    
-    if not conv.empty:
-        return costo_base / float(conv.iloc[0]['factor_multiplicador'])
-    
-    return costo_base
-
-def check_and_seed_data():
+def _leer(query, params, tablas):
+    """De la réplica local si tiene esas tablas al día (o si no hay conexión); si no, de la DB."""
+    if replica is not None and (replica.vigente(tablas) or (not en_linea() and replica.puede_servir(tablas))):
+        try:
+            df = replica.leer(query, params)
+            traza.contar('lecturas_replica')
+            return df
+        except Exception:
+            if not en_linea(): raise
+            # SQL que SQLite no entiende: se sirve desde la DB
+    if not en_linea():
+        raise SinConexion("Sin conexión a la base de datos y estos datos no están en la réplica local.")
     try:
-        df = get_data("SELECT id FROM config_admin WHERE id=1")
-        if df.empty:
-            with engine.connect() as conn:
-                conn.execute(text("INSERT INTO config_admin (id, salario_base, p_prestaciones, num_empleados) VALUES (1, 5000, 41.83, 3) ON CONFLICT DO NOTHING"))
-                conn.execute(text("INSERT INTO config_ventas (id, salario_base, p_prestaciones, num_empleados) VALUES (1, 3500, 41.83, 2) ON CONFLICT DO NOTHING"))
-                conn.execute(text("INSERT INTO config_mod (id, salario_base, p_prestaciones, num_operarios, horas_mes) VALUES (1, 4252.28, 41.83, 2, 176) ON CONFLICT DO NOTHING"))
-                conn.execute(text("INSERT INTO config_global (id, unidades_promedio_mes) VALUES (1, 5000) ON CONFLICT DO NOTHING"))
-                conn.commit()
+        return _leer_db(query, params)
     except Exception as e:
-        pass
+        if replica is None or not es_error_de_conexion(e) or not replica.puede_servir(tablas): raise
+        return replica.leer(query, params)
 
-check_and_seed_data()
-
-def obtener_volumen_referencia():
-    """Retorna la producción real del mes o el promedio manual si no hay registros."""
-    mes_act = pd.to_datetime("today").month
-    anio_act = pd.to_datetime("today").year
-    real = get_data("SELECT SUM(cantidad_producida) FROM registro_produccion WHERE EXTRACT(MONTH FROM fecha) = :m AND EXTRACT(YEAR FROM fecha) = :a", {'m': mes_act, 'a': anio_act}).iloc[0,0]
-    
-    if real and real > 0:
-        return float(real), "Real (Mes Actual)"
-    manual = get_data("SELECT unidades_promedio_mes FROM config_global WHERE id=1").iloc[0,0]
-    return float(manual), "Teórico (Promedio)"
+def get_data(query, params=None):
+    tablas = {t.lower() for t in RE_TABLAS_LECTURA.findall(query)}
+    if not tablas or not tablas <= TABLAS_CACHEABLES:
+        return _leer(query, params, tablas)
+
+    cache = cache_lecturas
+    with cache['lock']:
+        versiones = tuple(sorted((t, cache['versiones'][t]) for t in tablas))
+        llave = (query, _llave_params(params), versiones)
+        if llave in cache['datos']:
+            cache['hits'] += 1
+            traza.contar('lecturas_cache')
+            cache['datos'].move_to_end(llave)
+            return cache['datos'][llave][1].copy()
+        cache['misses'] += 1
+
+    df = _leer(query, params, tablas)
+    with cache['lock']:
+        _guardar_en_cache(cache, llave, (tablas, df))
+    return df.copy()
+
+def memo_por_version(nombre, tablas, fn):
+    """Cachea un valor derivado (no un DataFrame de la DB) hasta que cambie alguna de `tablas`."""
+    cache = cache_lecturas
+    tablas = set(tablas)
+    with cache['lock']:
+        llave = (nombre, tuple(sorted((t, cache['versiones'][t]) for t in tablas)))
+        if llave in cache['datos']:
+            cache['hits'] += 1
+            cache['datos'].move_to_end(llave)
+            return cache['datos'][llave][1]
+        cache['misses'] += 1
+    valor = fn()
+    with cache['lock']:
+        _guardar_en_cache(cache, llave, (tablas, valor))
+    return valor
+
+# --- LECTURAS EN PARALELO ---
+# Cada lectura espera un viaje completo a la DB. Las que no dependen entre sí se lanzan
+# juntas en un pool de hilos y la sección espera solo a la más lenta. ERP_LECTURAS_PARALELAS
+# acota los hilos (cada uno toma una conexión del pool de SQLAlchemy); 1 = secuencial.
+@st.cache_resource
+def get_pool_lecturas():
+    hilos = max(1, int(os.environ.get("ERP_LECTURAS_PARALELAS", "4")))
+    return ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="lectura") if hilos > 1 else None
+
+def leer_en_paralelo(**lecturas):
+    """Ejecuta a la vez funciones sin argumentos y sin st.* (get_data y derivados). Retorna {nombre: resultado}.
+
+    Cada tarea lleva una copia del contexto (traza y sección del rerun). Dentro de una tarea
+    se ejecuta en serie para no agotar el pool esperándose a sí mismo. Los errores se propagan.
+    """
+    if len(lecturas) < 2 or threading.current_thread().name.startswith("lectura"):
+        return {k: fn() for k, fn in lecturas.items()}
+    pool = get_pool_lecturas()  # hilo principal: aquí sí hay ScriptRunContext
+    if pool is None:
+        return {k: fn() for k, fn in lecturas.items()}
+    futuros = {k: pool.submit(contextvars.copy_context().run, fn) for k, fn in lecturas.items()}
+    return {k: f.result() for k, f in futuros.items()}
+
+# --- GRAFO DE CONVERSIONES (cierre transitivo en costeo.py) ---
+def get_cierre_conversiones():
+    """Cierre de conversiones en memoria; se recalcula solo cuando cambia la tabla."""
+    return memo_por_version('cierre_conversiones', ['conversiones'],
+                            lambda: cierre_conversiones(get_data(SQL_CONVERSIONES)))
+
+def costear_recetas(producto_ids=None):
+    """Trae y costea en un solo viaje a la DB las recetas de uno, varios o (None) todos los productos."""
+    factores, _ = get_cierre_conversiones()
+    if producto_ids is None:
+        return calcular_costo_lineas(get_data(f"{SQL_RECETAS_COSTEO} ORDER BY r.id"), factores)
+    if isinstance(producto_ids, str): producto_ids = [producto_ids]
+    df = get_data(f"{SQL_RECETAS_COSTEO} WHERE r.producto_id = ANY(:pids) ORDER BY r.id", {'pids': list(producto_ids)})
+    return calcular_costo_lineas(df, factores)
+
+def avisar_sin_conversion(lineas):
+    """Muestra las líneas de receta que no tienen ruta de conversión de unidades."""
+    faltan = lineas[lineas['sin_conversion']]
+    if not faltan.empty:
+        pares = sorted({f"{u} → {d}" for u, d in zip(faltan['unidad_medida'], faltan['unidad_uso'])})
+        st.warning(f"⚠️ {len(faltan)} ingredientes sin conversión registrada ({', '.join(pares)}); "
+                   "se costearon en su unidad de compra. Registre la conversión en ⚙️ Ajustes.")
+
+def buscar_materias_primas(busqueda, pagina=1, por_pagina=50):
+    """Búsqueda en el servidor (ILIKE servido por índices trigram) y paginada. Retorna (página, total)."""
+    filtro, params = "", {}
+    if busqueda:
+        patron = busqueda.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        filtro = "WHERE nombre ILIKE :q OR codigo_interno ILIKE :q"
+        params['q'] = f"%{patron}%"
+    total = int(get_data(f"SELECT COUNT(*) FROM materias_primas {filtro}", params).iloc[0, 0])
+    df = get_data(f"""SELECT id, codigo_interno, nombre, categoria, unidad_medida, costo_unitario, tiene_iva
+                      FROM materias_primas {filtro} ORDER BY nombre, id LIMIT :lim OFFSET :off""",
+                  {**params, 'lim': por_pagina, 'off': (pagina - 1) * por_pagina})
+    return df, total
+
+def get_config():
+    """Foto de toda la configuración (nóminas, unidades promedio, totales de costos fijos) y sus
+    derivados, leída en un solo viaje y reutilizada hasta que se escriba en alguna de esas tablas."""
+    tablas = {t.lower() for t in RE_TABLAS_LECTURA.findall(SQL_CONFIG)}
+    return memo_por_version('config', tablas, lambda: Configuracion.desde_fila(get_data(SQL_CONFIG).iloc[0]))
+
+def volumen_mes_actual():
+    """Unidades producidas en el mes en curso (produccion_mensual se mantiene por trigger, migración 4).
+    Con volumen_referencia(real, config.unidades_promedio_mes) se obtiene el volumen real o el teórico."""
+    mes_ini, _ = rango_mes(pd.to_datetime("today"))
+    try:
+        return get_data(SQL_VOLUMEN_MES, {'m': mes_ini}).iloc[0,0]
+    except SinConexion:
+        return None  # produccion_mensual no se replica: sin conexión se usa el volumen teórico
+
+@st.cache_resource
+def get_escucha_cambios():
+    """Un hilo por proceso que escucha NOTIFY de cambios_tablas (notificaciones.py): las escrituras
+    de otros contenedores descartan aquí solo las entradas de caché de esas tablas."""
+    cache, rep = cache_lecturas, replica
+    def al_cambiar(cambios):
+        # Corre en el hilo de escucha: usa los recursos capturados, no st.*
+        if rep is not None:
+            # La réplica lleva su propia versión por tabla: solo se recopia lo que quedó atrás
+            vers = rep.versiones()
+            rep.marcar_sucias([t for t, v in cambios.items() if vers.get(t, (-1, None))[0] < v])
+        _descartar_cache(set(cambios), cache)
+    return crear_escucha(al_cambiar)
+
+def sincronizar_replica():
+    """Con conexión: reproduce la cola de escrituras pendiente y, cada ERP_REPLICA_TTL segundos,
+    copia las tablas que cambiaron. Lo que cambió en la DB también se descarta de la caché."""
+    if replica is None or not en_linea(): return
+    try:
+        aplicadas = fallidas = 0
+        if replica.pendientes():
+            aplicadas, fallidas = replica.reproducir(engine, es_error_de_conexion)
+            st.sidebar.info(f"📤 Se aplicaron {aplicadas} cambios hechos sin conexión"
+                            + (f"; {fallidas} rechazados por la DB (ver 💾 Réplica local)" if fallidas else "."))
+        if aplicadas or fallidas or time.time() - replica.ultima_revision >= replica.ttl:
+            _descartar_cache(replica.refrescar(engine))
+    except Exception as e:
+        if es_error_de_conexion(e): marcar_sin_conexion(e)
+        st.sidebar.caption(f"⚠️ No se pudo sincronizar la réplica local: {e}")
 # ==============================================================================
 # INTERFAZ
 # ==============================================================================
 st.title("☁️ ERP Perfumería")
-
-tabs = st.tabs(["👥 Nóminas", "💰 Costos Fijos", "🌿 Materias Primas", "📦 Fábrica (Prod)", "🔎 Ficha Técnica", "⚙️ Ajustes", "🚀 Producción Diaria"])
+sincronizar_replica()
+escucha = get_escucha_cambios()
+
+_cache = cache_lecturas
+with st.sidebar.expander("🗄️ Caché de lecturas"):
+    total_lect = _cache['hits'] + _cache['misses']
+    st.write(f"Aciertos: **{_cache['hits']}** · Fallos: **{_cache['misses']}**")
+    st.write(f"Tasa de acierto: **{(_cache['hits'] / total_lect * 100) if total_lect else 0:.1f}%** · Entradas: {len(_cache['datos'])}/{CACHE_MAX_ENTRADAS} · Desalojos: {_cache['desalojos']}")
+    if escucha is not None:
+        estado_escucha = "🟢 escuchando" if escucha.conectada else f"🔴 sin conexión ({escucha.error})"
+        ultimo = pd.Timestamp.fromtimestamp(escucha.ultimo_aviso).strftime('%H:%M:%S') if escucha.ultimo_aviso else "—"
+        st.caption(f"Cambios de otros procesos: {estado_escucha} · invalidaciones: {escucha.avisos} · última: {ultimo}")
+    if st.button("Vaciar caché", key="btn_vaciar_cache"):
+        invalidar_tablas(TABLAS_CACHEABLES)
+
+with st.sidebar.expander("🔌 Pool de conexiones"):
+    m_pool = engine.metricas_pool.resumen(engine.pool)
+    cfg_pool = engine.config_pool
+    if m_pool['capacidad'] is None:
+        st.caption(f"Sin pool local: una conexión por uso (el pooler de Supabase multiplexa) · "
+                   f"pre-ping {'sí' if cfg_pool['pool_pre_ping'] else 'no'}")
+        st.write(f"Conexiones abiertas: **{m_pool['en_uso']}** · máx. {m_pool['en_uso_max']}")
+    else:
+        st.caption(f"Pool '{cfg_pool['pool']}' · tamaño {cfg_pool['pool_size']} + {cfg_pool['max_overflow']} · "
+                   f"recycle {cfg_pool['pool_recycle']} s · pre-ping {'sí' if cfg_pool['pool_pre_ping'] else 'no'}")
+        st.write(f"En uso: **{m_pool['en_uso']}** / {m_pool['capacidad']} ({m_pool['saturacion']:.0%}) · máx. {m_pool['en_uso_max']}")
+    st.write(f"Espera por conexión: prom. {m_pool['espera_prom_ms']:.1f} ms · p95 {m_pool['espera_p95_ms']:.1f} ms · máx. {m_pool['espera_max_ms']:.1f} ms")
+    st.write(f"Checkouts: {m_pool['checkouts']} · Conexiones nuevas: {m_pool['conexiones_nuevas']} · "
+             f"Reconexiones: {m_pool['reconexiones']} · Timeouts: {m_pool['timeouts']}")
+
+if replica is not None:
+    with st.sidebar.expander("💾 Réplica local"):
+        if en_linea():
+            st.write(f"En línea · revisión cada {replica.ttl:.0f} s")
+        else:
+            desde = pd.Timestamp.fromtimestamp(estado_conexion['sin_conexion_desde'])
+            st.write(f"📴 **Sin conexión** desde {desde:%H:%M:%S}")
+            if st.button("Reintentar conexión", key="btn_reintentar_db"):
+                estado_conexion['reintentar_en'] = 0.0
+                st.rerun()
+        vers = replica.versiones()
+        if vers:
+            st.dataframe(pd.DataFrame([{'tabla': t, 'versión': v, 'copiada': pd.Timestamp.fromtimestamp(c).strftime('%H:%M:%S')}
+                                       for t, (v, c) in sorted(vers.items())]), hide_index=True, use_container_width=True)
+        st.write(f"Cambios en cola: **{replica.pendientes()}**")
+        df_fallidas = replica.fallidas()
+        if not df_fallidas.empty:
+            st.write(f"Rechazados al reproducir: **{len(df_fallidas)}**")
+            st.dataframe(df_fallidas, hide_index=True, use_container_width=True)
+        if en_linea() and st.button("🔄 Refrescar ahora", key="btn_refrescar_replica"):
+            _descartar_cache(replica.refrescar(engine, forzar=True))
+
+# --- NAVEGACIÓN: SOLO SE EJECUTA LA SECCIÓN ACTIVA ---
+# A diferencia de st.tabs (que ejecuta todas las pestañas en cada rerun), aquí solo corre
+# el código y las consultas de la sección elegida. ?seccion=<clave> permite enlaces directos.
+SECCIONES = {
+    "nominas": "👥 Nóminas", "costos_fijos": "💰 Costos Fijos", "materias_primas": "🌿 Materias Primas",
+    "fabrica": "📦 Fábrica (Prod)", "ficha": "🔎 Ficha Técnica", "ajustes": "⚙️ Ajustes",
+    "produccion": "🚀 Producción Diaria", "catalogo": "📈 Catálogo de Costos",
+    "simulacion": "🧪 Simulación de Precios",
+}
+
+# Widgets cuyo valor se conserva al cambiar de sección. Streamlit borra el estado de los
+# widgets que no se dibujan en un rerun; reasignarlos lo convierte en estado de sesión.
+# (st.data_editor y st.file_uploader no admiten este truco.)
+CLAVES_PERSISTENTES = [
+    "mp_buscar", "mp_por_pagina", "mp_pagina", "clon_src_new", "clon_cod_new", "clon_nom_new", "clon_src_exist", "clon_dst_exist",
+    "clon_modo_dst", "clon_dst_linea",
+    "receta_sel", "ficha_sel", "fecha_prod", "sel_linea_prod",
+    "cat_buscar", "cat_lineas", "cat_margen", "cat_perdida", "cat_orden", "cat_asc",
+    "sim_umbral", "sim_escenario", "sim_solo_nuevos",
+]
+for k in CLAVES_PERSISTENTES:
+    if k in st.session_state: st.session_state[k] = st.session_state[k]
+
+def validar_opcion(key, opciones):
+    """Descarta un valor persistido que ya no existe entre las opciones del selectbox."""
+    if key in st.session_state and st.session_state[key] not in opciones:
+        del st.session_state[key]
+
+# --- FRAGMENTOS: RERUNS PARCIALES ---
+# Un widget dentro de un fragmento vuelve a ejecutar solo ese bloque, no todo el script
+# (sidebar, navegación y demás consultas de la sección). Tras guardar se usa rerun_fragmento()
+# si el cambio solo se ve dentro del bloque, y st.rerun() si lo usan otros bloques.
+fragmento = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda fn: fn)
+
+def rerun_fragmento():
+    """Vuelve a ejecutar solo el fragmento actual; todo el script en versiones sin rerun por fragmento
+    (TypeError) o si se llama fuera de un fragmento o en un rerun completo (StreamlitAPIException).
+    Se llama después de confirmar la escritura: nunca debe terminar como un "Error DB"."""
+    try: st.rerun(scope="fragment")
+    except (TypeError, StreamlitAPIException): st.rerun()
+
+if "nav_seccion" not in st.session_state:
+    seccion_url = st.query_params.get("seccion", "nominas")
+    st.session_state.nav_seccion = seccion_url if seccion_url in SECCIONES else "nominas"
+seccion = st.radio("Sección", list(SECCIONES), format_func=SECCIONES.get, horizontal=True,
+                   key="nav_seccion", label_visibility="collapsed")
+st.query_params["seccion"] = seccion
+fijar_seccion(SECCIONES[seccion])
+st.divider()
 # TAB 1: NÓMINAS
 
 # ------------------------------------------------------------------
 
-with tabs[0]:
+if seccion == "nominas":
 
     st.header("Configuración de Personal")
 
@@ -131,6 +465,7 @@ with tabs[0]:
 
     
 
+    @fragmento
     def render_nomina_form(titulo, tabla, key_prefix):
 
         with st.container(border=True):
@@ -139,23 +474,17 @@ with tabs[0]:
 
             try:
 
-                # Query seguro
+                # Misma foto de configuración que usan Costos Fijos, Fábrica y Ficha
 
                 col_emp = "num_operarios" if tabla == 'config_mod' else "num_empleados"
 
-                cols = f"salario_base, p_prestaciones, {col_emp}"
-
-                if tabla == 'config_mod': cols += ", horas_mes"
-
-                
+                config = get_config()
 
-                df = get_data(f"SELECT {cols} FROM {tabla} WHERE id=1")
+                data = {'config_admin': config.admin, 'config_ventas': config.ventas, 'config_mod': config.mod}[tabla]
 
                 
 
-                if not df.empty:
-
-                    data = df.iloc[0]
+                if data['salario_base'] is not None:
 
                     with st.form(f"form_{key_prefix}"):
 
@@ -185,11 +514,19 @@ with tabs[0]:
 
                                 run_query(f"UPDATE {tabla} SET salario_base=:s, p_prestaciones=:p, num_empleados=:n WHERE id=1", {'s':s, 'p':p, 'n':n})
 
-                            st.rerun()
+                            rerun_fragmento()
 
                 else:
 
-                    st.warning("⚠️ Datos vacíos. Recarga la página para auto-reparar.")
+                    st.warning("⚠️ No hay configuración guardada para esta nómina. Usa «Restaurar valores por defecto» para volver a crearla con los valores iniciales y luego ajústalos.")
+
+                    if st.button("Restaurar valores por defecto", key=f"btn_semilla_{key_prefix}"):
+
+                        with transaccion(['config_admin', 'config_ventas', 'config_mod', 'config_global']) as conn:
+
+                            restaurar_semilla_config(conn)
+
+                        rerun_fragmento()
 
             except Exception as e: st.error(f"Error DB: {e}")
 
@@ -205,7 +542,7 @@ with tabs[0]:
 
 # --- TAB 2: COSTOS FIJOS (RESTAURADO CON TOTALES) ---
 
-with tabs[1]:
+if seccion == "costos_fijos":
 
     st.header("Matriz de Costos Fijos")
 
@@ -221,261 +558,253 @@ with tabs[1]:
 
             if st.form_submit_button("Cargar") and f:
 
-                if borrar: run_query("TRUNCATE TABLE costos_fijos RESTART IDENTITY")
+                try:
 
-                df = pd.read_csv(f)
+                    df_ok, df_err = validar_costos_fijos(pd.read_csv(f))
 
-                for _, r in df.iterrows():
+                    if not df_err.empty:
 
-                    run_query("INSERT INTO costos_fijos (concepto, total_mensual, p_admin, p_ventas, p_prod) VALUES (:c, :t, :pa, :pv, :pp)",
+                        # Nada se escribe si alguna fila es inválida
+                        st.error(f"❌ {len(df_err)} filas inválidas (los % deben sumar 100). No se cargó nada.")
 
-                              {'c':r['concepto'], 't':r['total_mensual'], 'pa':r['p_admin'], 'pv':r['p_ventas'], 'pp':r['p_prod']})
+                        st.dataframe(df_err, use_container_width=True)
 
-                st.success("Cargado"); st.rerun()
+                    else:
 
+                        t0 = time.perf_counter()
+                        with transaccion(['costos_fijos']) as conn: n = cargar_costos_fijos(conn, df_ok, borrar)
+                        seg = time.perf_counter() - t0
 
+                        st.success(f"Cargado: {n} filas en {seg:.2f} s ({n / seg if seg > 0 else n:,.0f} filas/s)")
 
-    try:
+                except Exception as e: st.error(f"Error en CSV (no se guardó ningún cambio): {e}")
+
+
+
+    @fragmento
+    def matriz_costos_fijos():
+        try:
 
-        df_man = get_data("SELECT id, concepto, total_mensual, p_admin, p_ventas, p_prod FROM costos_fijos ORDER BY id")
+            df_man = get_data("SELECT id, concepto, total_mensual, p_admin, p_ventas, p_prod FROM costos_fijos ORDER BY id")
 
         
 
-        # Lógica de Filas Auto de Nóminas
+            # Lógica de Filas Auto de Nóminas
 
-        filas_auto = []
+            filas_auto = []
 
-        adm = get_data("SELECT salario_base, p_prestaciones, num_empleados FROM config_admin WHERE id=1").iloc[0]
+            config = get_config()
+            adm = config.admin
 
-        t_adm = float(adm['salario_base'] * adm['num_empleados'])
+            t_adm = float(adm['salario_base'] * adm['num_empleados'])
 
-        filas_auto.append({'id': -1, 'concepto': '⚡ Nómina: Salarios Admin', 'total_mensual': t_adm, 'p_admin': 100, 'p_ventas': 0, 'p_prod': 0})
+            filas_auto.append({'id': -1, 'concepto': '⚡ Nómina: Salarios Admin', 'total_mensual': t_adm, 'p_admin': 100, 'p_ventas': 0, 'p_prod': 0})
 
-        filas_auto.append({'id': -2, 'concepto': '⚡ Nómina: Prestaciones Admin', 'total_mensual': t_adm*(adm['p_prestaciones']/100), 'p_admin': 100, 'p_ventas': 0, 'p_prod': 0})
+            filas_auto.append({'id': -2, 'concepto': '⚡ Nómina: Prestaciones Admin', 'total_mensual': t_adm*(adm['p_prestaciones']/100), 'p_admin': 100, 'p_ventas': 0, 'p_prod': 0})
 
         
 
-        ven = get_data("SELECT salario_base, p_prestaciones, num_empleados FROM config_ventas WHERE id=1").iloc[0]
+            ven = config.ventas
 
-        t_ven = float(ven['salario_base'] * ven['num_empleados'])
+            t_ven = float(ven['salario_base'] * ven['num_empleados'])
 
-        filas_auto.append({'id': -3, 'concepto': '⚡ Nómina: Salarios Ventas', 'total_mensual': t_ven, 'p_admin': 0, 'p_ventas': 100, 'p_prod': 0})
+            filas_auto.append({'id': -3, 'concepto': '⚡ Nómina: Salarios Ventas', 'total_mensual': t_ven, 'p_admin': 0, 'p_ventas': 100, 'p_prod': 0})
 
-        filas_auto.append({'id': -4, 'concepto': '⚡ Nómina: Prestaciones Ventas', 'total_mensual': t_ven*(ven['p_prestaciones']/100), 'p_admin': 0, 'p_ventas': 100, 'p_prod': 0})
+            filas_auto.append({'id': -4, 'concepto': '⚡ Nómina: Prestaciones Ventas', 'total_mensual': t_ven*(ven['p_prestaciones']/100), 'p_admin': 0, 'p_ventas': 100, 'p_prod': 0})
 
 
 
-        df_show = pd.concat([df_man, pd.DataFrame(filas_auto)], ignore_index=True)
+            df_show = pd.concat([df_man, pd.DataFrame(filas_auto)], ignore_index=True)
 
-        ed_df = st.data_editor(df_show, disabled=["id"], num_rows="dynamic", key="cf_ed", column_config={"total_mensual": st.column_config.NumberColumn(format="Q%.2f")})
+            ed_df = st.data_editor(df_show, disabled=["id"], num_rows="dynamic", key="cf_ed", column_config={"total_mensual": st.column_config.NumberColumn(format="Q%.2f")})
 
         
 
-        if st.button("💾 Guardar Matriz"):
+            if st.button("💾 Guardar Matriz"):
 
-            ids_now = set()
+                ids_now = set()
 
-            for _, r in ed_df.iterrows():
+                for _, r in ed_df.iterrows():
 
-                if r['id'] >= 0:
+                    if r['id'] >= 0:
 
-                    ids_now.add(r['id'])
+                        ids_now.add(r['id'])
 
-                    run_query("UPDATE costos_fijos SET concepto=:c, total_mensual=:t, p_admin=:pa, p_ventas=:pv, p_prod=:pp WHERE id=:id",
+                        run_query("UPDATE costos_fijos SET concepto=:c, total_mensual=:t, p_admin=:pa, p_ventas=:pv, p_prod=:pp WHERE id=:id",
 
-                            {'c':r['concepto'], 't':r['total_mensual'], 'pa':r['p_admin'], 'pv':r['p_ventas'], 'pp':r['p_prod'], 'id':r['id']})
+                                {'c':r['concepto'], 't':r['total_mensual'], 'pa':r['p_admin'], 'pv':r['p_ventas'], 'pp':r['p_prod'], 'id':r['id']})
 
-                elif pd.isna(r['id']):
+                    elif pd.isna(r['id']):
 
-                    run_query("INSERT INTO costos_fijos (concepto, total_mensual, p_admin, p_ventas, p_prod) VALUES (:c, :t, :pa, :pv, :pp)",
+                        run_query("INSERT INTO costos_fijos (concepto, total_mensual, p_admin, p_ventas, p_prod) VALUES (:c, :t, :pa, :pv, :pp)",
 
-                            {'c':r['concepto'], 't':r['total_mensual'], 'pa':r['p_admin'], 'pv':r['p_ventas'], 'pp':r['p_prod']})
+                                {'c':r['concepto'], 't':r['total_mensual'], 'pa':r['p_admin'], 'pv':r['p_ventas'], 'pp':r['p_prod']})
 
             
 
-            ids_old = set(df_man['id'].tolist())
+                ids_old = set(df_man['id'].tolist())
 
-            to_del = list(ids_old - ids_now)
+                to_del = list(ids_old - ids_now)
 
-            if to_del:
+                if to_del:
 
-                todel = tuple(to_del)
+                    todel = tuple(to_del)
 
-                if len(to_del)==1: todel = f"({to_del[0]})"
+                    if len(to_del)==1: todel = f"({to_del[0]})"
 
-                run_query(f"DELETE FROM costos_fijos WHERE id IN {todel}")
+                    run_query(f"DELETE FROM costos_fijos WHERE id IN {todel}")
 
-            st.success("Guardado"); st.rerun()
+                st.success("Guardado"); rerun_fragmento()
 
 
 
-        # --- SECCIÓN DE TOTALES RESTAURADA ---
+            # --- SECCIÓN DE TOTALES RESTAURADA ---
 
-        ed_df['M_Admin'] = ed_df['total_mensual'] * (ed_df['p_admin']/100)
+            ed_df['M_Admin'] = ed_df['total_mensual'] * (ed_df['p_admin']/100)
 
-        ed_df['M_Ventas'] = ed_df['total_mensual'] * (ed_df['p_ventas']/100)
+            ed_df['M_Ventas'] = ed_df['total_mensual'] * (ed_df['p_ventas']/100)
 
-        ed_df['M_Prod'] = ed_df['total_mensual'] * (ed_df['p_prod']/100)
+            ed_df['M_Prod'] = ed_df['total_mensual'] * (ed_df['p_prod']/100)
 
         
 
-        st.divider()
+            st.divider()
 
-        st.subheader("📊 Resumen Mensual")
+            st.subheader("📊 Resumen Mensual")
 
-        c1, c2, c3, c4 = st.columns(4)
+            c1, c2, c3, c4 = st.columns(4)
 
-        c1.metric("TOTAL GASTOS", f"Q{ed_df['total_mensual'].sum():,.2f}")
+            c1.metric("TOTAL GASTOS", f"Q{ed_df['total_mensual'].sum():,.2f}")
 
-        c2.metric("Total Admin", f"Q{ed_df['M_Admin'].sum():,.2f}")
+            c2.metric("Total Admin", f"Q{ed_df['M_Admin'].sum():,.2f}")
 
-        c3.metric("Total Ventas", f"Q{ed_df['M_Ventas'].sum():,.2f}")
+            c3.metric("Total Ventas", f"Q{ed_df['M_Ventas'].sum():,.2f}")
 
-        c4.metric("Total Prod (CIF)", f"Q{ed_df['M_Prod'].sum():,.2f}")
+            c4.metric("Total Prod (CIF)", f"Q{ed_df['M_Prod'].sum():,.2f}")
 
         
 
-        st.write("---")
+            st.write("---")
 
-        u_prom = get_data("SELECT unidades_promedio_mes FROM config_global WHERE id=1").iloc[0,0]
+            u_prom = config.unidades_promedio_mes
 
-        u_base = st.number_input("Unidades Base", value=int(u_prom))
+            u_base = st.number_input("Unidades Base", value=int(u_prom))
 
-        if u_base != u_prom:
+            if u_base != u_prom:
 
-            run_query("UPDATE config_global SET unidades_promedio_mes=:u WHERE id=1", {'u':u_base})
+                run_query("UPDATE config_global SET unidades_promedio_mes=:u WHERE id=1", {'u':u_base})
 
-            st.rerun()
+                rerun_fragmento()
 
             
 
-        cif_unit = ed_df['M_Prod'].sum() / u_base if u_base > 0 else 0
+            cif_unit = ed_df['M_Prod'].sum() / u_base if u_base > 0 else 0
 
-        st.success(f"🎯 CIF Unitario: **Q{cif_unit:,.2f}**")
+            st.success(f"🎯 CIF Unitario: **Q{cif_unit:,.2f}**")
 
 
 
-    except Exception as e: st.error(f"Error cargando matriz: {e}")
+        except Exception as e: st.error(f"Error cargando matriz: {e}")
+    matriz_costos_fijos()
 # --- TAB 3: MATERIAS PRIMAS (CON IVA Y ELIMINACIÓN) ---
-with tabs[2]:
+if seccion == "materias_primas":
     st.header("🌿 Inventario Materia Prima")
+    @fragmento
+    def editor_materias_primas():
+        if 'mp_sync_msg' in st.session_state: st.success(st.session_state.pop('mp_sync_msg'))
     
-    # 1. BUSCADOR DINÁMICO
-    busqueda = st.text_input("🔍 Buscar por código o nombre:", placeholder="Ej: REPH... o Alcohol")
-    
-    # Recuperamos los datos de la DB (Añadimos 'tiene_iva')
-    query_base = "SELECT id, codigo_interno, nombre, categoria, unidad_medida, costo_unitario, tiene_iva FROM materias_primas"
-    df_mps = get_data(f"{query_base} ORDER BY nombre")
-    ids_antes = set(df_mps['id'].dropna().unique()) # Guardamos los IDs actuales
-    
-    if busqueda:
-        df_filtrado = df_mps[
-            df_mps['nombre'].str.contains(busqueda, case=False, na=False) | 
-            df_mps['codigo_interno'].str.contains(busqueda, case=False, na=False)
-        ]
-    else:
-        df_filtrado = df_mps
-
-    # 2. EDITOR DE DATOS
-    # Configuramos la columna IVA para que sea un checkbox
-    ed_mp = st.data_editor(
-        df_filtrado, 
-        num_rows="dynamic", 
-        key="mp_ed_v3", 
-        disabled=["id"],
-        use_container_width=True,
-        column_config={
-            "tiene_iva": st.column_config.CheckboxColumn("¿Tiene IVA?", default=False),
-            "costo_unitario": st.column_config.NumberColumn("Costo (Q)", format="%.4f")
-        }
-    )
+        # 1. BUSCADOR DINÁMICO (en el servidor, por páginas)
+        c_bus, c_pp, c_pag = st.columns([3, 1, 1])
+        busqueda = c_bus.text_input("🔍 Buscar por código o nombre:", placeholder="Ej: REPH... o Alcohol", key="mp_buscar")
+        st.session_state.setdefault("mp_por_pagina", 50)
+        por_pagina = c_pp.selectbox("Filas por página", [25, 50, 100, 250], key="mp_por_pagina")
+        if st.session_state.get('mp_busqueda_prev') != (busqueda, por_pagina):
+            st.session_state['mp_busqueda_prev'] = (busqueda, por_pagina)
+            st.session_state['mp_pagina'] = 1  # nueva búsqueda: volver a la primera página
+
+        st.session_state.setdefault('mp_pagina', 1)
+        pagina = c_pag.number_input("Página", min_value=1, step=1, key="mp_pagina")
+        df_filtrado, total = buscar_materias_primas(busqueda, pagina, por_pagina)
+        n_paginas = max(1, -(-total // por_pagina))
+        st.caption(f"{total} materias primas encontradas · página {pagina} de {n_paginas}")
+
+        # 2. EDITOR DE DATOS
+        # Configuramos la columna IVA para que sea un checkbox
+        ed_mp = st.data_editor(
+            df_filtrado, 
+            num_rows="dynamic", 
+            key=f"mp_ed_v3_{busqueda}_{pagina}_{por_pagina}",  # estado del editor por página
+            disabled=["id"],
+            use_container_width=True,
+            column_config={
+                "tiene_iva": st.column_config.CheckboxColumn("¿Tiene IVA?", default=False),
+                "costo_unitario": st.column_config.NumberColumn("Costo (Q)", format="%.4f")
+            }
+        )
     
-    # 3. LOGICA DE ACTUALIZACIÓN Y ELIMINACIÓN
-    st.write("---")
-    col_save, col_check = st.columns([1, 2])
+        # 3. LOGICA DE ACTUALIZACIÓN Y ELIMINACIÓN
+        st.write("---")
+        col_save, col_check = st.columns([1, 2])
     
-    with col_check:
-        confirmar = st.checkbox("✅ Confirmo que los precios (sin IVA si aplica) y datos son correctos.")
+        with col_check:
+            confirmar = st.checkbox("✅ Confirmo que los precios (sin IVA si aplica) y datos son correctos.")
     
-    with col_save:
-        if st.button("💾 Sincronizar Cambios", disabled=not confirmar, type="primary"):
-            try:
-                # A. Detectar y eliminar filas borradas
-                ids_ahora = set(ed_mp['id'].dropna().unique())
-                ids_a_eliminar = ids_antes - ids_ahora
-                
-                if ids_a_eliminar:
-                    for id_del in ids_a_eliminar:
-                        run_query("DELETE FROM materias_primas WHERE id = :id", {'id': id_del})
-
-                # B. Actualizar o Insertar filas
-                for _, r in ed_mp.iterrows():
-                    id_actual = r.get('id')
-                    
-                    # Lógica de IVA: Si tiene IVA, lo guardamos ya neto (Costo / 1.12)
-                    # Opcional: Puedes elegir guardar el bruto y calcularlo solo al ver recetas.
-                    # Aquí lo guardaremos bruto pero con el flag para procesarlo después.
-                    costo = float(r['costo_unitario'])
-                    t_iva = bool(r['tiene_iva'])
-                    
-                    if pd.notna(id_actual): 
-                        run_query("""UPDATE materias_primas SET codigo_interno=:cod, nombre=:n, 
-                                     categoria=:c, unidad_medida=:u, costo_unitario=:p, tiene_iva=:iva 
-                                     WHERE id=:id""", 
-                                  {'cod':r['codigo_interno'], 'n':r['nombre'], 'c':r['categoria'], 
-                                   'u':r['unidad_medida'], 'p':costo, 'iva':t_iva, 'id':id_actual})
-                    else: 
-                        run_query("""INSERT INTO materias_primas (codigo_interno, nombre, categoria, unidad_medida, costo_unitario, tiene_iva) 
-                                     VALUES (:cod, :n, :c, :u, :p, :iva)""", 
-                                  {'cod':r['codigo_interno'], 'n':r['nombre'], 'c':r['categoria'], 
-                                   'u':r['unidad_medida'], 'p':costo, 'iva':t_iva})
-                
-                st.success("¡Base de datos sincronizada y limpia!")
-                st.rerun()
-            except Exception as e:
-                st.error(f"Error al sincronizar: {e}")
+        with col_save:
+            if st.button("💾 Sincronizar Cambios", disabled=not confirmar, type="primary"):
+                try:
+                    # Solo se envían las diferencias contra lo que se mostró en el editor
+                    # (el costo se guarda bruto, con el flag de IVA para procesarlo al costear)
+                    with transaccion(['materias_primas']) as conn:
+                        res = sincronizar_materias_primas(conn, df_filtrado, ed_mp)
+                    st.session_state['mp_sync_msg'] = (f"¡Base de datos sincronizada! {res['insertadas']} nuevas, "
+                                                       f"{res['actualizadas']} actualizadas, {res['eliminadas']} eliminadas.")
+                    rerun_fragmento()
+                except Exception as e:
+                    st.error(f"Error al sincronizar (no se guardó ningún cambio): {e}")
+    editor_materias_primas()
 # --- TAB 4: FÁBRICA (PRODUCTOS, LÍNEAS Y RECETAS) ---
-with tabs[3]:
+if seccion == "fabrica":
     st.header("Gestión de Producción")
     
     # --- A. DATOS DE REFERENCIA ---
     try:
-        mod_cfg = get_data("SELECT salario_base, p_prestaciones, num_operarios, horas_mes FROM config_mod WHERE id=1").iloc[0]
-        t_mod_mensual = float(mod_cfg['salario_base'] * mod_cfg['num_operarios'] * (1 + mod_cfg['p_prestaciones']/100))
-        minutos_disponibles = float(mod_cfg['horas_mes'] * mod_cfg['num_operarios'] * 60)
-        costo_minuto = t_mod_mensual / minutos_disponibles if minutos_disponibles > 0 else 0
-        st.info(f"⏱️ **Costo de Mano de Obra por Minuto:** Q{costo_minuto:,.4f}")
+        config = get_config()
+        if config.mod['salario_base'] is None: raise ValueError("config_mod vacía")
+        st.info(f"⏱️ **Costo de Mano de Obra por Minuto:** Q{config.costo_minuto:,.4f}")
     except:
         st.warning("Configure la nómina de producción para calcular el costo por minuto.")
 
     # --- B. GESTOR DE LÍNEAS (CREAR Y BORRAR) ---
-    with st.expander("🛠️ Configurar Líneas de Producción"):
-        df_lineas_db = get_data("SELECT id, nombre FROM lineas_produccion ORDER BY nombre")
-        ed_lineas = st.data_editor(
-            df_lineas_db, 
-            num_rows="dynamic", 
-            key="ed_lineas_master_v3", 
-            disabled=["id"],
-            use_container_width=True
-        )
+    @fragmento
+    def gestor_lineas():
+        with st.expander("🛠️ Configurar Líneas de Producción"):
+            df_lineas_db = get_data("SELECT id, nombre FROM lineas_produccion ORDER BY nombre")
+            ed_lineas = st.data_editor(
+                df_lineas_db, 
+                num_rows="dynamic", 
+                key="ed_lineas_master_v3", 
+                disabled=["id"],
+                use_container_width=True
+            )
         
-        if st.button("💾 Sincronizar Líneas"):
-            ids_antes = set(df_lineas_db['id'].tolist())
-            ids_ahora = set(ed_lineas['id'].dropna().tolist())
-            ids_a_borrar = ids_antes - ids_ahora
+            if st.button("💾 Sincronizar Líneas"):
+                ids_antes = set(df_lineas_db['id'].tolist())
+                ids_ahora = set(ed_lineas['id'].dropna().tolist())
+                ids_a_borrar = ids_antes - ids_ahora
             
-            # 1. Eliminar
-            for id_del in ids_a_borrar:
-                run_query("DELETE FROM lineas_produccion WHERE id = :id", {'id': id_del})
+                # 1. Eliminar
+                for id_del in ids_a_borrar:
+                    run_query("DELETE FROM lineas_produccion WHERE id = :id", {'id': id_del})
             
-            # 2. Actualizar o Insertar
-            for _, r in ed_lineas.iterrows():
-                if pd.isna(r['id']): # Nueva
-                    run_query("INSERT INTO lineas_produccion (nombre) VALUES (:n) ON CONFLICT DO NOTHING", {'n': r['nombre']})
-                else: # Editar nombre existente
-                    run_query("UPDATE lineas_produccion SET nombre=:n WHERE id=:id", {'n': r['nombre'], 'id': r['id']})
-            st.success("Catálogo de líneas actualizado.")
-            st.rerun()
+                # 2. Actualizar o Insertar
+                for _, r in ed_lineas.iterrows():
+                    if pd.isna(r['id']): # Nueva
+                        run_query("INSERT INTO lineas_produccion (nombre) VALUES (:n) ON CONFLICT DO NOTHING", {'n': r['nombre']})
+                    else: # Editar nombre existente
+                        run_query("UPDATE lineas_produccion SET nombre=:n WHERE id=:id", {'n': r['nombre'], 'id': r['id']})
+                st.success("Catálogo de líneas actualizado.")
+                st.rerun()  # las líneas se usan en el resto de Fábrica: rerun completo
+    gestor_lineas()
 
     # --- C. CARGA MASIVA INTELIGENTE ---
     with st.expander("📂 Carga Masiva de Productos (CSV)"):
@@ -484,27 +813,16 @@ with tabs[3]:
             f_p = st.file_uploader("Subir CSV", type="csv")
             if st.form_submit_button("Procesar") and f_p:
                 try:
-                    df_p = pd.read_csv(f_p, sep=None, engine='python')
-                    df_p.columns = [c.strip().lower() for c in df_p.columns]
-                    
-                    for _, r in df_p.iterrows():
-                        l_csv = str(r['linea']).strip()
-                        run_query("INSERT INTO lineas_produccion (nombre) VALUES (:n) ON CONFLICT DO NOTHING", {'n': l_csv})
-                        
-                        run_query("""
-                            INSERT INTO productos (codigo_barras, nombre, tipo_produccion, unidades_por_lote, minutos_por_unidad, precio_venta_sugerido, linea)
-                            VALUES (:c, :n, :t, :u, :m, :p, :l)
-                            ON CONFLICT (codigo_barras) DO UPDATE SET 
-                            nombre=:n, tipo_produccion=:t, unidades_por_lote=:u, minutos_por_unidad=:m, precio_venta_sugerido=:p, linea=:l
-                        """, {
-                            'c': str(r['codigo']), 'n': r['nombre'], 't': r['tipo'], 
-                            'u': r['unidades_lote'], 'm': float(r['tiempo_ciclo']),
-                            'p': r['precio'], 'l': l_csv
-                        })
-                    st.success("Carga masiva completada.")
-                    st.rerun()
+                    t0 = time.perf_counter()
+                    with transaccion(['productos', 'lineas_produccion']) as conn:
+                        res = cargar_productos_csv(conn, f_p)
+                    seg = time.perf_counter() - t0
+                    st.success(f"Carga masiva completada en {seg:.2f} s: {res['insertados']} nuevos, "
+                               f"{res['actualizados']} actualizados, {res['rechazados']} rechazados.")
+                    if res['duplicados']:
+                        st.info(f"{res['duplicados']} códigos repetidos en el archivo: se usó la última fila de cada uno.")
                 except Exception as e: 
-                    st.error(f"Error en CSV: {e}")
+                    st.error(f"Error en CSV (no se guardó ningún cambio): {e}")
 
     # --- D. HERRAMIENTAS DE CLONACIÓN ---
     with st.expander("©️ Herramientas de Clonación (Recetas y Variantes)"):
@@ -517,6 +835,7 @@ with tabs[3]:
         with tab_clon1:
             st.write("Crea un producto **nuevo** copiando datos y receta de otro.")
             if lista_prods:
+                validar_opcion("clon_src_new", lista_prods)
                 c1, c2, c3 = st.columns(3)
                 origen_str = c1.selectbox("Basado en:", lista_prods, key="clon_src_new")
                 new_cod = c2.text_input("Nuevo Código", key="clon_cod_new")
@@ -525,55 +844,45 @@ with tabs[3]:
                 if st.button("🚀 Crear Variante", type="primary"):
                     try:
                         cod_org = origen_str.split(" | ")[-1]
-                        base = get_data("SELECT * FROM productos WHERE codigo_barras=:c", {'c': cod_org}).iloc[0]
-                        
-                        # 1. Crear Producto
-                        run_query("""
-                            INSERT INTO productos (codigo_barras, nombre, tipo_produccion, unidades_por_lote, minutos_por_unidad, precio_venta_sugerido, linea)
-                            VALUES (:c, :n, :t, :u, :m, :p, :l)
-                        """, {'c': new_cod, 'n': new_nom, 't': base['tipo_produccion'], 
-                              'u': base['unidades_por_lote'], 'm': base['minutos_por_unidad'], 
-                              'p': base['precio_venta_sugerido'], 'l': base['linea']})
-                        
-                        # 2. Copiar Receta
-                        rec_base = get_data("SELECT mp_id, cantidad, unidad_uso FROM recetas WHERE producto_id=:pid", {'pid': cod_org})
-                        for _, row in rec_base.iterrows():
-                            run_query("INSERT INTO recetas (producto_id, mp_id, cantidad, unidad_uso) VALUES (:pid, :mid, :c, :u)",
-                                      {'pid': new_cod, 'mid': row['mp_id'], 'c': row['cantidad'], 'u': row['unidad_uso']})
-                        
-                        st.success(f"Variante creada: {new_nom}")
+                        # Producto + receta en una transacción: o se crea todo o nada
+                        with transaccion(['productos', 'recetas']) as conn:
+                            n_lineas = crear_variante(conn, cod_org, new_cod, new_nom)
+                        st.success(f"Variante creada: {new_nom} ({n_lineas} ingredientes)")
                         st.rerun()
                     except Exception as e:
                         st.error(f"Error: {e}")
 
-        # OPCIÓN 2: Pegar receta a producto EXISTENTE
+        # OPCIÓN 2: Pegar receta a productos EXISTENTES (uno, varios o una línea completa)
         with tab_clon2:
-            st.write("Copia los ingredientes de un producto a otro que **ya existe** (sobrescribe la receta destino).")
+            st.write("Copia los ingredientes de un producto a otros que **ya existen** (sobrescribe la receta destino).")
             if lista_prods:
-                col_a, col_b = st.columns(2)
-                p_origen = col_a.selectbox("Copiar receta DE:", lista_prods, key="clon_src_exist")
-                p_destino = col_b.selectbox("Pegar receta A:", lista_prods, key="clon_dst_exist")
-                
+                validar_opcion("clon_src_exist", lista_prods)
+                p_origen = st.selectbox("Copiar receta DE:", lista_prods, key="clon_src_exist")
+                modo_dst = st.radio("Pegar receta A:", ["Productos seleccionados", "Toda una línea"], horizontal=True, key="clon_modo_dst")
+                if modo_dst == "Productos seleccionados":
+                    if "clon_dst_exist" in st.session_state:
+                        st.session_state.clon_dst_exist = [p for p in st.session_state.clon_dst_exist if p in lista_prods]
+                    p_destinos = st.multiselect("Productos destino:", lista_prods, key="clon_dst_exist")
+                else:
+                    lineas_clon = get_data("SELECT nombre FROM lineas_produccion ORDER BY nombre")['nombre'].tolist()
+                    validar_opcion("clon_dst_linea", lineas_clon)
+                    linea_dst = st.selectbox("Línea destino:", lineas_clon, key="clon_dst_linea")
+
                 if st.button("⚠️ Sobrescribir Receta"):
                     cod_org = p_origen.split(" | ")[-1]
-                    cod_dst = p_destino.split(" | ")[-1]
-                    
-                    if cod_org == cod_dst:
-                        st.error("El origen y destino no pueden ser el mismo.")
-                    else:
-                        # 1. Borrar receta anterior del destino
-                        run_query("DELETE FROM recetas WHERE producto_id = :pid", {'pid': cod_dst})
-                        
-                        # 2. Copiar nueva receta
-                        rec_base = get_data("SELECT mp_id, cantidad, unidad_uso FROM recetas WHERE producto_id=:pid", {'pid': cod_org})
-                        if not rec_base.empty:
-                            for _, row in rec_base.iterrows():
-                                run_query("INSERT INTO recetas (producto_id, mp_id, cantidad, unidad_uso) VALUES (:pid, :mid, :c, :u)",
-                                          {'pid': cod_dst, 'mid': row['mp_id'], 'c': row['cantidad'], 'u': row['unidad_uso']})
-                            st.success("Receta copiada exitosamente.")
-                            st.rerun()
-                        else:
-                            st.warning("El producto origen no tiene receta.")
+                    try:
+                        # Borrado y copia en la misma transacción: un fallo no deja recetas a medias
+                        with transaccion(['recetas']) as conn:
+                            if modo_dst == "Productos seleccionados":
+                                n_dst, n_lin = clonar_receta(conn, cod_org, [p.split(" | ")[-1] for p in p_destinos])
+                            else:
+                                n_dst, n_lin = clonar_receta_a_linea(conn, cod_org, linea_dst)
+                        st.success(f"Receta copiada exitosamente a {n_dst} productos ({n_lin} líneas).")
+                        st.rerun()
+                    except ValueError as e:
+                        st.warning(str(e))
+                    except Exception as e:
+                        st.error(f"Error (no se modificó ninguna receta): {e}")
 
     # --- E. EDITOR INDIVIDUAL Y RECETAS ---
     st.divider()
@@ -606,127 +915,120 @@ with tabs[3]:
 
     # Columna Derecha: Editor de Recetas
     with c_right:
-        prods_list = get_data("SELECT codigo_barras, nombre, linea FROM productos ORDER BY nombre")
-        if not prods_list.empty:
-            sel_str = st.selectbox("🛠️ Editar Receta de:", 
-                                   [f"{r['nombre']} | {r['linea']}" for _, r in prods_list.iterrows()])
+        @fragmento
+        def editor_recetas():
+            prods_list = get_data("SELECT codigo_barras, nombre, linea FROM productos ORDER BY nombre")
+            if not prods_list.empty:
+                ops_receta = [f"{r['nombre']} | {r['linea']}" for _, r in prods_list.iterrows()]
+                validar_opcion("receta_sel", ops_receta)
+                sel_str = st.selectbox("🛠️ Editar Receta de:", ops_receta, key="receta_sel")
             
-            nom_sel = sel_str.split(" | ")[0]
-            pid = prods_list[prods_list['nombre'] == nom_sel]['codigo_barras'].values[0]
+                nom_sel = sel_str.split(" | ")[0]
+                pid = prods_list[prods_list['nombre'] == nom_sel]['codigo_barras'].values[0]
             
-            mps = get_data("SELECT id, nombre, unidad_medida FROM materias_primas ORDER BY nombre")
-            u_db = get_data("SELECT DISTINCT unidad_medida FROM materias_primas WHERE unidad_medida IS NOT NULL")
-            ops_u = u_db['unidad_medida'].tolist()
-            if "Nueva unidad..." not in ops_u: ops_u.append("Nueva unidad...")
-
-            with st.form("add_rec_f"):
-                c1, c2, c3 = st.columns([3, 1.2, 1.5])
-                m_n = c1.selectbox("Materia Prima", mps['nombre'].tolist())
-                m_dat = mps[mps['nombre']==m_n].iloc[0]
-                can = c2.number_input("Cant.", format="%.4f")
+                mps = get_data("SELECT id, nombre, unidad_medida FROM materias_primas ORDER BY nombre")
+                u_db = get_data("SELECT DISTINCT unidad_medida FROM materias_primas WHERE unidad_medida IS NOT NULL")
+                ops_u = u_db['unidad_medida'].tolist()
+                if "Nueva unidad..." not in ops_u: ops_u.append("Nueva unidad...")
+
+                with st.form("add_rec_f"):
+                    c1, c2, c3 = st.columns([3, 1.2, 1.5])
+                    m_n = c1.selectbox("Materia Prima", mps['nombre'].tolist())
+                    m_dat = mps[mps['nombre']==m_n].iloc[0]
+                    can = c2.number_input("Cant.", format="%.4f")
                 
-                idx_u = ops_u.index(m_dat['unidad_medida']) if m_dat['unidad_medida'] in ops_u else 0
-                u_sel = c3.selectbox("Unidad", ops_u, index=idx_u)
-                new_u_txt = st.text_input("Nueva unidad (si aplica):")
+                    idx_u = ops_u.index(m_dat['unidad_medida']) if m_dat['unidad_medida'] in ops_u else 0
+                    u_sel = c3.selectbox("Unidad", ops_u, index=idx_u)
+                    new_u_txt = st.text_input("Nueva unidad (si aplica):")
                 
-                if st.form_submit_button("➕ Agregar"):
-                    u_fin = new_u_txt if u_sel == "Nueva unidad..." else u_sel
-                    run_query("INSERT INTO recetas (producto_id, mp_id, cantidad, unidad_uso) VALUES (:pid, :mid, :c, :u)",
-                              {'pid': pid, 'mid': int(m_dat['id']), 'c': can, 'u': u_fin})
-                    st.rerun()
-
-            curr = get_data("SELECT r.id, m.nombre, r.cantidad, r.unidad_uso FROM recetas r JOIN materias_primas m ON r.mp_id=m.id WHERE r.producto_id=:pid", {'pid': pid})
-            st.dataframe(curr, use_container_width=True, hide_index=True)
+                    if st.form_submit_button("➕ Agregar"):
+                        u_fin = new_u_txt if u_sel == "Nueva unidad..." else u_sel
+                        run_query("INSERT INTO recetas (producto_id, mp_id, cantidad, unidad_uso) VALUES (:pid, :mid, :c, :u)",
+                                  {'pid': pid, 'mid': int(m_dat['id']), 'c': can, 'u': u_fin})
+                        rerun_fragmento()
+
+                curr = get_data("SELECT r.id, m.nombre, r.cantidad, r.unidad_uso FROM recetas r JOIN materias_primas m ON r.mp_id=m.id WHERE r.producto_id=:pid", {'pid': pid})
+                st.dataframe(curr, use_container_width=True, hide_index=True)
             
-            if st.button("👁️ Calcular Costo Rápido"):
-                # Cálculo rápido sin CIF (solo materiales)
-                cost_m = 0
-                for _, row in curr.iterrows():
-                    mp_id_val = mps[mps['nombre']==row['nombre']]['id'].values[0]
-                    cost_m += row['cantidad'] * obtener_costo_convertido(mp_id_val, row['unidad_uso'])
-                st.info(f"Costo Materiales Aprox: Q{cost_m:,.2f}")
-
-            if not curr.empty:
-                with st.expander("🗑️ Borrar Ingrediente"):
-                    del_dict = {f"{r['nombre']} ({r['cantidad']})": r['id'] for _, r in curr.iterrows()}
-                    sel_d = st.selectbox("Elige:", list(del_dict.keys()))
-                    if st.button("Confirmar Borrado"):
-                        run_query("DELETE FROM recetas WHERE id=:id", {'id': del_dict[sel_d]})
-                        st.rerun()
+                if st.button("👁️ Calcular Costo Rápido"):
+                    # Cálculo rápido sin CIF (solo materiales)
+                    lineas_rap = costear_recetas(pid)
+                    cost_m = lineas_rap['costo_linea'].sum()
+                    avisar_sin_conversion(lineas_rap)
+                    st.info(f"Costo Materiales Aprox: Q{cost_m:,.2f}")
+
+                if not curr.empty:
+                    with st.expander("🗑️ Borrar Ingrediente"):
+                        del_dict = {f"{r['nombre']} ({r['cantidad']})": r['id'] for _, r in curr.iterrows()}
+                        sel_d = st.selectbox("Elige:", list(del_dict.keys()))
+                        if st.button("Confirmar Borrado"):
+                            run_query("DELETE FROM recetas WHERE id=:id", {'id': del_dict[sel_d]})
+                            rerun_fragmento()
+        editor_recetas()
 # --- TAB 5: FICHA TÉCNICA (ACTUALIZADA CON COSTOS REALES Y SEMÁFORO) ---
-with tabs[4]:
+if seccion == "ficha":
     st.header("🔎 Ficha Técnica de Costeo")
     prods_f = get_data("SELECT * FROM productos ORDER BY nombre")
-    sel_f = st.selectbox("Ver Ficha de:", [""] + prods_f['nombre'].tolist())
+    validar_opcion("ficha_sel", [""] + prods_f['nombre'].tolist())
+    sel_f = st.selectbox("Ver Ficha de:", [""] + prods_f['nombre'].tolist(), key="ficha_sel")
     
     if sel_f:
         p_info = prods_f[prods_f['nombre']==sel_f].iloc[0]
         cod_p = p_info['codigo_barras']
         
-        # Recuperar receta
-        rec_det = get_data("SELECT m.nombre, m.categoria, r.cantidad, r.unidad_uso, m.id as mid FROM recetas r JOIN materias_primas m ON r.mp_id=m.id WHERE r.producto_id=:c", {'c':cod_p})
+        # Receta, volumen, MOD y costos fijos no dependen entre sí: un solo tiempo de espera
+        lect_f = leer_en_paralelo(
+            receta=lambda: costear_recetas(cod_p),
+            volumen_real=volumen_mes_actual,
+            config=get_config,
+        )
+        rec_det = lect_f['receta']
         df_frag = rec_det[rec_det['categoria'].str.contains("FRAGANCIA|FORMULA", case=False, na=False)]
         df_otros = rec_det[~rec_det['categoria'].str.contains("FRAGANCIA|FORMULA", case=False, na=False)]
         
         st.markdown(f"### {p_info['nombre']}")
+        avisar_sin_conversion(rec_det)
         
         # Botón de Exportación
         if st.button("📥 Generar Reporte PDF"):
             st.info("Función de exportación PDF seleccionada. Preparando estructura de datos...")
 
         c_f, c_o = st.columns(2)
-        tot_formula = 0
-        tot_empaque = 0
         
         with c_f:
             st.write("**🧪 FRAGANCIA / FÓRMULA**")
-            sub_f = 0
             for _, r in df_frag.iterrows():
-                linea = r['cantidad'] * obtener_costo_convertido(r['mid'], r['unidad_uso'])
-                sub_f += linea
-                st.write(f"- {r['nombre']}: Q{linea:.4f}")
+                st.write(f"- {r['nombre']}: Q{r['costo_linea']:.4f}")
+            sub_f = df_frag['costo_linea'].sum()
             st.info(f"SUB-TOTAL FORMULA: Q{sub_f:.4f}")
-            tot_formula = sub_f
 
         with c_o:
             st.write("**📦 MATERIA PRIMA / EMPAQUE**")
-            sub_o = 0
             for _, r in df_otros.iterrows():
-                linea = r['cantidad'] * obtener_costo_convertido(r['mid'], r['unidad_uso'])
-                sub_o += linea
-                st.write(f"- {r['nombre']}: Q{linea:.4f}")
+                st.write(f"- {r['nombre']}: Q{r['costo_linea']:.4f}")
+            sub_o = df_otros['costo_linea'].sum()
             st.info(f"SUB-TOTAL MATERIA PRIMA: Q{sub_o:.4f}")
-            tot_empaque = sub_o
         
         st.divider()
 
-        # --- CÁLCULOS TÉCNICOS CON VOLUMEN REAL ---
-        u_div = p_info['unidades_por_lote'] if p_info['tipo_produccion'] == 'Lote' else 1
-        
-        # Llamada a la función dinámica para obtener volumen real vs teórico
-        u_volumen, tipo_vol = obtener_volumen_referencia()
-        
-        costo_variable_u = (tot_formula + tot_empaque) / u_div
-        mod_cfg = get_data("SELECT salario_base, p_prestaciones, num_operarios, horas_mes FROM config_mod WHERE id=1").iloc[0]
-        t_mod_mensual = float(mod_cfg['salario_base'] * mod_cfg['num_operarios'] * (1 + mod_cfg['p_prestaciones']/100))
-        minutos_disponibles = float(mod_cfg['horas_mes'] * mod_cfg['num_operarios'] * 60)
-        costo_minuto = t_mod_mensual / minutos_disponibles if minutos_disponibles > 0 else 0
-        
-        tiempo_ciclo = float(p_info.get('minutos_por_unidad', 5.0)) 
-        mod_u = tiempo_ciclo * costo_minuto
-        
-        cif_tot = get_data("SELECT SUM(total_mensual * (p_prod/100)) FROM costos_fijos").iloc[0,0] or 0
-        c_fijos_u = float(cif_tot) / u_volumen
-        
-        gasto_op_tot = get_data("SELECT SUM(total_mensual * ((p_admin + p_ventas)/100)) FROM costos_fijos").iloc[0,0] or 0
-        gasto_op_u = float(gasto_op_tot) / u_volumen
-        
+        # --- CÁLCULOS TÉCNICOS CON VOLUMEN REAL (fórmulas en costeo.py) ---
+        # Volumen real del mes vs teórico (leído arriba junto con la receta)
+        config = lect_f['config']
+        u_volumen, tipo_vol = volumen_referencia(lect_f['volumen_real'], config.unidades_promedio_mes)
+        ficha = calcular_ficha(p_info, rec_det, config.costo_minuto, config.cif_tot, config.gasto_op_tot, u_volumen)
+
+        costo_variable_u = ficha['costo_variable']
+        tiempo_ciclo = float(ficha['minutos_por_unidad']) if pd.notna(ficha['minutos_por_unidad']) else 5.0
+        mod_u = ficha['mod']
+        c_fijos_u = ficha['cif_unitario']
+        gasto_op_u = ficha['gasto_operativo']
+
         # --- TOTALES FINALES ---
-        costo_total_u = costo_variable_u + mod_u + c_fijos_u
-        total_costos_gastos = costo_total_u + gasto_op_u
+        costo_total_u = ficha['costo_total']
+        total_costos_gastos = ficha['costo_y_gasto']
         precio_venta = float(p_info['precio_venta_sugerido'])
-        utilidad = precio_venta - total_costos_gastos
-        margen = (utilidad / precio_venta * 100) if precio_venta > 0 else 0
+        utilidad = ficha['utilidad']
+        margen = ficha['margen']
 
         # --- TABLA DE RESULTADOS ---
         st.subheader("📊 Desglose Final de Costos y Utilidad")
@@ -773,9 +1075,9 @@ with tabs[4]:
         """, unsafe_allow_html=True)
         
         st.write("")
-        st.metric("PUNTO DE EQUILIBRIO (Est.)", f"{int(total_costos_gastos / (precio_venta - costo_variable_u) * u_volumen) if precio_venta > costo_variable_u else 0} uds")
+        st.metric("PUNTO DE EQUILIBRIO (Est.)", f"{ficha['punto_equilibrio']} uds")
 # --- TAB 6: AJUSTES (CONVERSIONES) ---
-with tabs[5]:
+if seccion == "ajustes":
     st.header("⚙️ Ajustes y Conversiones")
     with st.form("new_conv"):
         c1, c2, c3 = st.columns(3)
@@ -786,106 +1088,333 @@ with tabs[5]:
             run_query("INSERT INTO conversiones (unidad_origen, unidad_destino, factor_multiplicador) VALUES (:o, :d, :f) ON CONFLICT (unidad_origen, unidad_destino) DO UPDATE SET factor_multiplicador=:f", {'o':o, 'd':d, 'f':f})
             st.rerun()
     st.dataframe(get_data("SELECT * FROM conversiones"), use_container_width=True)
+
+    factores, inconsistencias = get_cierre_conversiones()
+    if inconsistencias:
+        st.error("❌ Conversiones inconsistentes: distintas rutas dan factores diferentes.")
+        st.dataframe(pd.DataFrame(inconsistencias), use_container_width=True, hide_index=True)
+    with st.expander(f"🔗 Conversiones disponibles (directas, inversas y transitivas): {len(factores)}"):
+        st.dataframe(pd.DataFrame([{'unidad_origen': o, 'unidad_destino': d, 'factor': f} for (o, d), f in sorted(factores.items())]),
+                     use_container_width=True, hide_index=True)
 # --- TAB 7: REGISTRO DE PRODUCCIÓN (MÓDULO 3.1 COMPLETO) ---
-with tabs[6]:
+if seccion == "produccion":
     st.header("🚀 Panel de Producción Diaria")
     
     col_entrada, col_hist_prod = st.columns([1.2, 1])
     
     with col_entrada:
-        st.subheader("📥 Registro Masivo por Línea")
+        @fragmento
+        def registro_lote():
+            st.subheader("📥 Registro Masivo por Línea")
         
-        # 1. Configuración
-        c_f1, c_f2 = st.columns(2)
-        fecha_registro = c_f1.date_input("Fecha de Trabajo", value=pd.to_datetime("today"), key="fecha_prod")
+            # 1. Configuración
+            c_f1, c_f2 = st.columns(2)
+            st.session_state.setdefault("fecha_prod", pd.to_datetime("today").date())
+            fecha_registro = c_f1.date_input("Fecha de Trabajo", key="fecha_prod")
         
-        # Recuperamos líneas oficiales
-        lineas_db = get_data("SELECT nombre FROM lineas_produccion ORDER BY nombre")
-        linea_sel = c_f2.selectbox("Seleccione Línea para trabajar:", 
-                                   lineas_db['nombre'].tolist() if not lineas_db.empty else ["General"],
-                                   key="sel_linea_prod")
-
-        # 2. FILTRADO DINÁMICO: Solo productos de la línea seleccionada
-        prods_filtrados = get_data("SELECT codigo_barras, nombre FROM productos WHERE linea = :l ORDER BY nombre", {'l': linea_sel})
+            # Recuperamos líneas oficiales
+            lineas_db = get_data("SELECT nombre FROM lineas_produccion ORDER BY nombre")
+            ops_linea = lineas_db['nombre'].tolist() if not lineas_db.empty else ["General"]
+            validar_opcion("sel_linea_prod", ops_linea)
+            linea_sel = c_f2.selectbox("Seleccione Línea para trabajar:", ops_linea, key="sel_linea_prod")
+
+            # 2. FILTRADO DINÁMICO: Solo productos de la línea seleccionada
+            prods_filtrados = get_data("SELECT codigo_barras, nombre FROM productos WHERE linea = :l ORDER BY nombre", {'l': linea_sel})
         
-        if not prods_filtrados.empty:
-            st.info(f"📋 Productos encontrados para **{linea_sel}**: {len(prods_filtrados)}")
+            if 'prod_msg' in st.session_state: st.success(st.session_state.pop('prod_msg'))
+            # Llave de idempotencia del envío: cambia solo tras guardar con éxito (y con ella la hoja de trabajo),
+            # así un doble clic o un rerun repetido reusa la misma llave y no duplica la producción
+            envio = st.session_state.setdefault('prod_envio', uuid.uuid4().hex)
+            if not prods_filtrados.empty:
+                st.info(f"📋 Productos encontrados para **{linea_sel}**: {len(prods_filtrados)}")
             
-            # Preparamos tabla para ingreso masivo
-            df_hoja_trabajo = prods_filtrados.copy()
-            df_hoja_trabajo['unidades'] = 0 # Columna para llenar
+                # Preparamos tabla para ingreso masivo
+                df_hoja_trabajo = prods_filtrados.copy()
+                df_hoja_trabajo['unidades'] = 0 # Columna para llenar
             
-            # EL EDITOR MASIVO: Permite llenar varios productos a la vez
-            ed_carga = st.data_editor(
-                df_hoja_trabajo,
-                hide_index=True,
-                use_container_width=True,
-                disabled=["codigo_barras", "nombre"], # Solo se edita 'unidades'
-                column_config={
-                    "unidades": st.column_config.NumberColumn("Unidades Producidas", min_value=0, step=1)
-                },
-                key=f"editor_batch_{linea_sel}" # Key única para que refresque al cambiar línea
-            )
+                # EL EDITOR MASIVO: Permite llenar varios productos a la vez
+                ed_carga = st.data_editor(
+                    df_hoja_trabajo,
+                    hide_index=True,
+                    use_container_width=True,
+                    disabled=["codigo_barras", "nombre"], # Solo se edita 'unidades'
+                    column_config={
+                        "unidades": st.column_config.NumberColumn("Unidades Producidas", min_value=0, step=1)
+                    },
+                    key=f"editor_batch_{linea_sel}_{envio}" # Key única para que refresque al cambiar línea o tras guardar
+                )
             
-            if st.button("💾 Guardar Todo el Lote", type="primary"):
-                # Filtramos solo los productos donde se puso una cantidad > 0
-                datos_a_guardar = ed_carga[ed_carga['unidades'] > 0]
+                if st.button("💾 Guardar Todo el Lote", type="primary"):
+                    # Filtramos solo los productos donde se puso una cantidad > 0
+                    datos_a_guardar = ed_carga[ed_carga['unidades'] > 0]
                 
-                if not datos_a_guardar.empty:
-                    try:
-                        for _, r in datos_a_guardar.iterrows():
-                            run_query("""
-                                INSERT INTO registro_produccion (fecha, linea_nombre, producto_codigo, cantidad_producida)
-                                VALUES (:f, :l, :c, :q)
-                            """, {
-                                'f': fecha_registro, 'l': linea_sel, 
-                                'c': r['codigo_barras'], 'q': int(r['unidades'])
-                            })
-                        st.success(f"✅ Se registraron {len(datos_a_guardar)} productos con éxito.")
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Error al guardar: {e}")
-                else:
-                    st.warning("Ingrese cantidades en la tabla antes de guardar.")
-        else:
-            # Si la categoría no tiene productos, aparece en blanco/aviso
-            st.warning(f"No hay productos registrados en la línea '{linea_sel}'.")
+                    if not datos_a_guardar.empty:
+                        try:
+                            # Todo el lote en una transacción: o se registra completo o nada
+                            with transaccion() as conn:
+                                n = registrar_produccion(conn, fecha_registro, linea_sel, envio, datos_a_guardar)
+                            st.session_state['prod_envio'] = uuid.uuid4().hex
+                            st.session_state['prod_msg'] = (f"✅ Se registraron {n} productos con éxito." if n is not None else
+                                                            "ℹ️ Este lote ya estaba registrado; no se duplicó.")
+                            st.rerun()  # el historial (otro fragmento) debe mostrar el lote: rerun completo
+                        except Exception as e:
+                            st.error(f"Error al guardar (no se registró nada): {e}")
+                    else:
+                        st.warning("Ingrese cantidades en la tabla antes de guardar.")
+            else:
+                # Si la categoría no tiene productos, aparece en blanco/aviso
+                st.warning(f"No hay productos registrados en la línea '{linea_sel}'.")
+        registro_lote()
 
     with col_hist_prod:
-        st.subheader("📋 Historial y Gráfico")
+        @fragmento
+        def historial_produccion():
+            st.subheader("📋 Historial y Gráfico")
         
-        # Filtro para ver qué se hizo
-        f_ver = st.date_input("Ver producción del día:", value=fecha_registro, key="fecha_hist")
+            # Filtro para ver qué se hizo
+            f_ver = st.date_input("Ver producción del día:", value=st.session_state["fecha_prod"], key="fecha_hist")
         
-        # Query para el historial y para el gráfico
-        historial_dia = get_data("""
-            SELECT r.id, p.nombre as producto, r.cantidad_producida as cantidad, r.linea_nombre as linea
-            FROM registro_produccion r
-            JOIN productos p ON r.producto_codigo = p.codigo_barras
-            WHERE r.fecha = :f
-            ORDER BY r.id DESC
-        """, {'f': f_ver})
+            # Query para el historial y para el gráfico
+            historial_dia = get_data("""
+                SELECT r.id, p.nombre as producto, r.cantidad_producida as cantidad, r.linea_nombre as linea
+                FROM registro_produccion r
+                JOIN productos p ON r.producto_codigo = p.codigo_barras
+                WHERE r.fecha = :f
+                ORDER BY r.id DESC
+            """, {'f': f_ver})
         
-        if not historial_dia.empty:
-            # --- NUEVO: GRÁFICO DE BARRAS ---
-            st.write("**Producción por Línea (Hoy)**")
-            df_chart = historial_dia.groupby('linea')['cantidad'].sum().reset_index()
-            st.bar_chart(df_chart.set_index('linea'))
+            if not historial_dia.empty:
+                # --- NUEVO: GRÁFICO DE BARRAS ---
+                st.write("**Producción por Línea (Hoy)**")
+                df_chart = historial_dia.groupby('linea')['cantidad'].sum().reset_index()
+                st.bar_chart(df_chart.set_index('linea'))
             
-            # Tabla de historial
-            st.dataframe(historial_dia[['producto', 'cantidad', 'linea']], use_container_width=True, hide_index=True)
+                # Tabla de historial
+                st.dataframe(historial_dia[['producto', 'cantidad', 'linea']], use_container_width=True, hide_index=True)
             
-            # --- MÓDULO DE ELIMINACIÓN (CORREGIDO) ---
-            with st.expander("🗑️ Anular Registro del Día"):
-                opciones_anular = {f"{row['producto']} ({row['cantidad']} uds)": row['id'] 
-                                   for _, row in historial_dia.iterrows()}
+                # --- MÓDULO DE ELIMINACIÓN (CORREGIDO) ---
+                with st.expander("🗑️ Anular Registro del Día"):
+                    opciones_anular = {f"{row['producto']} ({row['cantidad']} uds)": row['id'] 
+                                       for _, row in historial_dia.iterrows()}
                 
-                registro_sel = st.selectbox("Seleccione para eliminar:", options=list(opciones_anular.keys()))
+                    registro_sel = st.selectbox("Seleccione para eliminar:", options=list(opciones_anular.keys()))
                 
-                if st.button("Confirmar Borrado", type="primary"):
-                    id_a_borrar = opciones_anular[registro_sel]
-                    run_query("DELETE FROM registro_produccion WHERE id = :id", {'id': id_a_borrar})
-                    st.success("Registro eliminado.")
-                    st.rerun()
+                    if st.button("Confirmar Borrado", type="primary"):
+                        id_a_borrar = opciones_anular[registro_sel]
+                        run_query("DELETE FROM registro_produccion WHERE id = :id", {'id': id_a_borrar})
+                        st.success("Registro eliminado.")
+                        rerun_fragmento()
+            else:
+                st.write("Sin producción en esta fecha.")
+
+            # --- HISTÓRICO MENSUAL (desde el resumen, sin recorrer registro_produccion) ---
+            with st.expander("📅 Producción mensual por línea (últimos 12 meses)"):
+                desde, _ = rango_mes(pd.Timestamp(f_ver) - pd.DateOffset(months=11))
+                hist_mes = get_data("""
+                    SELECT mes, linea_nombre AS linea, SUM(cantidad) AS cantidad
+                    FROM produccion_mensual WHERE mes >= :desde AND cantidad <> 0
+                    GROUP BY mes, linea_nombre ORDER BY mes
+                """, {'desde': desde})
+                if not hist_mes.empty:
+                    st.bar_chart(hist_mes.pivot_table(index='mes', columns='linea', values='cantidad', aggfunc='sum').fillna(0))
+                else:
+                    st.write("Sin producción en los últimos 12 meses.")
+        historial_produccion()
+# --- TAB 8: CATÁLOGO DE COSTOS (TODOS LOS PRODUCTOS EN UNA PASADA) ---
+if seccion == "catalogo":
+    st.header("📈 Costos y Márgenes del Catálogo")
+    try:
+        # Costo de materiales precalculado: solo se recalculan los productos afectados por cambios
+        # en materias primas, recetas o conversiones desde la última vez (ver migración 5)
+        # Escritura en el hilo principal, antes de las lecturas en paralelo, y solo si hay marcas:
+        # ver el catálogo no abre una transacción de escritura. Sin conexión se muestra el último
+        # costo guardado (réplica local) y se avisa que puede estar atrasado.
+        n_recalc, costos_atrasados = 0, False
+        try:
+            with _conectar() as conn:
+                hay_pendientes = conn.execute(text("SELECT EXISTS (SELECT 1 FROM costos_pendientes)")).scalar()
+            if hay_pendientes:
+                with transaccion(['costos_producto']) as conn:
+                    n_recalc = recalcular_costos_pendientes(conn)
+        except Exception as e:
+            if not (isinstance(e, SinConexion) or es_error_de_conexion(e)): raise
+            costos_atrasados = True
+        lect_c = leer_en_paralelo(
+            costos=lambda: get_data("""SELECT p.*, c.costo_materiales, c.sin_conversion, c.calculado_en
+                                       FROM productos p LEFT JOIN costos_producto c ON c.codigo_barras = p.codigo_barras
+                                       ORDER BY p.nombre"""),
+            config=get_config,
+            volumen_real=volumen_mes_actual,
+        )
+        prods_cat = lect_c['costos']
+        config = lect_c['config']
+        u_volumen, tipo_vol = volumen_referencia(lect_c['volumen_real'], config.unidades_promedio_mes)
+
+        df_cat = completar_catalogo(prods_cat, config.costo_minuto, config.cif_tot, config.gasto_op_tot, u_volumen)
+        st.caption(f"ℹ️ {len(df_cat)} productos ({n_recalc} recalculados ahora). "
+                   f"Volumen **{tipo_vol}**: {u_volumen:,.0f} unidades.")
+        if costos_atrasados:
+            st.caption("📴 Sin conexión: costo de materiales del último cálculo guardado; los cambios "
+                       "recientes en materias primas, recetas o conversiones se aplicarán al reconectar.")
+        n_sin_conv = int((df_cat['sin_conversion'] > 0).sum())
+        if n_sin_conv:
+            st.warning(f"⚠️ {n_sin_conv} productos tienen ingredientes sin conversión de unidad (columna 'Sin conv.').")
+
+        # Filtros y orden
+        c1, c2, c3, c4 = st.columns([2, 2, 1.5, 1.5])
+        txt_cat = c1.text_input("🔍 Buscar producto o código:", key="cat_buscar")
+        ops_lineas = sorted(df_cat['linea'].dropna().unique().tolist())
+        if "cat_lineas" in st.session_state:
+            st.session_state.cat_lineas = [l for l in st.session_state.cat_lineas if l in ops_lineas]
+        st.session_state.setdefault("cat_margen", 100.0)
+        st.session_state.setdefault("cat_asc", True)
+        lineas_sel = c2.multiselect("Líneas", ops_lineas, key="cat_lineas")
+        margen_max = c3.number_input("Margen máximo (%)", step=5.0, key="cat_margen")
+        solo_perdida = c4.checkbox("Solo con pérdida", key="cat_perdida")
+
+        vista = df_cat
+        if txt_cat:
+            vista = vista[vista['nombre'].str.contains(txt_cat, case=False, na=False) |
+                          vista['codigo_barras'].astype(str).str.contains(txt_cat, case=False, na=False)]
+        if lineas_sel: vista = vista[vista['linea'].isin(lineas_sel)]
+        vista = vista[vista['margen'] <= margen_max]
+        if solo_perdida: vista = vista[vista['utilidad'] < -0.01]
+
+        c5, c6 = st.columns([2, 1])
+        orden = c5.selectbox("Ordenar por:", ["margen", "utilidad", "costo_total", "costo_variable", "precio_venta_sugerido", "nombre"], key="cat_orden")
+        asc = c6.checkbox("Ascendente", key="cat_asc")
+        vista = vista.sort_values(orden, ascending=asc)
+
+        m1, m2, m3 = st.columns(3)
+        m1.metric("Productos mostrados", len(vista))
+        m2.metric("Con pérdida", int((vista['utilidad'] < -0.01).sum()))
+        m3.metric("Margen promedio", f"{vista['margen'].mean():.2f}%" if not vista.empty else "—")
+
+        qfmt = st.column_config.NumberColumn(format="Q%.2f")
+        st.dataframe(
+            vista[['codigo_barras', 'nombre', 'linea', 'costo_variable', 'mod', 'cif_unitario', 'gasto_operativo',
+                   'costo_total', 'precio_venta_sugerido', 'utilidad', 'margen', 'punto_equilibrio', 'sin_conversion']],
+            use_container_width=True, hide_index=True,
+            column_config={
+                "costo_variable": qfmt, "mod": qfmt, "cif_unitario": qfmt, "gasto_operativo": qfmt,
+                "costo_total": qfmt, "precio_venta_sugerido": qfmt, "utilidad": qfmt,
+                "margen": st.column_config.NumberColumn("Margen %", format="%.2f%%"),
+                "punto_equilibrio": st.column_config.NumberColumn("P. Equilibrio (uds)"),
+                "sin_conversion": st.column_config.NumberColumn("Sin conv.")
+            }
+        )
+        st.download_button("📥 Descargar CSV", vista.to_csv(index=False).encode('utf-8'), "catalogo_costos.csv", "text/csv")
+    except Exception as e: st.error(f"Error calculando catálogo: {e}")
+
+# --- TAB 9: SIMULACIÓN DE PRECIOS ("¿QUÉ PASA SI...?") ---
+if seccion == "simulacion":
+    st.header("🧪 Simulación de Precios de Materias Primas")
+    st.caption("Aplique alzas o bajas por materia prima o por categoría y compare varios escenarios a la vez. "
+               "No se modifica ningún precio en la base de datos.")
+    try:
+        lect_s = leer_en_paralelo(
+            lineas=costear_recetas,
+            prods=lambda: get_data(SQL_PRODUCTOS),
+            config=get_config,
+            volumen_real=volumen_mes_actual,
+        )
+        lineas_sim, prods_sim, config = lect_s['lineas'], lect_s['prods'], lect_s['config']
+        u_volumen, tipo_vol = volumen_referencia(lect_s['volumen_real'], config.unidades_promedio_mes)
+
+        # Solo se ofrecen las MP y categorías que aparecen en alguna receta
+        mps_sim = lineas_sim.drop_duplicates('mid').sort_values('nombre')
+        ops_objetivo = ([f"Categoría: {c}" for c in sorted(mps_sim['categoria'].dropna().unique())] +
+                        [f"MP #{i}: {n}" for i, n in zip(mps_sim['mid'], mps_sim['nombre'])])
+        st.write("**Choques por escenario** (una fila por choque; se aplican en orden dentro de cada escenario)")
+        choques = st.data_editor(
+            pd.DataFrame({'escenario': ["Escenario 1"], 'objetivo': [None], 'tipo': ["%"], 'valor': [0.0]}),
+            num_rows="dynamic", use_container_width=True, hide_index=True, key="sim_choques",
+            column_config={
+                "escenario": st.column_config.TextColumn("Escenario", required=True),
+                "objetivo": st.column_config.SelectboxColumn("Materia prima o categoría", options=ops_objetivo, required=True),
+                "tipo": st.column_config.SelectboxColumn("Tipo", options=["%", "Q"], required=True,
+                                                         help="% sobre el precio de compra, o monto fijo en Q por unidad de compra"),
+                "valor": st.column_config.NumberColumn("Valor", format="%.2f"),
+            })
+
+        escenarios = {}
+        for _, ch in choques.dropna(subset=['escenario', 'objetivo']).iterrows():
+            nombre = str(ch['escenario']).strip()
+            if not nombre or nombre == ESCENARIO_BASE: continue
+            m = re.match(r"MP #(\d+):", ch['objetivo'])
+            escenarios.setdefault(nombre, []).append({
+                'nivel': 'mp' if m else 'categoria',
+                'clave': int(m.group(1)) if m else ch['objetivo'].removeprefix("Categoría: "),
+                'tipo': 'pct' if ch['tipo'] == "%" else 'abs',
+                'valor': float(ch['valor'] or 0),
+            })
+        if (choques['escenario'].astype(str).str.strip() == ESCENARIO_BASE).any():
+            st.warning(f"⚠️ '{ESCENARIO_BASE}' está reservado para los precios actuales; esas filas se ignoran.")
+
+        if not escenarios:
+            st.info("Agregue al menos un choque con escenario y materia prima o categoría.")
         else:
-            st.write("Sin producción en esta fecha.")
+            st.session_state.setdefault("sim_umbral", 20.0)
+            umbral = st.number_input("Margen mínimo aceptable (%)", step=1.0, key="sim_umbral")
+            sim = simular_escenarios(prods_sim, lineas_sim, escenarios, config.costo_minuto,
+                                     config.cif_tot, config.gasto_op_tot, u_volumen)
+            sim['bajo_umbral'] = sim['margen'] < umbral
+            sim['cae_bajo_umbral'] = sim['bajo_umbral'] & (sim['margen_base'] >= umbral)
+
+            resumen = sim.groupby('escenario', sort=False).agg(
+                bajo_umbral=('bajo_umbral', 'sum'), nuevos=('cae_bajo_umbral', 'sum'),
+                afectados=('delta_costo', lambda d: int((d.abs() > 1e-9).sum())),
+                margen_promedio=('margen', 'mean'), delta_costo_promedio=('delta_costo', 'mean')).reset_index()
+            st.caption(f"ℹ️ {len(prods_sim)} productos × {len(resumen)} escenarios. Volumen **{tipo_vol}**: {u_volumen:,.0f} unidades.")
+            st.dataframe(resumen, use_container_width=True, hide_index=True, column_config={
+                "bajo_umbral": st.column_config.NumberColumn(f"Bajo {umbral:.0f}%"),
+                "nuevos": st.column_config.NumberColumn("Nuevos bajo umbral"),
+                "afectados": st.column_config.NumberColumn("Con costo distinto"),
+                "margen_promedio": st.column_config.NumberColumn("Margen prom. %", format="%.2f%%"),
+                "delta_costo_promedio": st.column_config.NumberColumn("Δ costo prom.", format="Q%.4f"),
+            })
+
+            ops_esc = list(escenarios)
+            validar_opcion("sim_escenario", ops_esc)
+            d1, d2 = st.columns([2, 1])
+            esc_sel = d1.selectbox("Detalle del escenario:", ops_esc, key="sim_escenario")
+            solo_nuevos = d2.checkbox("Solo los que caen bajo el umbral", key="sim_solo_nuevos")
+            detalle = sim[(sim['escenario'] == esc_sel) & (sim['cae_bajo_umbral'] if solo_nuevos else sim['delta_costo'].abs() > 1e-9)]
+            qfmt = st.column_config.NumberColumn(format="Q%.2f")
+            st.dataframe(
+                detalle.sort_values('margen')[['codigo_barras', 'nombre', 'linea', 'costo_total', 'delta_costo',
+                                               'precio_venta_sugerido', 'margen_base', 'margen']],
+                use_container_width=True, hide_index=True,
+                column_config={
+                    "costo_total": qfmt, "precio_venta_sugerido": qfmt,
+                    "delta_costo": st.column_config.NumberColumn("Δ costo", format="Q%.4f"),
+                    "margen_base": st.column_config.NumberColumn("Margen actual %", format="%.2f%%"),
+                    "margen": st.column_config.NumberColumn("Margen simulado %", format="%.2f%%"),
+                }
+            )
+            st.download_button("📥 Descargar simulación (CSV)", sim.to_csv(index=False).encode('utf-8'),
+                               "simulacion_precios.csv", "text/csv")
+    except Exception as e: st.error(f"Error en la simulación: {e}")
+
+# ==============================================================================
+# 🐞 PANEL DE DEPURACIÓN: CONSULTAS DE ESTE RERUN
+# ==============================================================================
+# Va al final para incluir todas las consultas del rerun
+if st.sidebar.checkbox("🐞 Depuración de consultas", key="debug_sql"):
+    res_traza = traza.resumen()
+    with st.sidebar.expander("🐞 Consultas del último rerun", expanded=True):
+        st.write(f"Viajes a la DB: **{res_traza['viajes']}** · Servidas por caché: {res_traza['lecturas_cache']} · "
+                 f"Por réplica local: {res_traza['lecturas_replica']}")
+        st.write(f"Tiempo en DB: **{res_traza['tiempo_db_ms']:,.1f} ms** de {res_traza['tiempo_rerun_ms']:,.1f} ms del rerun")
+        if res_traza['por_seccion']:
+            st.caption(" · ".join(f"{s}: {n}" for s, n in res_traza['por_seccion'].items()))
+        if res_traza['mas_lentas']:
+            st.write("**Más lentas**")
+            st.dataframe(pd.DataFrame(res_traza['mas_lentas'])[['ms', 'filas', 'seccion', 'sql']],
+                         hide_index=True, use_container_width=True,
+                         column_config={"ms": st.column_config.NumberColumn(format="%.1f")})
+        if res_traza['repetidas']:
+            st.write("**Repetidas (misma sentencia y parámetros)**")
+            st.dataframe(pd.DataFrame(res_traza['repetidas'])[['veces', 'secciones', 'sql']], hide_index=True, use_container_width=True)
+        st.download_button("📥 Exportar traza (Chrome Trace)", traza.exportar_chrome_trace().encode('utf-8'),
+                           f"traza_{seccion}_{pd.Timestamp.now():%Y%m%d_%H%M%S}.json", "application/json")
@@ -0,0 +1,141 @@
+"""Generador de un catálogo sintético de perfumería para benchmarks.
+
+Produce DataFrames con la forma de las tablas reales (materias_primas, conversiones,
+productos, recetas, costos_fijos, registro_produccion) a partir de una semilla, de modo
+que dos corridas con los mismos parámetros generan exactamente los mismos datos.
+"""
+from dataclasses import dataclass, asdict
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from migraciones import aplicar_migraciones
+from operaciones import copiar_dataframe
+
+@dataclass
+class Tamanos:
+    materias_primas: int = 10_000
+    productos: int = 5_000
+    ingredientes: int = 40
+    lineas: int = 20
+    costos_fijos: int = 200
+    dias_produccion: int = 730
+    productos_por_dia: int = 150
+    semilla: int = 42
+
+ESCALAS = {
+    'pequena': Tamanos(materias_primas=500, productos=200, ingredientes=15, costos_fijos=30,
+                       dias_produccion=60, productos_por_dia=30),
+    'mediana': Tamanos(materias_primas=3_000, productos=1_000, ingredientes=30, dias_produccion=365, productos_por_dia=80),
+    'grande': Tamanos(),
+}
+
+# (categoría, unidad de compra, unidad de uso en receta, rango de costo, rango de cantidad)
+CATEGORIAS = [
+    ('FRAGANCIA', 'Kg', 'g', (150, 1200), (2, 25)),
+    ('FORMULA', 'Kg', 'g', (40, 400), (1, 10)),
+    ('ALCOHOL', 'Gal', 'ml', (60, 140), (20, 90)),
+    ('ENVASE', 'Unidad', 'Unidad', (2, 25), (1, 1)),
+    ('TAPA', 'Unidad', 'Unidad', (0.5, 6), (1, 1)),
+    ('ETIQUETA', 'Unidad', 'Unidad', (0.1, 2), (1, 2)),
+    ('CAJA', 'Unidad', 'Unidad', (1, 8), (1, 1)),
+]
+
+CONVERSIONES = pd.DataFrame([
+    ('Gal', 'Oz', 128.0), ('Oz', 'ml', 29.5735), ('L', 'ml', 1000.0),
+    ('Gal', 'L', 3.78541), ('Kg', 'g', 1000.0), ('Lb', 'g', 453.592),
+], columns=['unidad_origen', 'unidad_destino', 'factor_multiplicador'])
+
+def generar_catalogo(t: Tamanos):
+    """Retorna un dict {tabla: DataFrame} listo para cargar."""
+    rng = np.random.default_rng(t.semilla)
+
+    # Materias primas
+    idx_cat = rng.integers(0, len(CATEGORIAS), t.materias_primas)
+    cat = [CATEGORIAS[i] for i in idx_cat]
+    mps = pd.DataFrame({
+        'id': np.arange(1, t.materias_primas + 1),
+        'codigo_interno': [f"MP{i:06d}" for i in range(1, t.materias_primas + 1)],
+        'nombre': [f"{c[0].title()} sintético {i:05d}" for i, c in enumerate(cat, 1)],
+        'categoria': [c[0] for c in cat],
+        'unidad_medida': [c[1] for c in cat],
+        'costo_unitario': np.round([rng.uniform(*c[3]) for c in cat], 4),
+        'tiene_iva': rng.random(t.materias_primas) < 0.7,
+    })
+
+    # Productos y líneas
+    lineas = [f"Línea {i:02d}" for i in range(1, t.lineas + 1)]
+    es_lote = rng.random(t.productos) < 0.2
+    prods = pd.DataFrame({
+        'codigo_barras': [f"750{i:09d}" for i in range(1, t.productos + 1)],
+        'nombre': [f"Perfume sintético {i:05d}" for i in range(1, t.productos + 1)],
+        'linea': rng.choice(lineas, t.productos),
+        'tipo_produccion': np.where(es_lote, 'Lote', 'Unidad'),
+        'unidades_por_lote': np.where(es_lote, rng.integers(10, 200, t.productos), 1),
+        'minutos_por_unidad': np.round(rng.uniform(1, 12, t.productos), 2),
+        'precio_venta_sugerido': np.round(rng.uniform(40, 450, t.productos), 2),
+    })
+
+    # Recetas: `ingredientes` MPs distintas por producto
+    n_ing = min(t.ingredientes, t.materias_primas)
+    mp_ids = np.concatenate([rng.choice(mps['id'].values, n_ing, replace=False) for _ in range(t.productos)])
+    fila_mp = mps.set_index('id').loc[mp_ids]
+    rango_cant = {c[0]: c[4] for c in CATEGORIAS}
+    uso = {c[0]: c[2] for c in CATEGORIAS}
+    recetas = pd.DataFrame({
+        'producto_id': np.repeat(prods['codigo_barras'].values, n_ing),
+        'mp_id': mp_ids,
+        'cantidad': np.round([rng.uniform(*rango_cant[c]) for c in fila_mp['categoria']], 4),
+        'unidad_uso': [uso[c] for c in fila_mp['categoria']],
+    })
+
+    # Costos fijos (los % suman 100)
+    p = rng.dirichlet([1, 1, 1], t.costos_fijos) * 100
+    p = np.round(p, 2)
+    p[:, 2] = np.round(100 - p[:, 0] - p[:, 1], 2)
+    costos_fijos = pd.DataFrame({
+        'concepto': [f"Gasto sintético {i:04d}" for i in range(1, t.costos_fijos + 1)],
+        'total_mensual': np.round(rng.uniform(100, 20_000, t.costos_fijos), 2),
+        'p_admin': p[:, 0], 'p_ventas': p[:, 1], 'p_prod': p[:, 2],
+    })
+
+    # Producción diaria de los últimos `dias_produccion` días
+    fechas = pd.date_range(end=pd.Timestamp.today().normalize(), periods=t.dias_produccion, freq='D')
+    por_dia = min(t.productos_por_dia, t.productos)
+    elegidos = np.concatenate([rng.choice(t.productos, por_dia, replace=False) for _ in fechas])
+    produccion = pd.DataFrame({
+        'fecha': np.repeat(fechas.date, por_dia),
+        'linea_nombre': prods['linea'].values[elegidos],
+        'producto_codigo': prods['codigo_barras'].values[elegidos],
+        'cantidad_producida': rng.integers(10, 500, len(elegidos)),
+    })
+
+    return {
+        'materias_primas': mps, 'conversiones': CONVERSIONES.copy(),
+        'lineas_produccion': pd.DataFrame({'nombre': lineas}), 'productos': prods,
+        'recetas': recetas, 'costos_fijos': costos_fijos, 'registro_produccion': produccion,
+    }
+
+def cargar_en_db(engine, datos):
+    """Aplica migraciones, vacía las tablas del catálogo y carga `datos` con COPY."""
+    aplicar_migraciones(engine, log=lambda _: None)
+    tablas = ['registro_produccion', 'recetas', 'productos', 'lineas_produccion',
+              'materias_primas', 'conversiones', 'costos_fijos']
+    with engine.begin() as conn:
+        # produccion_mensual no la vacía el trigger (TRUNCATE no dispara los triggers de DELETE)
+        conn.execute(text(f"TRUNCATE {', '.join(tablas)}, produccion_mensual, costos_producto, costos_pendientes, "
+                          "envios_produccion RESTART IDENTITY"))
+        for tabla in reversed(tablas):
+            df = datos[tabla]
+            copiar_dataframe(conn, df, tabla, list(df.columns))
+        # El COPY de recetas ya marcó sus productos; los que no tienen receta también quedan pendientes
+        conn.execute(text("INSERT INTO costos_pendientes (codigo_barras) SELECT codigo_barras FROM productos "
+                          "ON CONFLICT DO NOTHING"))
+        conn.execute(text("SELECT setval(pg_get_serial_sequence('materias_primas', 'id'), (SELECT MAX(id) FROM materias_primas))"))
+    # Estadísticas frescas para que los planes sean los de una base real
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE"))
+
+def describir(t: Tamanos):
+    return asdict(t)
@@ -0,0 +1,85 @@
+"""Latencia de la invalidación entre procesos (LISTEN/NOTIFY, migración 8).
+
+Levanta N procesos que escuchan `cambios_tablas` como lo hace cada contenedor de la app
+(notificaciones.EscuchaCambios) y, desde este proceso, hace escrituras que disparan el
+trigger sin modificar datos. Mide cuánto tarda cada proceso en recibir la invalidación
+y cuántas se perdieron. Contra el Postgres local de los benchmarks:
+
+    python -m benchmarks.invalidacion --procesos 2 --escrituras 50
+"""
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from conexion import crear_engine
+from migraciones import aplicar_migraciones
+from notificaciones import EscuchaCambios
+from benchmarks.correr import URL_POR_DEFECTO
+
+# UPDATE sin filas: el trigger por sentencia se dispara igual y los datos no cambian
+SQL_TOQUE = "UPDATE materias_primas SET nombre = nombre WHERE false"
+
+def _escuchar(url, nombre, avisos, parar):
+    escucha = EscuchaCambios(url, lambda tablas: avisos.put((nombre, sorted(tablas), time.time())), sondeo=3600)
+    escucha.iniciar()
+    while not escucha.conectada and not parar.is_set(): time.sleep(0.05)
+    avisos.put((nombre, None, time.time()))  # listo
+    parar.wait()
+    escucha.detener()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latencia de invalidación de caché entre procesos.")
+    parser.add_argument("--url", default=os.environ.get("ERP_BENCH_DB_URL", URL_POR_DEFECTO))
+    parser.add_argument("--procesos", type=int, default=2)
+    parser.add_argument("--escrituras", type=int, default=50)
+    parser.add_argument("--espera", type=float, default=5.0, help="Segundos máximos por aviso")
+    args = parser.parse_args(argv)
+
+    engine = crear_engine(args.url, pool='queue', pool_pre_ping=False)
+    aplicar_migraciones(engine, log=lambda _: None)
+
+    ctx = mp.get_context("spawn")
+    avisos, parar = ctx.Queue(), ctx.Event()
+    procesos = [ctx.Process(target=_escuchar, args=(args.url, f"p{i}", avisos, parar), daemon=True)
+                for i in range(args.procesos)]
+    for p in procesos: p.start()
+    listos = 0
+    while listos < args.procesos:
+        _, tablas, _ = avisos.get(timeout=30)
+        listos += tablas is None
+
+    latencias, perdidas = [], 0
+    for _ in range(args.escrituras):
+        t0 = time.time()
+        with engine.begin() as conn:
+            conn.execute(text(SQL_TOQUE))
+        recibidos = set()
+        while len(recibidos) < args.procesos:
+            try:
+                nombre, tablas, t1 = avisos.get(timeout=max(0.0, t0 + args.espera - time.time()))
+            except queue.Empty:
+                break
+            if tablas and 'materias_primas' in tablas and nombre not in recibidos:
+                recibidos.add(nombre)
+                latencias.append((t1 - t0) * 1000)
+        perdidas += args.procesos - len(recibidos)
+
+    parar.set()
+    for p in procesos: p.join(10)
+
+    esperados = args.escrituras * args.procesos
+    print(f"Procesos: {args.procesos} · escrituras: {args.escrituras} · avisos recibidos: {len(latencias)}/{esperados}")
+    if latencias:
+        lat = np.array(latencias)
+        print(f"Latencia escritura → invalidación: p50 {np.percentile(lat, 50):.1f} ms · "
+              f"p95 {np.percentile(lat, 95):.1f} ms · máx {lat.max():.1f} ms")
+    return 1 if perdidas else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
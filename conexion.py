@@ -0,0 +1,146 @@
+import os
+import time
+import threading
+import urllib.parse
+from collections import deque
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import QueuePool, NullPool
+
+# ==============================================================================
+# 🔐 CONEXIÓN A BASE DE DATOS (VIA TRANSACTION POOLER - PUERTO 6543)
+# ==============================================================================
+# Módulo sin Streamlit: lo usan tanto app.py como los scripts (migraciones, etc.)
+
+# 1. CREDENCIALES EXACTAS PARA EL POOLER
+# Nota: Si el host 'aws-0' no funciona, cámbialo a 'aws-1' según lo que diga Supabase
+DB_HOST = "aws-1-us-east-1.pooler.supabase.com" 
+DB_NAME = "postgres"
+DB_USER = "postgres.nzlysybivtiumentgpvi" # <--- Usuario especial del pooler
+DB_PORT = "6543" 
+DB_PASS = ".pJUb+(3pnYqBH1yhM" # <--- ¡La que creaste recientemente!
+
+# 2. CONSTRUCCIÓN DE URL SEGURA
+encoded_password = urllib.parse.quote_plus(DB_PASS)
+# Importante: Usamos postgresql+psycopg2 y sslmode require
+# ERP_DB_URL la reemplaza (p. ej. un Postgres local para probar varios procesos de la app)
+DB_URL = os.environ.get("ERP_DB_URL") or \
+    f"postgresql+psycopg2://{DB_USER}:{encoded_password}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=require"
+# LISTEN/NOTIFY (notificaciones.py) necesita una conexión de sesión: el session pooler de
+# Supabase atiende en el puerto 5432 del mismo host. Con ERP_DB_URL se usa esa misma URL.
+DB_URL_SESION = os.environ.get("ERP_DB_URL_SESION") or \
+    (DB_URL if os.environ.get("ERP_DB_URL") else DB_URL.replace(f":{DB_PORT}/", ":5432/"))
+
+# 3. POOL LOCAL (configurable por variables de entorno)
+# El transaction pooler de Supabase ya multiplexa conexiones al servidor, así que el pool
+# local solo evita repetir el handshake TLS. Valores por defecto pensados para ese modo:
+#   ERP_DB_POOL          "queue" (reutiliza conexiones) o "null" (una conexión por uso)
+#   ERP_DB_POOL_SIZE     conexiones que se mantienen abiertas (5)
+#   ERP_DB_MAX_OVERFLOW  conexiones extra en picos (10)
+#   ERP_DB_POOL_TIMEOUT  segundos de espera máxima por una conexión libre (10)
+#   ERP_DB_POOL_RECYCLE  segundos antes de renovar una conexión; menor que el idle del pooler (240)
+#   ERP_DB_PRE_PING      "1" valida la conexión antes de cada uso (un viaje extra); con "0" se
+#                        confía en el recycle y se ahorra ese viaje por consulta
+#   ERP_DB_CONNECT_TIMEOUT  segundos máximos para abrir una conexión (5); acota cuánto tarda
+#                        en detectarse que la DB no responde
+def config_pool():
+    return {
+        'pool': os.environ.get("ERP_DB_POOL", "queue").lower(),
+        'pool_size': int(os.environ.get("ERP_DB_POOL_SIZE", 5)),
+        'max_overflow': int(os.environ.get("ERP_DB_MAX_OVERFLOW", 10)),
+        'pool_timeout': float(os.environ.get("ERP_DB_POOL_TIMEOUT", 10)),
+        'pool_recycle': int(os.environ.get("ERP_DB_POOL_RECYCLE", 240)),
+        'pool_pre_ping': os.environ.get("ERP_DB_PRE_PING", "1") == "1",
+        'connect_timeout': int(os.environ.get("ERP_DB_CONNECT_TIMEOUT", 5)),
+    }
+
+def es_error_de_conexion(e):
+    """True si el error es de red/pooler (la DB no responde), no de la consulta en sí."""
+    if "Circuit breaker open" in str(e): return True
+    if isinstance(e, (exc.OperationalError, exc.TimeoutError)): return True
+    return isinstance(e, exc.DBAPIError) and e.connection_invalidated
+
+class MetricasPool:
+    """Contadores del pool: esperas al pedir conexión, conexiones nuevas, reconexiones y timeouts."""
+    def __init__(self, max_muestras=1000):
+        self.lock = threading.Lock()
+        self.esperas = deque(maxlen=max_muestras)
+        self.checkouts = 0
+        self.conexiones_nuevas = 0
+        self.reconexiones = 0
+        self.timeouts = 0
+        self.en_uso_max = 0
+        self.en_uso_actual = 0  # por eventos checkout/checkin: vale también sin pool local (NullPool)
+
+    def registrar_espera(self, seg, en_uso):
+        with self.lock:
+            self.checkouts += 1
+            self.esperas.append(seg)
+            self.en_uso_max = max(self.en_uso_max, en_uso)
+
+    def resumen(self, pool):
+        """Con un pool sin tamaño (NullPool: una conexión por uso) capacidad y saturación son None."""
+        with self.lock:
+            esperas = sorted(self.esperas)
+            con_tamano = hasattr(pool, 'size')
+            capacidad = pool.size() + max(getattr(pool, '_max_overflow', 0), 0) if con_tamano else None
+            en_uso = pool.checkedout() if hasattr(pool, 'checkedout') else self.en_uso_actual
+            return {
+                'en_uso': en_uso,
+                'capacidad': capacidad,
+                'saturacion': (en_uso / capacidad) if capacidad else None,
+                'en_uso_max': self.en_uso_max,
+                'checkouts': self.checkouts,
+                'espera_prom_ms': (sum(esperas) / len(esperas) * 1000) if esperas else 0.0,
+                'espera_p95_ms': (esperas[int(len(esperas) * 0.95)] * 1000) if esperas else 0.0,
+                'espera_max_ms': (esperas[-1] * 1000) if esperas else 0.0,
+                'conexiones_nuevas': self.conexiones_nuevas,
+                'reconexiones': self.reconexiones,
+                'timeouts': self.timeouts,
+            }
+
+def _pool_medido(base, metricas):
+    """Subclase del pool que mide cuánto se espera por cada conexión (incluye abrir una nueva)."""
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return base._do_get(self)
+        except Exception as e:
+            if isinstance(e, exc.TimeoutError):
+                with metricas.lock: metricas.timeouts += 1
+            raise
+        finally:
+            metricas.registrar_espera(time.perf_counter() - t0, getattr(self, 'checkedout', lambda: metricas.en_uso_actual + 1)())
+    return type(f"{base.__name__}Medido", (base,), {'_do_get': _do_get})
+
+def crear_engine(url=DB_URL, **overrides):
+    cfg = {**config_pool(), **overrides}
+    metricas = MetricasPool()
+    connect_args = {'connect_timeout': cfg['connect_timeout']}
+    if cfg['pool'] == 'null':
+        engine = create_engine(url, poolclass=_pool_medido(NullPool, metricas), pool_pre_ping=cfg['pool_pre_ping'],
+                               connect_args=connect_args)
+    else:
+        engine = create_engine(url, poolclass=_pool_medido(QueuePool, metricas), connect_args=connect_args,
+                               pool_size=cfg['pool_size'], max_overflow=cfg['max_overflow'],
+                               pool_timeout=cfg['pool_timeout'], pool_recycle=cfg['pool_recycle'],
+                               pool_pre_ping=cfg['pool_pre_ping'])
+
+    @event.listens_for(engine.pool, "connect")
+    def _al_conectar(dbapi_conn, record):
+        with metricas.lock: metricas.conexiones_nuevas += 1
+
+    @event.listens_for(engine.pool, "checkout")
+    def _al_prestar(dbapi_conn, record, proxy):
+        with metricas.lock: metricas.en_uso_actual += 1
+
+    @event.listens_for(engine.pool, "checkin")
+    def _al_devolver(dbapi_conn, record):
+        with metricas.lock: metricas.en_uso_actual = max(0, metricas.en_uso_actual - 1)
+
+    @event.listens_for(engine.pool, "invalidate")
+    def _al_invalidar(dbapi_conn, record, exc):
+        with metricas.lock: metricas.reconexiones += 1
+
+    engine.metricas_pool = metricas
+    engine.config_pool = cfg
+    return engine
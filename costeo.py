@@ -0,0 +1,315 @@
+"""Núcleo de costeo: funciones puras (sin Streamlit ni conexión propia).
+
+Las usan app.py (Ficha Técnica, Catálogo, Costo Rápido) y recalcular_costos.py (lotes
+nocturnos). Las que leen datos reciben un `leer(sql, params) -> DataFrame`, de modo que
+cada llamador decide cómo consultar (con caché en la app, directo en el CLI).
+"""
+from collections import defaultdict
+from dataclasses import dataclass
+
+import pandas as pd
+
+TASA_IVA = 1.12
+
+# ==============================================================================
+# CONSULTAS
+# ==============================================================================
+# Receta + precio/IVA de la MP en un solo viaje (el factor sale del cierre de conversiones)
+SQL_RECETAS_COSTEO = """
+    SELECT r.id, r.producto_id, m.id AS mid, m.nombre, m.categoria, r.cantidad, r.unidad_uso,
+           m.costo_unitario, m.unidad_medida, m.tiene_iva
+    FROM recetas r
+    JOIN materias_primas m ON r.mp_id = m.id
+"""
+SQL_CONVERSIONES = "SELECT unidad_origen, unidad_destino, factor_multiplicador FROM conversiones"
+SQL_PRODUCTOS = "SELECT * FROM productos ORDER BY nombre"
+SQL_VOLUMEN_MES = "SELECT SUM(cantidad) FROM produccion_mensual WHERE mes = :m"
+# Toda la configuración (nóminas, unidades promedio y totales de costos fijos) en un viaje.
+# LEFT JOIN desde una fila fija: si falta una fila de config, sus columnas vienen en NULL.
+SQL_CONFIG = """
+    SELECT a.salario_base AS adm_salario_base, a.p_prestaciones AS adm_p_prestaciones, a.num_empleados AS adm_num_empleados,
+           v.salario_base AS ven_salario_base, v.p_prestaciones AS ven_p_prestaciones, v.num_empleados AS ven_num_empleados,
+           m.salario_base AS mod_salario_base, m.p_prestaciones AS mod_p_prestaciones, m.num_operarios AS mod_num_operarios,
+           m.horas_mes AS mod_horas_mes, g.unidades_promedio_mes, cf.*
+    FROM (SELECT 1) AS uno
+    LEFT JOIN config_admin a ON a.id = 1
+    LEFT JOIN config_ventas v ON v.id = 1
+    LEFT JOIN config_mod m ON m.id = 1
+    LEFT JOIN config_global g ON g.id = 1
+    CROSS JOIN (SELECT COALESCE(SUM(total_mensual), 0) AS cf_total,
+                       COALESCE(SUM(total_mensual * (p_admin/100)), 0) AS cf_admin,
+                       COALESCE(SUM(total_mensual * (p_ventas/100)), 0) AS cf_ventas,
+                       COALESCE(SUM(total_mensual * (p_prod/100)), 0) AS cf_prod
+                FROM costos_fijos) AS cf
+"""
+
+# ==============================================================================
+# IVA Y CONVERSIONES
+# ==============================================================================
+def calcular_sin_iva(monto, tiene_iva):
+    return monto / TASA_IVA if (tiene_iva and monto > 0) else monto
+
+# Cada fila de `conversiones` es una arista origen -> destino (1 origen = factor destino).
+# Se agregan las inversas (1/factor) y se precalcula el cierre transitivo: Gal->Oz + Oz->ml = Gal->ml.
+TOLERANCIA_CONVERSION = 1e-6
+
+def cierre_conversiones(df_conv):
+    """Retorna ({(origen, destino): factor} para todos los pares conectados, [inconsistencias])."""
+    ady = defaultdict(dict)
+    for o, d, f in df_conv[['unidad_origen', 'unidad_destino', 'factor_multiplicador']].itertuples(index=False):
+        if pd.isna(o) or pd.isna(d) or o == d or pd.isna(f) or float(f) <= 0: continue
+        ady[o][d] = (float(f), True)
+        if not ady[d].get(o, (None, False))[1]:  # la inversa explícita tiene prioridad
+            ady[d][o] = (1 / float(f), False)
+
+    factores, inconsistencias = {}, {}
+    # Dos aristas explícitas opuestas deben ser inversas entre sí (el BFS no lo detecta: la
+    # discrepancia aparece al volver al origen)
+    for o in list(ady):
+        for d, (f, explicita) in ady[o].items():
+            g, explicita_inv = ady[d].get(o, (None, False))
+            if explicita and explicita_inv and o < d and abs(f * g - 1) > TOLERANCIA_CONVERSION:
+                inconsistencias[(o, d)] = {'origen': o, 'destino': d, 'factor': f, 'factor_otra_ruta': 1 / g}
+
+    for origen in list(ady):
+        # BFS: la ruta más corta define el factor; otras rutas deben coincidir
+        alcanzados = {origen: 1.0}
+        cola = [origen]
+        while cola:
+            u = cola.pop(0)
+            for v, (f, _) in ady[u].items():
+                f_ruta = alcanzados[u] * f
+                if v not in alcanzados:
+                    alcanzados[v] = f_ruta
+                    cola.append(v)
+                elif abs(alcanzados[v] - f_ruta) > TOLERANCIA_CONVERSION * max(abs(alcanzados[v]), 1.0):
+                    if origen < v:  # cada par se reporta una vez
+                        inconsistencias.setdefault((origen, v), {'origen': origen, 'destino': v,
+                                                                 'factor': alcanzados[v], 'factor_otra_ruta': f_ruta})
+        for v, f in alcanzados.items():
+            if v != origen: factores[(origen, v)] = f
+    return factores, list(inconsistencias.values())
+
+def calcular_costo_lineas(df, factores):
+    """Calcula (vectorizado) el costo neto convertido y el costo de cada línea de receta.
+
+    Si tiene IVA se divide entre 1.12 y, si la unidad de uso es distinta a la de compra,
+    se divide entre el factor de conversión. Las líneas sin ruta de conversión quedan
+    marcadas en `sin_conversion` (y se costean en la unidad de compra) para reportarlas.
+    """
+    df = df.copy()
+    costo = df['costo_unitario'].astype(float)
+    costo = costo.where(~df['tiene_iva'].fillna(False).astype(bool), costo / TASA_IVA)
+
+    requiere = df['unidad_uso'].notna() & (df['unidad_uso'] != df['unidad_medida'])
+    factor = pd.Series([factores.get(par) for par in zip(df['unidad_medida'], df['unidad_uso'])],
+                       index=df.index, dtype=float)
+    df['factor_multiplicador'] = factor.where(requiere)
+    df['sin_conversion'] = requiere & factor.isna()
+    convertir = requiere & factor.notna()
+    df['costo_convertido'] = costo.where(~convertir, costo / factor)
+    df['costo_linea'] = df['cantidad'].astype(float) * df['costo_convertido']
+    return df
+
+# ==============================================================================
+# MOD, VOLUMEN Y FICHA
+# ==============================================================================
+def costo_por_minuto(mod_cfg):
+    """Costo de mano de obra directa por minuto disponible según config_mod."""
+    t_mod_mensual = float(mod_cfg['salario_base'] * mod_cfg['num_operarios'] * (1 + mod_cfg['p_prestaciones']/100))
+    minutos_disponibles = float(mod_cfg['horas_mes'] * mod_cfg['num_operarios'] * 60)
+    return t_mod_mensual / minutos_disponibles if minutos_disponibles > 0 else 0
+
+def _nomina_mensual(cfg, col_personas):
+    """Salarios + prestaciones de un área; 0 si la fila de config no existe."""
+    if cfg['salario_base'] is None: return 0.0
+    return float(cfg['salario_base'] * cfg[col_personas] * (1 + cfg['p_prestaciones']/100))
+
+@dataclass(frozen=True)
+class Configuracion:
+    """Foto de config_admin/ventas/mod/global y de los totales de costos_fijos, con los derivados ya calculados.
+
+    Se arma con una sola fila de `SQL_CONFIG` (ver `desde_fila`). `admin`, `ventas` y `mod`
+    son dicts con las columnas de su tabla (None si falta la fila).
+    """
+    admin: dict
+    ventas: dict
+    mod: dict
+    unidades_promedio_mes: float
+    costos_fijos: dict  # total y reparto por área: total, admin, ventas, prod
+    costo_minuto: float
+    nomina: dict        # salarios + prestaciones por área: admin, ventas, mod
+
+    @property
+    def cif_tot(self):
+        return self.costos_fijos['prod']
+
+    @property
+    def gasto_op_tot(self):
+        return self.costos_fijos['admin'] + self.costos_fijos['ventas']
+
+    @property
+    def completa(self):
+        return all(c['salario_base'] is not None for c in (self.admin, self.ventas, self.mod))
+
+    @classmethod
+    def desde_fila(cls, fila):
+        fila = {k: (None if pd.isna(v) else v) for k, v in dict(fila).items()}
+        seccion = lambda p: {k[len(p):]: v for k, v in fila.items() if k.startswith(p)}
+        admin, ventas, mod = seccion('adm_'), seccion('ven_'), seccion('mod_')
+        return cls(
+            admin=admin, ventas=ventas, mod=mod,
+            unidades_promedio_mes=float(fila['unidades_promedio_mes'] or 0),
+            costos_fijos={k: float(v) for k, v in seccion('cf_').items()},
+            costo_minuto=costo_por_minuto(mod) if mod['salario_base'] is not None else 0,
+            nomina={'admin': _nomina_mensual(admin, 'num_empleados'), 'ventas': _nomina_mensual(ventas, 'num_empleados'),
+                    'mod': _nomina_mensual(mod, 'num_operarios')},
+        )
+
+def rango_mes(fecha):
+    """(primer día del mes, primer día del mes siguiente) para filtrar con fecha >= :ini AND fecha < :fin."""
+    ini = pd.Timestamp(fecha).to_period('M').to_timestamp()
+    return ini.date(), (ini + pd.offsets.MonthBegin(1)).date()
+
+def volumen_referencia(real, manual):
+    """La producción real del mes si la hay; si no, el promedio manual de config_global."""
+    if real and real > 0:
+        return float(real), "Real (Mes Actual)"
+    return float(manual), "Teórico (Promedio)"
+
+def calcular_catalogo(prods, lineas, costo_minuto, cif_tot, gasto_op_tot, u_volumen):
+    """Aplica las fórmulas de la Ficha Técnica a todos los productos a la vez.
+
+    El costo de materiales es el producto (disperso) receta × precio: la suma por
+    producto de las líneas ya costeadas. El resto son operaciones columna a columna.
+    """
+    df = prods.copy()
+    materiales = materiales_por_producto(lineas)
+    df['costo_materiales'] = df['codigo_barras'].map(materiales['costo_materiales'])
+    df['sin_conversion'] = df['codigo_barras'].map(materiales['sin_conversion'])
+    return completar_catalogo(df, costo_minuto, cif_tot, gasto_op_tot, u_volumen)
+
+def materiales_por_producto(lineas):
+    """Costo de materiales y nº de líneas sin conversión por producto (índice: producto_id)."""
+    return lineas.groupby('producto_id').agg(costo_materiales=('costo_linea', 'sum'),
+                                             sin_conversion=('sin_conversion', 'sum'))
+
+def completar_catalogo(prods, costo_minuto, cif_tot, gasto_op_tot, u_volumen):
+    """Fórmulas de la ficha a partir del costo de materiales ya calculado (columna `costo_materiales`).
+
+    Lo que depende de config_mod, costos_fijos y el volumen del mes se calcula aquí, al leer,
+    porque es barato y cambia con cada registro de producción.
+    """
+    df = prods[['codigo_barras', 'nombre', 'linea', 'tipo_produccion', 'unidades_por_lote',
+                'minutos_por_unidad', 'precio_venta_sugerido', 'costo_materiales', 'sin_conversion']].copy()
+    df['costo_materiales'] = df['costo_materiales'].astype(float).fillna(0.0)
+    df['sin_conversion'] = df['sin_conversion'].fillna(0).astype(int)
+
+    u_div = df['unidades_por_lote'].astype(float).where(df['tipo_produccion'] == 'Lote', 1.0)
+    df['costo_variable'] = df['costo_materiales'] / u_div
+    df['mod'] = df['minutos_por_unidad'].astype(float).fillna(5.0) * costo_minuto
+    df['cif_unitario'] = float(cif_tot) / u_volumen
+    df['gasto_operativo'] = float(gasto_op_tot) / u_volumen
+    df['costo_total'] = df['costo_variable'] + df['mod'] + df['cif_unitario']
+    df['costo_y_gasto'] = df['costo_total'] + df['gasto_operativo']
+
+    precio = df['precio_venta_sugerido'].astype(float).fillna(0.0)
+    df['utilidad'] = precio - df['costo_y_gasto']
+    df['margen'] = (df['utilidad'] / precio * 100).where(precio > 0, 0.0)
+    contribucion = precio - df['costo_variable']
+    df['punto_equilibrio'] = (df['costo_y_gasto'] / contribucion * u_volumen).where(contribucion > 0, 0).fillna(0).astype(int)
+    return df
+
+def calcular_ficha(producto, lineas, costo_minuto, cif_tot, gasto_op_tot, u_volumen):
+    """Ficha Técnica de un producto (dict/Series de `productos`): mismas fórmulas que el catálogo."""
+    return calcular_catalogo(pd.DataFrame([dict(producto)]), lineas, costo_minuto,
+                             cif_tot, gasto_op_tot, u_volumen).iloc[0].to_dict()
+
+# ==============================================================================
+# SIMULACIÓN DE PRECIOS ("¿qué pasa si...?")
+# ==============================================================================
+# El costo de materiales es lineal en el precio de compra: costo_linea = coef × costo_unitario,
+# con coef = cantidad / IVA / factor. El catálogo bajo k escenarios es entonces la matriz
+# (dispersa) de coeficientes producto × MP por la matriz de precios MP × k. Nada se escribe.
+ESCENARIO_BASE = "Base"
+
+def coeficientes_lineas(lineas):
+    """Cuánto aporta al costo de materiales cada Q del precio de compra, por línea costeada."""
+    iva = pd.Series(TASA_IVA, index=lineas.index).where(lineas['tiene_iva'].fillna(False).astype(bool), 1.0)
+    factor = lineas['factor_multiplicador'].where(~lineas['sin_conversion']).fillna(1.0)
+    return lineas['cantidad'].astype(float) / iva / factor
+
+def precios_escenarios(lineas, escenarios):
+    """Precios de compra por MP (índice: id) con una columna por escenario, tras aplicar los choques.
+
+    `escenarios` es {nombre: [choque, ...]}; cada choque es un dict con `nivel` ('mp' o
+    'categoria'), `clave` (id de la MP o nombre de la categoría), `tipo` ('pct' o 'abs') y
+    `valor`. Los choques de un escenario se aplican en orden y ningún precio baja de 0.
+    """
+    mps = lineas.drop_duplicates('mid').set_index('mid')
+    base = mps['costo_unitario'].astype(float).fillna(0.0)
+    precios = {}
+    for nombre, choques in escenarios.items():
+        p = base.copy()
+        for c in choques:
+            if c['nivel'] == 'mp': sel = p.index == int(c['clave'])
+            elif c['nivel'] == 'categoria': sel = (mps['categoria'] == c['clave']).to_numpy()
+            else: raise ValueError(f"Nivel de choque desconocido: {c['nivel']}")
+            if c['tipo'] == 'pct': p[sel] = p[sel] * (1 + float(c['valor']) / 100)
+            elif c['tipo'] == 'abs': p[sel] = p[sel] + float(c['valor'])
+            else: raise ValueError(f"Tipo de choque desconocido: {c['tipo']}")
+        precios[nombre] = p.clip(lower=0)
+    return pd.DataFrame(precios, index=base.index)
+
+def simular_escenarios(prods, lineas, escenarios, costo_minuto, cif_tot, gasto_op_tot, u_volumen):
+    """Costo y margen de todo el catálogo bajo cada escenario y bajo los precios actuales (`ESCENARIO_BASE`).
+
+    Retorna una fila por escenario y producto con las columnas del catálogo más
+    `margen_base` y `delta_costo` (costo_total del escenario − costo_total base).
+    """
+    if ESCENARIO_BASE in escenarios:
+        raise ValueError(f"'{ESCENARIO_BASE}' está reservado para los precios actuales; renombre ese escenario.")
+    precios = precios_escenarios(lineas, {ESCENARIO_BASE: [], **escenarios})
+    aportes = coeficientes_lineas(lineas).to_numpy()[:, None] * precios.reindex(lineas['mid']).to_numpy()
+    materiales = pd.DataFrame(aportes, columns=precios.columns).groupby(lineas['producto_id'].to_numpy()).sum()
+    sin_conv = lineas.groupby('producto_id')['sin_conversion'].sum()
+
+    resultados = []
+    for nombre in precios.columns:
+        df = prods.assign(costo_materiales=prods['codigo_barras'].map(materiales[nombre]),
+                          sin_conversion=prods['codigo_barras'].map(sin_conv))
+        df = completar_catalogo(df, costo_minuto, cif_tot, gasto_op_tot, u_volumen)
+        df.insert(0, 'escenario', nombre)
+        resultados.append(df)
+    sim = pd.concat(resultados, ignore_index=True)
+    base = sim[sim['escenario'] == ESCENARIO_BASE].set_index('codigo_barras')
+    sim['margen_base'] = sim['codigo_barras'].map(base['margen'])
+    sim['delta_costo'] = sim['costo_total'] - sim['codigo_barras'].map(base['costo_total'])
+    return sim
+
+# ==============================================================================
+# CARGA DE INSUMOS (para lotes / CLI)
+# ==============================================================================
+def cargar_insumos(leer, hoy=None):
+    """Lee todo lo que necesita el costeo del catálogo con el lector dado."""
+    mes_ini, _ = rango_mes(hoy if hoy is not None else pd.Timestamp.today())
+    config = Configuracion.desde_fila(leer(SQL_CONFIG, None).iloc[0])
+    u_volumen, tipo_vol = volumen_referencia(leer(SQL_VOLUMEN_MES, {'m': mes_ini}).iloc[0, 0],
+                                             config.unidades_promedio_mes)
+    return {
+        'productos': leer(SQL_PRODUCTOS, None),
+        'recetas': leer(f"{SQL_RECETAS_COSTEO} ORDER BY r.id", None),
+        'conversiones': leer(SQL_CONVERSIONES, None),
+        'config': config,
+        'u_volumen': u_volumen,
+        'tipo_volumen': tipo_vol,
+    }
+
+def costear_catalogo(insumos):
+    """Catálogo completo a partir de los insumos de `cargar_insumos`. Retorna (catálogo, líneas, inconsistencias)."""
+    factores, inconsistencias = cierre_conversiones(insumos['conversiones'])
+    lineas = calcular_costo_lineas(insumos['recetas'], factores)
+    cfg = insumos['config']
+    df = calcular_catalogo(insumos['productos'], lineas, cfg.costo_minuto, cfg.cif_tot, cfg.gasto_op_tot,
+                           insumos['u_volumen'])
+    return df, lineas, inconsistencias
@@ -0,0 +1,110 @@
+"""Instrumentación de consultas por rerun (eventos de SQLAlchemy, sin Streamlit).
+
+app.py abre una traza al inicio de cada rerun e indica la sección activa; cada sentencia
+que llega a la base queda registrada con su sección, filas y latencia. La traza se puede
+resumir (viajes, tiempo total, más lentas, repetidas) y exportar en formato Chrome Trace
+(abrir en chrome://tracing o https://ui.perfetto.dev).
+"""
+import contextvars
+import json
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+_traza_actual = contextvars.ContextVar("traza_actual", default=None)
+
+def _normalizar_sql(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+class TrazaRerun:
+    def __init__(self, seccion="inicio"):
+        self.inicio = time.perf_counter()
+        self.seccion = seccion
+        self.registros = []
+        self.lecturas_cache = 0    # get_data servidos desde la caché (sin viaje a la DB)
+        self.lecturas_replica = 0  # servidos desde la réplica local (SQLite)
+        self._lock = threading.Lock()  # las lecturas en paralelo cuentan desde otros hilos
+
+    def registrar(self, sql, params, filas, t0, t1):
+        self.registros.append({
+            'seccion': self.seccion, 'hilo': threading.current_thread().name,
+            'sql': _normalizar_sql(sql), 'params': repr(params)[:300],
+            'filas': filas, 'inicio_ms': (t0 - self.inicio) * 1000, 'ms': (t1 - t0) * 1000,
+        })
+
+    def contar(self, contador):
+        with self._lock: setattr(self, contador, getattr(self, contador) + 1)
+
+    def resumen(self, top=10):
+        total_ms = sum(r['ms'] for r in self.registros)
+        repetidas = Counter((r['sql'], r['params']) for r in self.registros)
+        return {
+            'viajes': len(self.registros),
+            'lecturas_cache': self.lecturas_cache,
+            'lecturas_replica': self.lecturas_replica,
+            'tiempo_db_ms': total_ms,
+            'tiempo_rerun_ms': (time.perf_counter() - self.inicio) * 1000,
+            'por_seccion': dict(Counter(r['seccion'] for r in self.registros)),
+            'mas_lentas': sorted(self.registros, key=lambda r: r['ms'], reverse=True)[:top],
+            'repetidas': [{'sql': sql, 'params': p, 'veces': n,
+                           'secciones': sorted({r['seccion'] for r in self.registros if r['sql'] == sql and r['params'] == p})}
+                          for (sql, p), n in repetidas.most_common() if n > 1],
+        }
+
+    def exportar_chrome_trace(self):
+        """Eventos 'X' (duración) en formato Chrome Trace; una pista por sección e hilo (lecturas en paralelo)."""
+        pista = lambda r: f"{r['seccion']} · {r['hilo']}" if r['hilo'].startswith('lectura') else r['seccion']
+        pistas = {s: i for i, s in enumerate(dict.fromkeys(pista(r) for r in self.registros), start=1)}
+        eventos = [{'name': r['sql'][:80], 'cat': r['seccion'], 'ph': 'X', 'pid': 1, 'tid': pistas[pista(r)],
+                    'ts': r['inicio_ms'] * 1000, 'dur': r['ms'] * 1000,
+                    'args': {'sql': r['sql'], 'params': r['params'], 'filas': r['filas']}}
+                   for r in self.registros]
+        eventos += [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': s}} for s, tid in pistas.items()]
+        return json.dumps({'traceEvents': eventos, 'displayTimeUnit': 'ms'}, ensure_ascii=False, indent=1)
+
+def iniciar_traza(seccion="inicio"):
+    """Abre una traza nueva para el rerun (o tarea) actual."""
+    traza = TrazaRerun(seccion)
+    _traza_actual.set(traza)
+    return traza
+
+def traza_actual():
+    return _traza_actual.get()
+
+def fijar_seccion(nombre):
+    traza = _traza_actual.get()
+    if traza is not None: traza.seccion = nombre
+
+@contextmanager
+def seccion(nombre):
+    """Atribuye a `nombre` las consultas del bloque y restaura la sección anterior al salir."""
+    traza = _traza_actual.get()
+    anterior = traza.seccion if traza is not None else None
+    fijar_seccion(nombre)
+    try:
+        yield
+    finally:
+        fijar_seccion(anterior)
+
+def instrumentar(engine):
+    """Registra los eventos en el engine (llamar una sola vez por engine)."""
+    # El inicio se guarda en el contexto de ejecución de la sentencia, no en la conexión:
+    # after_cursor_execute no se dispara si la sentencia falla, y un inicio huérfano en la
+    # conexión del pool desfasaría todas las duraciones siguientes.
+    @event.listens_for(engine, "before_cursor_execute")
+    def _antes(conn, cursor, statement, parameters, context, executemany):
+        if context is not None: context._t0_traza = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _despues(conn, cursor, statement, parameters, context, executemany):
+        t1 = time.perf_counter()
+        t0 = getattr(context, '_t0_traza', None)
+        if t0 is None: return
+        traza = _traza_actual.get()
+        if traza is not None:
+            traza.registrar(statement, parameters, cursor.rowcount, t0, t1)
+    return engine
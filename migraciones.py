@@ -0,0 +1,274 @@
+"""Creación del esquema, índices y datos semilla, versionados en la tabla `schema_version`.
+
+Es idempotente: cada migración se aplica una sola vez y queda registrada. Se puede correr
+como paso separado (p. ej. en el despliegue) con:
+
+    python migraciones.py
+
+o la aplica app.py una vez por proceso si ERP_MIGRAR_AL_INICIAR no es "0".
+"""
+import re
+import sys
+from sqlalchemy import text
+
+from conexion import crear_engine
+
+# Llave para pg_advisory_xact_lock: evita que dos procesos migren a la vez
+LLAVE_BLOQUEO = 7441011
+
+# ==============================================================================
+# MIGRACIONES (versión, descripción, sentencias). Nunca editar una ya publicada:
+# los cambios nuevos van en una versión nueva al final de la lista.
+# ==============================================================================
+MIGRACIONES = [
+    (1, "Tablas base", [
+        """CREATE TABLE IF NOT EXISTS config_admin (
+            id INTEGER PRIMARY KEY, salario_base NUMERIC, p_prestaciones NUMERIC, num_empleados INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS config_ventas (
+            id INTEGER PRIMARY KEY, salario_base NUMERIC, p_prestaciones NUMERIC, num_empleados INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS config_mod (
+            id INTEGER PRIMARY KEY, salario_base NUMERIC, p_prestaciones NUMERIC, num_operarios INTEGER, horas_mes NUMERIC)""",
+        """CREATE TABLE IF NOT EXISTS config_global (
+            id INTEGER PRIMARY KEY, unidades_promedio_mes INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS costos_fijos (
+            id SERIAL PRIMARY KEY, concepto TEXT, total_mensual NUMERIC,
+            p_admin NUMERIC, p_ventas NUMERIC, p_prod NUMERIC)""",
+        """CREATE TABLE IF NOT EXISTS materias_primas (
+            id SERIAL PRIMARY KEY, codigo_interno TEXT, nombre TEXT, categoria TEXT,
+            unidad_medida TEXT, costo_unitario NUMERIC, tiene_iva BOOLEAN DEFAULT FALSE)""",
+        """CREATE TABLE IF NOT EXISTS lineas_produccion (
+            id SERIAL PRIMARY KEY, nombre TEXT UNIQUE)""",
+        """CREATE TABLE IF NOT EXISTS productos (
+            codigo_barras TEXT PRIMARY KEY, nombre TEXT, linea TEXT, tipo_produccion TEXT,
+            unidades_por_lote INTEGER, minutos_por_unidad NUMERIC, precio_venta_sugerido NUMERIC)""",
+        """CREATE TABLE IF NOT EXISTS recetas (
+            id SERIAL PRIMARY KEY, producto_id TEXT, mp_id INTEGER, cantidad NUMERIC, unidad_uso TEXT)""",
+        """CREATE TABLE IF NOT EXISTS conversiones (
+            id SERIAL PRIMARY KEY, unidad_origen TEXT, unidad_destino TEXT, factor_multiplicador NUMERIC,
+            UNIQUE (unidad_origen, unidad_destino))""",
+        """CREATE TABLE IF NOT EXISTS registro_produccion (
+            id SERIAL PRIMARY KEY, fecha DATE, linea_nombre TEXT, producto_codigo TEXT, cantidad_producida INTEGER)""",
+        "CREATE INDEX IF NOT EXISTS idx_recetas_producto ON recetas (producto_id)",
+    ]),
+    (2, "Datos semilla de configuración", [
+        "INSERT INTO config_admin (id, salario_base, p_prestaciones, num_empleados) VALUES (1, 5000, 41.83, 3) ON CONFLICT DO NOTHING",
+        "INSERT INTO config_ventas (id, salario_base, p_prestaciones, num_empleados) VALUES (1, 3500, 41.83, 2) ON CONFLICT DO NOTHING",
+        "INSERT INTO config_mod (id, salario_base, p_prestaciones, num_operarios, horas_mes) VALUES (1, 4252.28, 41.83, 2, 176) ON CONFLICT DO NOTHING",
+        "INSERT INTO config_global (id, unidades_promedio_mes) VALUES (1, 5000) ON CONFLICT DO NOTHING",
+    ]),  # idempotente: restaurar_semilla_config la vuelve a aplicar si se borra la fila id=1
+    (3, "Índices de búsqueda de materias primas", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX IF NOT EXISTS idx_mp_nombre_trgm ON materias_primas USING gin (nombre gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS idx_mp_codigo_trgm ON materias_primas USING gin (codigo_interno gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS idx_mp_nombre_id ON materias_primas (nombre, id)",
+    ]),
+    (4, "Resumen mensual de producción", [
+        "CREATE INDEX IF NOT EXISTS idx_registro_produccion_fecha ON registro_produccion (fecha)",
+        """CREATE TABLE IF NOT EXISTS produccion_mensual (
+            mes DATE NOT NULL, linea_nombre TEXT NOT NULL, producto_codigo TEXT NOT NULL,
+            cantidad BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (mes, linea_nombre, producto_codigo))""",
+        "LOCK TABLE registro_produccion IN SHARE ROW EXCLUSIVE MODE",
+        """CREATE OR REPLACE FUNCTION fn_produccion_mensual() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO produccion_mensual (mes, linea_nombre, producto_codigo, cantidad)
+                VALUES (date_trunc('month', NEW.fecha)::date, COALESCE(NEW.linea_nombre, ''), NEW.producto_codigo, NEW.cantidad_producida)
+                ON CONFLICT (mes, linea_nombre, producto_codigo) DO UPDATE SET cantidad = produccion_mensual.cantidad + EXCLUDED.cantidad;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                UPDATE produccion_mensual SET cantidad = cantidad - OLD.cantidad_producida
+                WHERE mes = date_trunc('month', OLD.fecha)::date AND linea_nombre = COALESCE(OLD.linea_nombre, '')
+                  AND producto_codigo = OLD.producto_codigo;
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS trg_produccion_mensual ON registro_produccion",
+        """CREATE TRIGGER trg_produccion_mensual AFTER INSERT OR UPDATE OR DELETE ON registro_produccion
+        FOR EACH ROW EXECUTE FUNCTION fn_produccion_mensual()""",
+        "TRUNCATE produccion_mensual",
+        """INSERT INTO produccion_mensual (mes, linea_nombre, producto_codigo, cantidad)
+        SELECT date_trunc('month', fecha)::date, COALESCE(linea_nombre, ''), producto_codigo, SUM(cantidad_producida)
+        FROM registro_produccion GROUP BY 1, 2, 3""",
+    ]),
+    (5, "Costos de materiales persistidos con invalidación incremental", [
+        # recetas(mp_id) es el índice inverso materia prima -> productos que la usan
+        "CREATE INDEX IF NOT EXISTS idx_recetas_mp ON recetas (mp_id, producto_id)",
+        """CREATE TABLE IF NOT EXISTS costos_producto (
+            codigo_barras TEXT PRIMARY KEY, costo_materiales NUMERIC NOT NULL DEFAULT 0,
+            sin_conversion INTEGER NOT NULL DEFAULT 0, calculado_en TIMESTAMPTZ NOT NULL DEFAULT now())""",
+        """CREATE TABLE IF NOT EXISTS costos_pendientes (
+            codigo_barras TEXT PRIMARY KEY, desde TIMESTAMPTZ NOT NULL DEFAULT now())""",
+        # Materias primas: solo si cambia algo que afecta el costo
+        """CREATE OR REPLACE FUNCTION fn_pendientes_mp() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                INSERT INTO costos_pendientes (codigo_barras)
+                SELECT DISTINCT r.producto_id FROM nuevas n JOIN viejas v ON v.id = n.id JOIN recetas r ON r.mp_id = n.id
+                WHERE n.costo_unitario IS DISTINCT FROM v.costo_unitario OR n.tiene_iva IS DISTINCT FROM v.tiene_iva
+                   OR n.unidad_medida IS DISTINCT FROM v.unidad_medida
+                ON CONFLICT DO NOTHING;
+            ELSE
+                INSERT INTO costos_pendientes (codigo_barras)
+                SELECT DISTINCT r.producto_id FROM viejas v JOIN recetas r ON r.mp_id = v.id
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS trg_pendientes_mp_upd ON materias_primas",
+        """CREATE TRIGGER trg_pendientes_mp_upd AFTER UPDATE ON materias_primas
+        REFERENCING NEW TABLE AS nuevas OLD TABLE AS viejas FOR EACH STATEMENT EXECUTE FUNCTION fn_pendientes_mp()""",
+        "DROP TRIGGER IF EXISTS trg_pendientes_mp_del ON materias_primas",
+        """CREATE TRIGGER trg_pendientes_mp_del AFTER DELETE ON materias_primas
+        REFERENCING OLD TABLE AS viejas FOR EACH STATEMENT EXECUTE FUNCTION fn_pendientes_mp()""",
+        # Recetas: los productos cuyas líneas se agregan, cambian o borran
+        """CREATE OR REPLACE FUNCTION fn_pendientes_recetas() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO costos_pendientes (codigo_barras) SELECT DISTINCT producto_id FROM nuevas
+                WHERE producto_id IS NOT NULL ON CONFLICT DO NOTHING;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                INSERT INTO costos_pendientes (codigo_barras) SELECT DISTINCT producto_id FROM viejas
+                WHERE producto_id IS NOT NULL ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS trg_pendientes_recetas_ins ON recetas",
+        """CREATE TRIGGER trg_pendientes_recetas_ins AFTER INSERT ON recetas
+        REFERENCING NEW TABLE AS nuevas FOR EACH STATEMENT EXECUTE FUNCTION fn_pendientes_recetas()""",
+        "DROP TRIGGER IF EXISTS trg_pendientes_recetas_upd ON recetas",
+        """CREATE TRIGGER trg_pendientes_recetas_upd AFTER UPDATE ON recetas
+        REFERENCING NEW TABLE AS nuevas OLD TABLE AS viejas FOR EACH STATEMENT EXECUTE FUNCTION fn_pendientes_recetas()""",
+        "DROP TRIGGER IF EXISTS trg_pendientes_recetas_del ON recetas",
+        """CREATE TRIGGER trg_pendientes_recetas_del AFTER DELETE ON recetas
+        REFERENCING OLD TABLE AS viejas FOR EACH STATEMENT EXECUTE FUNCTION fn_pendientes_recetas()""",
+        # Conversiones: todos los productos con alguna línea que requiere conversión
+        """CREATE OR REPLACE FUNCTION fn_pendientes_conversiones() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO costos_pendientes (codigo_barras)
+            SELECT DISTINCT r.producto_id FROM recetas r JOIN materias_primas m ON m.id = r.mp_id
+            WHERE r.unidad_uso IS NOT NULL AND r.unidad_uso IS DISTINCT FROM m.unidad_medida
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS trg_pendientes_conversiones ON conversiones",
+        """CREATE TRIGGER trg_pendientes_conversiones AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON conversiones
+        FOR EACH STATEMENT EXECUTE FUNCTION fn_pendientes_conversiones()""",
+        # Primera vez: todo el catálogo queda pendiente
+        "INSERT INTO costos_pendientes (codigo_barras) SELECT codigo_barras FROM productos ON CONFLICT DO NOTHING",
+    ]),
+    (6, "Envíos de producción idempotentes y trigger mensual por sentencia", [
+        # Un envío del formulario de Producción Diaria = una fila; reintentos con la misma llave no insertan nada
+        """CREATE TABLE IF NOT EXISTS envios_produccion (
+            fecha DATE NOT NULL, linea_nombre TEXT NOT NULL, envio TEXT NOT NULL,
+            productos INTEGER NOT NULL, unidades BIGINT NOT NULL, registrado_en TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (fecha, linea_nombre, envio))""",
+        "ALTER TABLE registro_produccion ADD COLUMN IF NOT EXISTS envio TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_registro_produccion_envio ON registro_produccion (envio) WHERE envio IS NOT NULL",
+        # El lote entra en una sola sentencia: el acumulado mensual se actualiza una vez por sentencia, no por fila
+        "LOCK TABLE registro_produccion IN SHARE ROW EXCLUSIVE MODE",
+        """CREATE OR REPLACE FUNCTION fn_produccion_mensual_lote() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO produccion_mensual (mes, linea_nombre, producto_codigo, cantidad)
+                SELECT date_trunc('month', fecha)::date, COALESCE(linea_nombre, ''), producto_codigo, SUM(cantidad_producida)
+                FROM nuevas GROUP BY 1, 2, 3
+                ON CONFLICT (mes, linea_nombre, producto_codigo) DO UPDATE SET cantidad = produccion_mensual.cantidad + EXCLUDED.cantidad;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                UPDATE produccion_mensual p SET cantidad = p.cantidad - v.cantidad
+                FROM (SELECT date_trunc('month', fecha)::date AS mes, COALESCE(linea_nombre, '') AS linea_nombre,
+                             producto_codigo, SUM(cantidad_producida) AS cantidad
+                      FROM viejas GROUP BY 1, 2, 3) v
+                WHERE p.mes = v.mes AND p.linea_nombre = v.linea_nombre AND p.producto_codigo = v.producto_codigo;
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS trg_produccion_mensual ON registro_produccion",
+        "DROP FUNCTION IF EXISTS fn_produccion_mensual()",
+        "DROP TRIGGER IF EXISTS trg_produccion_mensual_ins ON registro_produccion",
+        """CREATE TRIGGER trg_produccion_mensual_ins AFTER INSERT ON registro_produccion
+        REFERENCING NEW TABLE AS nuevas FOR EACH STATEMENT EXECUTE FUNCTION fn_produccion_mensual_lote()""",
+        "DROP TRIGGER IF EXISTS trg_produccion_mensual_upd ON registro_produccion",
+        """CREATE TRIGGER trg_produccion_mensual_upd AFTER UPDATE ON registro_produccion
+        REFERENCING NEW TABLE AS nuevas OLD TABLE AS viejas FOR EACH STATEMENT EXECUTE FUNCTION fn_produccion_mensual_lote()""",
+        "DROP TRIGGER IF EXISTS trg_produccion_mensual_del ON registro_produccion",
+        """CREATE TRIGGER trg_produccion_mensual_del AFTER DELETE ON registro_produccion
+        REFERENCING OLD TABLE AS viejas FOR EACH STATEMENT EXECUTE FUNCTION fn_produccion_mensual_lote()""",
+    ]),
+    (7, "Contador de cambios por tabla para la réplica local", [
+        # replica.py compara estos contadores para copiar solo las tablas que cambiaron
+        """CREATE TABLE IF NOT EXISTS cambios_tablas (
+            tabla TEXT PRIMARY KEY, version BIGINT NOT NULL DEFAULT 0, actualizado TIMESTAMPTZ NOT NULL DEFAULT now())""",
+        """CREATE OR REPLACE FUNCTION fn_cambio_tabla() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO cambios_tablas (tabla, version) VALUES (TG_TABLE_NAME, 1)
+            ON CONFLICT (tabla) DO UPDATE SET version = cambios_tablas.version + 1, actualizado = now();
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+    ] + [s for t in ('materias_primas', 'productos', 'lineas_produccion', 'recetas', 'conversiones',
+                     'config_admin', 'config_ventas', 'config_mod', 'config_global', 'costos_fijos') for s in (
+        f"DROP TRIGGER IF EXISTS trg_cambio_{t} ON {t}",
+        f"""CREATE TRIGGER trg_cambio_{t} AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {t}
+        FOR EACH STATEMENT EXECUTE FUNCTION fn_cambio_tabla()""",
+        f"INSERT INTO cambios_tablas (tabla) VALUES ('{t}') ON CONFLICT DO NOTHING",
+    )]),
+    (8, "Aviso NOTIFY al cambiar una tabla (invalidación entre procesos)", [
+        # notificaciones.py escucha el canal 'cambios_tablas'; el aviso sale al confirmar la transacción
+        """CREATE OR REPLACE FUNCTION fn_cambio_tabla() RETURNS trigger AS $$
+        DECLARE v BIGINT;
+        BEGIN
+            INSERT INTO cambios_tablas (tabla, version) VALUES (TG_TABLE_NAME, 1)
+            ON CONFLICT (tabla) DO UPDATE SET version = cambios_tablas.version + 1, actualizado = now()
+            RETURNING version INTO v;
+            PERFORM pg_notify('cambios_tablas', TG_TABLE_NAME || ':' || v);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+    ]),
+    (9, "Contador de cambios de costos_producto (catálogo desde la réplica local)", [
+        "DROP TRIGGER IF EXISTS trg_cambio_costos_producto ON costos_producto",
+        """CREATE TRIGGER trg_cambio_costos_producto AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON costos_producto
+        FOR EACH STATEMENT EXECUTE FUNCTION fn_cambio_tabla()""",
+        "INSERT INTO cambios_tablas (tabla) VALUES ('costos_producto') ON CONFLICT DO NOTHING",
+    ]),
+]
+
+def version_actual(conn):
+    conn.execute(text("""CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY, descripcion TEXT, aplicada_en TIMESTAMPTZ NOT NULL DEFAULT now())"""))
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+def restaurar_semilla_config(conn):
+    """Vuelve a insertar las filas id=1 de configuración que falten (las sentencias de la migración 2,
+    con ON CONFLICT DO NOTHING: no toca las que existen). Retorna las tablas afectadas."""
+    sentencias = next(s for num, _, s in MIGRACIONES if num == 2)
+    return [re.match(r"INSERT INTO (\w+)", sql).group(1) for sql in sentencias if conn.execute(text(sql)).rowcount]
+
+def aplicar_migraciones(engine, log=print):
+    """Aplica en orden las migraciones pendientes, cada una en su transacción. Retorna la versión final."""
+    # Comprobación barata: si ya está al día no se toma ningún bloqueo
+    with engine.begin() as conn:
+        version = version_actual(conn)
+    if version >= MIGRACIONES[-1][0]:
+        return version
+
+    for num, descripcion, sentencias in MIGRACIONES:
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {'k': LLAVE_BLOQUEO})
+            if version_actual(conn) >= num: continue  # otro proceso ya la aplicó
+            for sql in sentencias:
+                conn.execute(text(sql))
+            conn.execute(text("INSERT INTO schema_version (version, descripcion) VALUES (:v, :d)"),
+                         {'v': num, 'd': descripcion})
+        log(f"✔ Migración {num}: {descripcion}")
+        version = num
+    return version
+
+if __name__ == "__main__":
+    try:
+        v = aplicar_migraciones(crear_engine())
+        print(f"Esquema en la versión {v}")
+    except Exception as e:
+        print(f"❌ Error aplicando migraciones: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,222 @@
+"""Operaciones de escritura masiva (cargas CSV, sincronización de editores).
+
+Cada función recibe `conn`, una conexión ya dentro de una transacción (engine.begin()),
+para que el llamador decida el alcance: en app.py se usa `transaccion([...])`, que además
+invalida la caché; los benchmarks la llaman directo contra la base local.
+"""
+import io
+
+import pandas as pd
+from sqlalchemy import text
+
+from costeo import (SQL_RECETAS_COSTEO, SQL_CONVERSIONES, cierre_conversiones, calcular_costo_lineas,
+                    materiales_por_producto)
+
+def copiar_dataframe(conn, df, tabla, columnas):
+    """Carga masiva con COPY ... FROM STDIN dentro de la transacción de `conn`."""
+    buf = io.StringIO()
+    df[columnas].to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+COLS_COSTOS_FIJOS = ['concepto', 'total_mensual', 'p_admin', 'p_ventas', 'p_prod']
+
+def validar_costos_fijos(df):
+    """Separa las filas válidas de las que tienen datos faltantes o % que no suman 100."""
+    df = df.rename(columns=lambda c: c.strip().lower())
+    faltantes = [c for c in COLS_COSTOS_FIJOS if c not in df.columns]
+    if faltantes: raise ValueError(f"Faltan columnas: {', '.join(faltantes)}")
+    df = df[COLS_COSTOS_FIJOS].copy()
+    for c in COLS_COSTOS_FIJOS[1:]:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    suma_p = df['p_admin'] + df['p_ventas'] + df['p_prod']
+    ok = df['concepto'].notna() & df[COLS_COSTOS_FIJOS[1:]].notna().all(axis=1) & ((suma_p - 100).abs() <= 0.01)
+    errores = df[~ok].assign(suma_p=suma_p[~ok])
+    errores.index = errores.index + 2  # número de línea en el CSV (con encabezado)
+    return df[ok], errores
+
+def cargar_costos_fijos(conn, df, borrar=False):
+    """TRUNCATE opcional + COPY de todas las filas, en la transacción de `conn`. Retorna las filas cargadas."""
+    if borrar: conn.execute(text("TRUNCATE TABLE costos_fijos RESTART IDENTITY"))
+    copiar_dataframe(conn, df, "costos_fijos", COLS_COSTOS_FIJOS)
+    return len(df)
+
+COLS_CSV_PRODUCTOS = ['codigo', 'nombre', 'tipo', 'unidades_lote', 'tiempo_ciclo', 'precio', 'linea']
+
+def preparar_chunk_productos(df):
+    """Normaliza un bloque del CSV de productos. Retorna (filas válidas, nº rechazadas)."""
+    df = df.rename(columns=lambda c: c.strip().lower())
+    faltantes = [c for c in COLS_CSV_PRODUCTOS if c not in df.columns]
+    if faltantes: raise ValueError(f"Faltan columnas: {', '.join(faltantes)}")
+    df = df[COLS_CSV_PRODUCTOS].copy()
+    for c in ['codigo', 'nombre', 'tipo', 'linea']:
+        df[c] = df[c].str.strip()
+    for c in ['unidades_lote', 'tiempo_ciclo', 'precio']:
+        df[c] = pd.to_numeric(df[c], errors='coerce')
+    ok = df[['codigo', 'nombre', 'linea', 'tiempo_ciclo']].notna().all(axis=1) & (df['codigo'] != '')
+    return df[ok], int((~ok).sum())
+
+def cargar_productos_csv(conn, archivo, chunksize=5000):
+    """Carga el CSV por bloques (COPY) a una tabla temporal y hace el upsert de líneas y productos
+    con dos sentencias, en la transacción de `conn`. Retorna conteos de insertados/actualizados/rechazados."""
+    rechazados = 0
+    conn.execute(text("""
+        CREATE TEMP TABLE stg_productos (
+            fila BIGSERIAL, codigo TEXT, nombre TEXT, tipo TEXT, unidades_lote NUMERIC,
+            tiempo_ciclo NUMERIC, precio NUMERIC, linea TEXT
+        ) ON COMMIT DROP
+    """))
+    for chunk in pd.read_csv(archivo, sep=None, engine='python', dtype=str, chunksize=chunksize):
+        validos, n_rech = preparar_chunk_productos(chunk)
+        rechazados += n_rech
+        copiar_dataframe(conn, validos, "stg_productos", COLS_CSV_PRODUCTOS)
+
+    conn.execute(text("INSERT INTO lineas_produccion (nombre) SELECT DISTINCT linea FROM stg_productos ON CONFLICT DO NOTHING"))
+    # Si un código se repite en el archivo, gana la última fila
+    res = conn.execute(text("""
+        INSERT INTO productos (codigo_barras, nombre, tipo_produccion, unidades_por_lote, minutos_por_unidad, precio_venta_sugerido, linea)
+        SELECT DISTINCT ON (codigo) codigo, nombre, tipo, unidades_lote, tiempo_ciclo, precio, linea
+        FROM stg_productos ORDER BY codigo, fila DESC
+        ON CONFLICT (codigo_barras) DO UPDATE SET
+        nombre=EXCLUDED.nombre, tipo_produccion=EXCLUDED.tipo_produccion, unidades_por_lote=EXCLUDED.unidades_por_lote,
+        minutos_por_unidad=EXCLUDED.minutos_por_unidad, precio_venta_sugerido=EXCLUDED.precio_venta_sugerido, linea=EXCLUDED.linea
+        RETURNING (xmax = 0) AS insertado
+    """)).fetchall()
+    duplicados = conn.execute(text("SELECT COUNT(*) - COUNT(DISTINCT codigo) FROM stg_productos")).scalar()
+    insertados = sum(1 for r in res if r.insertado)
+    return {'insertados': insertados, 'actualizados': len(res) - insertados,
+            'rechazados': rechazados, 'duplicados': int(duplicados)}
+
+COLS_MP = ['codigo_interno', 'nombre', 'categoria', 'unidad_medida', 'costo_unitario', 'tiene_iva']
+
+def _normalizar_mp(df):
+    df = df[COLS_MP].copy()
+    df['costo_unitario'] = pd.to_numeric(df['costo_unitario'], errors='coerce').astype(float)
+    df['tiene_iva'] = df['tiene_iva'].fillna(False).astype(bool)
+    for c in ['codigo_interno', 'nombre', 'categoria', 'unidad_medida']:
+        df[c] = df[c].astype(object).where(df[c].notna(), None)
+    return df
+
+def diff_materias_primas(original, editado):
+    """Compara la salida del editor con lo cargado (hash por fila). Retorna (nuevas, cambiadas, ids borrados)."""
+    orig = _normalizar_mp(original.set_index('id'))
+    con_id = editado[editado['id'].notna()]
+    ed = _normalizar_mp(con_id.set_index(con_id['id'].astype(original['id'].dtype)))
+    nuevas = _normalizar_mp(editado[editado['id'].isna()])
+    # Filas agregadas y dejadas en blanco: no hay nada que guardar (las incompletas sí se reportan)
+    nuevas = nuevas[nuevas.drop(columns='tiene_iva').notna().any(axis=1)]
+
+    comunes = ed.index.intersection(orig.index)
+    h_ed = pd.util.hash_pandas_object(ed.loc[comunes], index=True)
+    h_or = pd.util.hash_pandas_object(orig.loc[comunes], index=True)
+    cambiadas = ed.loc[comunes][(h_ed != h_or).values]
+    borrados = orig.index.difference(ed.index).tolist()
+    return nuevas, cambiadas, borrados
+
+def _como_lista(serie):
+    return [None if pd.isna(v) else v for v in serie.tolist()]
+
+def sincronizar_materias_primas(conn, original, editado):
+    """Envía solo las filas insertadas, modificadas y borradas, por lotes, en la transacción de `conn`.
+    Si alguna fila nueva o editada quedó sin nombre lanza ValueError antes de escribir nada."""
+    nuevas, cambiadas, borrados = diff_materias_primas(original, editado)
+    sin_nombre = pd.concat([nuevas, cambiadas])
+    sin_nombre = sin_nombre[sin_nombre['nombre'].isna() | (sin_nombre['nombre'].astype(str).str.strip() == '')]
+    if not sin_nombre.empty:
+        ejemplos = ", ".join(str(c) for c in sin_nombre['codigo_interno'].fillna('(sin código)').head(5))
+        raise ValueError(f"{len(sin_nombre)} fila(s) sin nombre: {ejemplos}. Complete el nombre o borre la fila.")
+    if borrados:
+        conn.execute(text("DELETE FROM materias_primas WHERE id = ANY(:ids)"), {'ids': [int(i) for i in borrados]})
+    if not cambiadas.empty:
+        conn.execute(text("""
+            UPDATE materias_primas m SET codigo_interno=v.cod, nombre=v.n, categoria=v.c,
+                   unidad_medida=v.u, costo_unitario=v.p, tiene_iva=v.iva
+            FROM unnest(CAST(:ids AS bigint[]), CAST(:cod AS text[]), CAST(:n AS text[]), CAST(:c AS text[]),
+                        CAST(:u AS text[]), CAST(:p AS numeric[]), CAST(:iva AS boolean[])) AS v(id, cod, n, c, u, p, iva)
+            WHERE m.id = v.id
+        """), {'ids': [int(i) for i in cambiadas.index], 'cod': _como_lista(cambiadas['codigo_interno']),
+               'n': _como_lista(cambiadas['nombre']), 'c': _como_lista(cambiadas['categoria']),
+               'u': _como_lista(cambiadas['unidad_medida']), 'p': _como_lista(cambiadas['costo_unitario']),
+               'iva': _como_lista(cambiadas['tiene_iva'])})
+    if not nuevas.empty:
+        conn.execute(text("""INSERT INTO materias_primas (codigo_interno, nombre, categoria, unidad_medida, costo_unitario, tiene_iva)
+                             VALUES (:codigo_interno, :nombre, :categoria, :unidad_medida, :costo_unitario, :tiene_iva)"""),
+                     [{k: (None if pd.isna(v) else v) for k, v in r.items()} for r in nuevas.to_dict('records')])
+    return {'insertadas': len(nuevas), 'actualizadas': len(cambiadas), 'eliminadas': len(borrados)}
+
+def crear_variante(conn, cod_origen, cod_nuevo, nombre_nuevo):
+    """Crea un producto nuevo copiando datos y receta de otro (INSERT ... SELECT). Retorna las líneas copiadas."""
+    creado = conn.execute(text("""
+        INSERT INTO productos (codigo_barras, nombre, tipo_produccion, unidades_por_lote, minutos_por_unidad, precio_venta_sugerido, linea)
+        SELECT :c, :n, tipo_produccion, unidades_por_lote, minutos_por_unidad, precio_venta_sugerido, linea
+        FROM productos WHERE codigo_barras = :org
+    """), {'c': cod_nuevo, 'n': nombre_nuevo, 'org': cod_origen}).rowcount
+    if not creado: raise ValueError(f"No existe el producto origen {cod_origen}")
+    return conn.execute(text("""
+        INSERT INTO recetas (producto_id, mp_id, cantidad, unidad_uso)
+        SELECT :c, mp_id, cantidad, unidad_uso FROM recetas WHERE producto_id = :org ORDER BY id
+    """), {'c': cod_nuevo, 'org': cod_origen}).rowcount
+
+def clonar_receta(conn, cod_origen, destinos):
+    """Sobrescribe la receta de uno o varios productos con la del origen. Retorna (destinos, líneas insertadas)."""
+    destinos = sorted({d for d in destinos if d != cod_origen})
+    if not destinos: raise ValueError("Elija al menos un destino distinto del origen.")
+    # Se bloquea la receta origen y se valida antes de tocar los destinos
+    n_origen = len(conn.execute(text("SELECT id FROM recetas WHERE producto_id = :org FOR SHARE"), {'org': cod_origen}).fetchall())
+    if not n_origen: raise ValueError("El producto origen no tiene receta.")
+    conn.execute(text("DELETE FROM recetas WHERE producto_id = ANY(:dst)"), {'dst': destinos})
+    insertadas = conn.execute(text("""
+        INSERT INTO recetas (producto_id, mp_id, cantidad, unidad_uso)
+        SELECT d.cod, r.mp_id, r.cantidad, r.unidad_uso
+        FROM recetas r CROSS JOIN unnest(CAST(:dst AS text[])) AS d(cod)
+        WHERE r.producto_id = :org ORDER BY d.cod, r.id
+    """), {'dst': destinos, 'org': cod_origen}).rowcount
+    return len(destinos), insertadas
+
+def clonar_receta_a_linea(conn, cod_origen, linea):
+    """Copia la receta del origen a todos los productos de una línea (excepto el origen)."""
+    destinos = [r[0] for r in conn.execute(text("SELECT codigo_barras FROM productos WHERE linea = :l"), {'l': linea})]
+    return clonar_receta(conn, cod_origen, destinos)
+
+def recalcular_costos_pendientes(conn):
+    """Recalcula `costos_producto` solo para los productos marcados por los triggers. Retorna cuántos.
+
+    Las conversiones se leen en la misma transacción que borra las marcas: con factores de una
+    caché atrasada el costo quedaría guardado mal y ya sin marca que lo vuelva a calcular.
+    """
+    pendientes = [r[0] for r in conn.execute(text("DELETE FROM costos_pendientes RETURNING codigo_barras"))]
+    if not pendientes: return 0
+    factores, _ = cierre_conversiones(pd.read_sql(text(SQL_CONVERSIONES), conn))
+    lineas = calcular_costo_lineas(pd.read_sql(text(f"{SQL_RECETAS_COSTEO} WHERE r.producto_id = ANY(:pids)"),
+                                               conn, params={'pids': pendientes}), factores)
+    mat = materiales_por_producto(lineas).reindex(pendientes).fillna(0)  # sin receta: costo 0
+    conn.execute(text("""
+        INSERT INTO costos_producto (codigo_barras, costo_materiales, sin_conversion, calculado_en)
+        SELECT c, m, s, now() FROM unnest(CAST(:c AS text[]), CAST(:m AS numeric[]), CAST(:s AS integer[])) AS v(c, m, s)
+        ON CONFLICT (codigo_barras) DO UPDATE SET costo_materiales = EXCLUDED.costo_materiales,
+            sin_conversion = EXCLUDED.sin_conversion, calculado_en = EXCLUDED.calculado_en
+    """), {'c': mat.index.tolist(), 'm': mat['costo_materiales'].astype(float).tolist(),
+           's': mat['sin_conversion'].astype(int).tolist()})
+    conn.execute(text("DELETE FROM costos_producto c WHERE NOT EXISTS (SELECT 1 FROM productos p WHERE p.codigo_barras = c.codigo_barras)"))
+    return len(pendientes)
+
+def registrar_produccion(conn, fecha, linea, envio, lote):
+    """Registra el lote de un día y línea en una sola sentencia (`lote`: codigo_barras, unidades).
+
+    `envio` identifica el envío del formulario. Si (fecha, línea, envío) ya se registró (doble
+    clic, rerun repetido) no se inserta nada y se retorna None; si no, el número de productos.
+    """
+    lote = lote[lote['unidades'] > 0]
+    if lote.empty: return 0
+    nuevo = conn.execute(text("""
+        INSERT INTO envios_produccion (fecha, linea_nombre, envio, productos, unidades)
+        VALUES (:f, :l, :e, :n, :u) ON CONFLICT DO NOTHING RETURNING 1
+    """), {'f': fecha, 'l': linea, 'e': envio, 'n': len(lote), 'u': int(lote['unidades'].sum())}).first()
+    if nuevo is None: return None
+    conn.execute(text("""
+        INSERT INTO registro_produccion (fecha, linea_nombre, producto_codigo, cantidad_producida, envio)
+        SELECT :f, :l, c, q, :e FROM unnest(CAST(:c AS text[]), CAST(:q AS integer[])) AS v(c, q)
+    """), {'f': fecha, 'l': linea, 'e': envio, 'c': lote['codigo_barras'].astype(str).tolist(),
+           'q': lote['unidades'].astype(int).tolist()})
+    return len(lote)
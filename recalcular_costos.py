@@ -0,0 +1,86 @@
+"""Recalcula y exporta el costo y margen de todos los productos, sin Streamlit.
+
+Pensado para tareas programadas (p. ej. cron nocturno):
+
+    python recalcular_costos.py --salida costos.csv
+    python recalcular_costos.py --formato json --linea "Colonias" --salida colonias.json
+    python recalcular_costos.py --escenarios escenarios.json --salida simulacion.csv
+
+El archivo de escenarios es {"nombre": [choque, ...]}, con los choques de
+costeo.precios_escenarios, p. ej. {"Alcohol +15%": [{"nivel": "categoria",
+"clave": "Alcoholes", "tipo": "pct", "valor": 15}]}. Los precios de la DB no cambian.
+"""
+import argparse
+import json
+import sys
+import time
+
+import pandas as pd
+from sqlalchemy import text
+
+from conexion import crear_engine
+from costeo import cargar_insumos, costear_catalogo, calcular_costo_lineas, cierre_conversiones, simular_escenarios
+
+COLUMNAS_EXPORTACION = ['codigo_barras', 'nombre', 'linea', 'costo_materiales', 'costo_variable', 'mod',
+                        'cif_unitario', 'gasto_operativo', 'costo_total', 'costo_y_gasto',
+                        'precio_venta_sugerido', 'utilidad', 'margen', 'punto_equilibrio', 'sin_conversion']
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recalcula costos y márgenes del catálogo completo.")
+    parser.add_argument("--salida", default=f"costos_{pd.Timestamp.today():%Y%m%d}.csv", help="Archivo de salida")
+    parser.add_argument("--formato", choices=["csv", "json"], default="csv")
+    parser.add_argument("--linea", action="append", help="Filtrar por línea (se puede repetir)")
+    parser.add_argument("--escenarios", help="JSON de escenarios de precios a simular (salida en formato largo)")
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    engine = crear_engine()
+    with engine.connect() as conn:
+        insumos = cargar_insumos(lambda sql, params: pd.read_sql(text(sql), conn, params=params))
+    if args.escenarios:
+        return simular(insumos, args)
+    catalogo, _, inconsistencias = costear_catalogo(insumos)
+    if args.linea:
+        catalogo = catalogo[catalogo['linea'].isin(args.linea)]
+
+    catalogo = catalogo[COLUMNAS_EXPORTACION].assign(tipo_volumen=insumos['tipo_volumen'],
+                                                     calculado_en=pd.Timestamp.now().isoformat(timespec='seconds'))
+    if args.formato == "json":
+        catalogo.to_json(args.salida, orient="records", force_ascii=False, indent=2)
+    else:
+        catalogo.to_csv(args.salida, index=False)
+
+    print(f"{len(catalogo)} productos costeados en {time.perf_counter() - t0:.2f} s -> {args.salida}")
+    print(f"Con pérdida: {int((catalogo['utilidad'] < -0.01).sum())} · "
+          f"Con ingredientes sin conversión: {int((catalogo['sin_conversion'] > 0).sum())}")
+    for inc in inconsistencias:
+        print(f"⚠️ Conversión inconsistente {inc['origen']} -> {inc['destino']}: "
+              f"{inc['factor']} vs {inc['factor_otra_ruta']}", file=sys.stderr)
+    return 0
+
+def simular(insumos, args):
+    """Evalúa todos los escenarios del archivo en una pasada y exporta una fila por escenario y producto."""
+    t0 = time.perf_counter()
+    with open(args.escenarios, encoding="utf-8") as f:
+        escenarios = json.load(f)
+    factores, _ = cierre_conversiones(insumos['conversiones'])
+    cfg = insumos['config']
+    try:
+        sim = simular_escenarios(insumos['productos'], calcular_costo_lineas(insumos['recetas'], factores), escenarios,
+                                 cfg.costo_minuto, cfg.cif_tot, cfg.gasto_op_tot, insumos['u_volumen'])
+    except ValueError as e:
+        print(f"❌ {args.escenarios}: {e}", file=sys.stderr)
+        return 2
+    if args.linea:
+        sim = sim[sim['linea'].isin(args.linea)]
+    sim = sim[['escenario'] + COLUMNAS_EXPORTACION + ['margen_base', 'delta_costo']]
+    if args.formato == "json":
+        sim.to_json(args.salida, orient="records", force_ascii=False, indent=2)
+    else:
+        sim.to_csv(args.salida, index=False)
+    print(f"{sim['escenario'].nunique()} escenarios × {sim['codigo_barras'].nunique()} productos "
+          f"en {time.perf_counter() - t0:.2f} s -> {args.salida}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
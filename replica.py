@@ -0,0 +1,298 @@
+"""Réplica local (SQLite) de las tablas de referencia y cola de escrituras sin conexión.
+
+Sin Streamlit. app.py la usa para:
+  * servir lecturas de las tablas replicadas desde un archivo local (sin viaje a us-east-1);
+  * seguir mostrando fichas, recetas y configuración cuando el pooler no responde
+    ("Circuit breaker open"), y
+  * guardar en una cola durable las escrituras hechas sin conexión, que se reproducen en
+    orden contra la DB al volver.
+
+El refresco es incremental por tabla: la migración 7 mantiene en `cambios_tablas` un
+contador por tabla que suben los triggers; solo se vuelven a copiar las tablas cuyo
+contador cambió (o que se escribieron localmente). Las consultas son las mismas de la app
+(dialecto Postgres); `a_sqlite` traduce lo poco que difiere (ILIKE, = ANY(:lista)).
+
+Variables de entorno:
+  ERP_REPLICA          "1" activa la réplica (por defecto), "0" la desactiva
+  ERP_REPLICA_RUTA     archivo SQLite (replica_local.sqlite)
+  ERP_REPLICA_TTL      segundos entre revisiones de `cambios_tablas` (30)
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+
+import pandas as pd
+from sqlalchemy import text
+
+TABLAS_REPLICA = ('materias_primas', 'productos', 'lineas_produccion', 'recetas', 'conversiones',
+                  'config_admin', 'config_ventas', 'config_mod', 'config_global', 'costos_fijos',
+                  'costos_producto')
+# Llaves para que los upserts (ON CONFLICT) y los ids nuevos funcionen también en local
+LLAVES = {'productos': 'codigo_barras', 'costos_producto': 'codigo_barras'}
+UNICAS = {'lineas_produccion': ['nombre'], 'conversiones': ['unidad_origen', 'unidad_destino']}
+# Los ids de filas creadas sin conexión empiezan aquí (un tramo de 10^9 por tabla, así un id
+# local identifica también su tabla). Al reproducir el INSERT se guarda el id que asignó la DB
+# y las escrituras posteriores de la cola que usan el id local se reescriben con él.
+ID_LOCAL_BASE = 10**12
+TRAMO_IDS_LOCALES = 10**9
+
+RE_ANY = re.compile(r"=\s*ANY\(\s*:(\w+)\s*\)", re.IGNORECASE)
+RE_ILIKE = re.compile(r"\bILIKE\s+(:\w+)", re.IGNORECASE)
+RE_INSERT = re.compile(r"^\s*INSERT\b", re.IGNORECASE)
+RE_UPDATE_DELETE = re.compile(r"^\s*(?:UPDATE|DELETE)\b", re.IGNORECASE)
+RE_RETURNING = re.compile(r"\bRETURNING\b", re.IGNORECASE)
+
+def _valor_sqlite(v):
+    if isinstance(v, Decimal): return float(v)
+    if hasattr(v, 'isoformat'): return v.isoformat()
+    if hasattr(v, 'item'): return v.item()  # escalares numpy
+    return v
+
+def _json_default(v):
+    r = _valor_sqlite(v)
+    return str(v) if r is v else r
+
+def a_sqlite(query, params=None):
+    """Traduce una consulta de la app (Postgres) al dialecto de SQLite. Retorna (sql, params)."""
+    params = dict(params or {})
+    def expandir(m):
+        valores = list(params.pop(m.group(1)))
+        claves = [f"{m.group(1)}_{i}" for i in range(len(valores))]
+        params.update(zip(claves, valores))
+        return f"IN ({', '.join(':' + k for k in claves)})" if claves else "IN (NULL)"
+    query = RE_ANY.sub(expandir, query)
+    query = RE_ILIKE.sub(r"LIKE \1 ESCAPE '\\'", query)
+    return query, {k: _valor_sqlite(v) for k, v in params.items()}
+
+def _es_booleana(serie):
+    no_nulos = serie.dropna()
+    return pd.api.types.is_bool_dtype(serie) or (len(no_nulos) > 0 and no_nulos.map(lambda v: isinstance(v, bool)).all())
+
+def _tipo_sqlite(serie):
+    if _es_booleana(serie) or pd.api.types.is_integer_dtype(serie): return "INTEGER"
+    if pd.api.types.is_float_dtype(serie): return "REAL"
+    return "TEXT"
+
+def _normalizar(df):
+    """NUMERIC llega como Decimal y las fechas como date: SQLite no los guarda tal cual."""
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype == object:
+            no_nulos = df[c].dropna()
+            if len(no_nulos) and no_nulos.map(lambda v: isinstance(v, Decimal)).all():
+                df[c] = pd.to_numeric(df[c])
+            elif len(no_nulos) and no_nulos.map(lambda v: hasattr(v, 'isoformat')).all():
+                df[c] = df[c].map(lambda v: v.isoformat() if hasattr(v, 'isoformat') else v)
+    return df
+
+def _es_id_local(v):
+    return isinstance(v, int) and not isinstance(v, bool) and v >= ID_LOCAL_BASE
+
+def _ids_locales(valor):
+    if isinstance(valor, (list, tuple)): return [i for v in valor for i in _ids_locales(v)]
+    return [valor] if _es_id_local(valor) else []
+
+def _reemplazar_ids(valor, mapa):
+    if isinstance(valor, (list, tuple)): return [_reemplazar_ids(v, mapa) for v in valor]
+    return mapa.get(valor, valor) if _es_id_local(valor) else valor
+
+class SinConexion(Exception):
+    """La DB no responde y la operación no se puede servir desde la réplica local."""
+
+class EscrituraSinEfecto(Exception):
+    """Un UPDATE/DELETE reproducido sobre una fila creada sin conexión no alcanzó ninguna fila."""
+
+class Replica:
+    def __init__(self, ruta, ttl=30):
+        self.ruta, self.ttl = ruta, ttl
+        self.lock = threading.RLock()
+        self.lock_cola = threading.Lock()  # una sola reproducción a la vez (sin bloquear las lecturas)
+        self.ultima_revision = 0.0
+        self.sucias = set()  # escritas desde la última copia: se leen de la DB hasta recopiarlas
+        self.generacion = Counter()  # marcas por tabla: refrescar no borra una marca puesta durante la copia
+        self._con = sqlite3.connect(ruta, check_same_thread=False)
+        with self.lock, self._con:
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute("""CREATE TABLE IF NOT EXISTS _versiones (
+                tabla TEXT PRIMARY KEY, version INTEGER, copiada_en REAL, booleanas TEXT)""")
+            self._con.execute("""CREATE TABLE IF NOT EXISTS _cola_escrituras (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, sql TEXT NOT NULL, params TEXT, tabla TEXT, creada_en REAL)""")
+            self._con.execute("""CREATE TABLE IF NOT EXISTS _cola_fallidas (
+                id INTEGER PRIMARY KEY, sql TEXT, params TEXT, tabla TEXT, creada_en REAL, error TEXT)""")
+            # id local -> id asignado por la DB al reproducir el INSERT (durable: sobrevive a un corte a mitad)
+            self._con.execute("CREATE TABLE IF NOT EXISTS _ids_locales (id_local INTEGER PRIMARY KEY, id_servidor INTEGER)")
+            columnas = {c[1] for c in self._con.execute("PRAGMA table_info(_cola_escrituras)")}
+            if 'id_local' not in columnas:  # archivos creados antes de reescribir ids
+                self._con.execute("ALTER TABLE _cola_escrituras ADD COLUMN id_local INTEGER")
+
+    # --- ESTADO ---
+    def versiones(self):
+        """{tabla: (versión, copiada_en)} de las tablas presentes en el archivo."""
+        with self.lock:
+            return {t: (v, c) for t, v, c in self._con.execute("SELECT tabla, version, copiada_en FROM _versiones")}
+
+    def tiene_datos(self):
+        return set(TABLAS_REPLICA) <= set(self.versiones())
+
+    def puede_servir(self, tablas):
+        return bool(tablas) and set(tablas) <= set(TABLAS_REPLICA) and set(tablas) <= set(self.versiones())
+
+    def marcar_sucias(self, tablas):
+        with self.lock:
+            for t in set(tablas) & set(TABLAS_REPLICA):
+                self.sucias.add(t)
+                self.generacion[t] += 1
+
+    def vigente(self, tablas):
+        """Se puede leer de la réplica estando en línea: ninguna tabla tiene escrituras sin recopiar."""
+        with self.lock: return self.puede_servir(tablas) and not (set(tablas) & self.sucias)
+
+    # --- REFRESCO INCREMENTAL ---
+    def refrescar(self, engine, forzar=False):
+        """Copia las tablas cuyo contador en `cambios_tablas` cambió (todas con `forzar`). Retorna cuáles."""
+        # Las marcas se toman antes de abrir la foto: una escritura marcada antes ya estaba
+        # confirmada y entra en la copia; una marcada después sube la generación y sigue sucia.
+        with self.lock: sucias, generacion = set(self.sucias), self.generacion.copy()
+        # REPEATABLE READ: contadores y datos salen de la misma foto de la DB
+        with engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn:
+            remotas = dict(conn.execute(text("SELECT tabla, version FROM cambios_tablas")).all())
+            locales = self.versiones()
+            copiar = [t for t in TABLAS_REPLICA
+                      if forzar or t in sucias or t not in locales or locales[t][0] != remotas.get(t, 0)]
+            datos = {t: pd.read_sql(text(f"SELECT * FROM {t}"), conn) for t in copiar}
+        for t, df in datos.items():
+            self._copiar_tabla(t, df, remotas.get(t, 0))
+        with self.lock:
+            self.sucias -= {t for t in copiar if self.generacion[t] == generacion[t]}
+            self.ultima_revision = time.time()
+        return copiar
+
+    def _copiar_tabla(self, tabla, df, version):
+        df = _normalizar(df)
+        booleanas = [c for c in df.columns if _es_booleana(df[c])]
+        llave = LLAVES.get(tabla, 'id' if 'id' in df.columns else None)
+        cols = []
+        for c in df.columns:
+            if c == llave and c == 'id': cols.append('"id" INTEGER PRIMARY KEY AUTOINCREMENT')
+            elif c == llave: cols.append(f'"{c}" {_tipo_sqlite(df[c])} PRIMARY KEY')
+            else: cols.append(f'"{c}" {_tipo_sqlite(df[c])}')
+        with self.lock, self._con:
+            self._con.execute(f'DROP TABLE IF EXISTS "{tabla}"')
+            self._con.execute(f'CREATE TABLE "{tabla}" ({", ".join(cols)})')
+            if tabla in UNICAS:
+                self._con.execute(f'CREATE UNIQUE INDEX "ux_{tabla}" ON "{tabla}" ({", ".join(UNICAS[tabla])})')
+            if len(df):
+                marcas = ", ".join("?" * len(df.columns))
+                filas = [tuple(None if pd.isna(v) else _valor_sqlite(v) for v in fila)
+                         for fila in df.itertuples(index=False, name=None)]
+                self._con.executemany(f'INSERT INTO "{tabla}" VALUES ({marcas})', filas)
+            if llave == 'id':
+                self._con.execute("DELETE FROM sqlite_sequence WHERE name = ?", (tabla,))
+                base = ID_LOCAL_BASE + TABLAS_REPLICA.index(tabla) * TRAMO_IDS_LOCALES
+                self._con.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                                  (tabla, max(base, int(df['id'].max()) if len(df) else 0)))
+            self._con.execute("INSERT OR REPLACE INTO _versiones VALUES (?, ?, ?, ?)",
+                              (tabla, int(version), time.time(), json.dumps(booleanas)))
+
+    # --- LECTURAS ---
+    def leer(self, query, params=None):
+        sql, p = a_sqlite(query, params)
+        with self.lock:
+            df = pd.read_sql(sql, self._con, params=p)
+            booleanas = set()
+            for (b,) in self._con.execute("SELECT booleanas FROM _versiones"):
+                booleanas |= set(json.loads(b or "[]"))
+        for c in set(df.columns) & booleanas:
+            df[c] = df[c].map(lambda v: None if pd.isna(v) else bool(v))
+        return df
+
+    # --- ESCRITURAS SIN CONEXIÓN ---
+    def encolar(self, query, params, tabla):
+        """Aplica la escritura a la copia local para que la interfaz la refleje y la guarda (durable)
+        en la cola; si fue un INSERT de una fila, con el id local que recibió."""
+        id_local = None
+        try:
+            sql, p = a_sqlite(query, params)
+            with self.lock, self._con:
+                cur = self._con.execute(sql, p)
+                if RE_INSERT.match(query) and cur.rowcount == 1 and _es_id_local(cur.lastrowid):
+                    id_local = cur.lastrowid
+        except sqlite3.Error:
+            pass  # la copia local no refleja este cambio; la DB sí lo tendrá al reproducir la cola
+        with self.lock, self._con:
+            self._con.execute("INSERT INTO _cola_escrituras (sql, params, tabla, creada_en, id_local) VALUES (?, ?, ?, ?, ?)",
+                              (query, json.dumps(params or {}, default=_json_default), tabla, time.time(), id_local))
+        if tabla: self.marcar_sucias([tabla])
+
+    def pendientes(self):
+        with self.lock:
+            return self._con.execute("SELECT COUNT(*) FROM _cola_escrituras").fetchone()[0]
+
+    def fallidas(self):
+        with self.lock:
+            return pd.read_sql("SELECT id, sql, params, tabla, creada_en, error FROM _cola_fallidas ORDER BY id", self._con)
+
+    def reproducir(self, engine, es_error_de_conexion):
+        """Aplica la cola en orden, una transacción por escritura. Retorna (aplicadas, fallidas).
+
+        Si se cae la conexión se detiene (el resto queda para el próximo intento); una escritura
+        que la DB rechaza por otro motivo pasa a `_cola_fallidas` para revisarla y la cola sigue.
+        Los ids locales de los parámetros se reescriben con los que asignó la DB; un UPDATE/DELETE
+        sobre una fila creada sin conexión que no alcanza ninguna fila también va a `_cola_fallidas`
+        (no se da por aplicado en silencio).
+        """
+        aplicadas = fallidas = 0
+        with self.lock_cola:
+            with self.lock:
+                cola = self._con.execute("""SELECT id, sql, params, tabla, creada_en, id_local
+                                            FROM _cola_escrituras ORDER BY id""").fetchall()
+                mapa = dict(self._con.execute("SELECT id_local, id_servidor FROM _ids_locales"))
+            for id_, sql, params, tabla, creada, id_local in cola:
+                try:
+                    p = json.loads(params or "{}")
+                    locales = _ids_locales(list(p.values()))
+                    p = {k: _reemplazar_ids(v, mapa) for k, v in p.items()}
+                    sql_db = sql
+                    if id_local is not None and not RE_RETURNING.search(sql):
+                        sql_db = sql.rstrip().rstrip(';') + " RETURNING id"
+                    with engine.begin() as conn:
+                        res = conn.execute(text(sql_db), p)
+                        if id_local is not None:
+                            fila = res.first()
+                            if fila is not None: mapa[id_local] = int(fila[0])
+                        elif locales and RE_UPDATE_DELETE.match(sql) and res.rowcount == 0:
+                            sin_mapear = [i for i in locales if i not in mapa]
+                            raise EscrituraSinEfecto(
+                                "No alcanzó ninguna fila: la fila creada sin conexión "
+                                + (f"(id local {sin_mapear}) no llegó a la DB" if sin_mapear else "ya no existe en la DB"))
+                    if id_local is not None and id_local in mapa:
+                        with self.lock, self._con:
+                            self._con.execute("INSERT OR REPLACE INTO _ids_locales VALUES (?, ?)", (id_local, mapa[id_local]))
+                except Exception as e:
+                    if es_error_de_conexion(e): raise
+                    with self.lock, self._con:
+                        self._con.execute("INSERT INTO _cola_fallidas VALUES (?, ?, ?, ?, ?, ?)",
+                                          (id_, sql, params, tabla, creada, str(e)[:500]))
+                        self._con.execute("DELETE FROM _cola_escrituras WHERE id = ?", (id_,))
+                    fallidas += 1
+                    continue
+                with self.lock, self._con:
+                    self._con.execute("DELETE FROM _cola_escrituras WHERE id = ?", (id_,))
+                aplicadas += 1
+            with self.lock, self._con:
+                # Cola vacía: los ids locales se vuelven a asignar tras el próximo refresco
+                if not self._con.execute("SELECT COUNT(*) FROM _cola_escrituras").fetchone()[0]:
+                    self._con.execute("DELETE FROM _ids_locales")
+        return aplicadas, fallidas
+
+def crear_replica():
+    """Réplica según las variables de entorno, o None si está desactivada."""
+    if os.environ.get("ERP_REPLICA", "1") == "0":
+        return None
+    return Replica(os.environ.get("ERP_REPLICA_RUTA", "replica_local.sqlite"),
+                   ttl=float(os.environ.get("ERP_REPLICA_TTL", 30)))
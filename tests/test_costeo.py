@@ -0,0 +1,32 @@
+import pandas as pd
+import pytest
+
+from costeo import ESCENARIO_BASE, cierre_conversiones, simular_escenarios
+
+def _conversiones(filas):
+    return pd.DataFrame(filas, columns=['unidad_origen', 'unidad_destino', 'factor_multiplicador'])
+
+def test_inversas_explicitas_contradictorias():
+    factores, inconsistencias = cierre_conversiones(_conversiones([('Gal', 'Oz', 128.0), ('Oz', 'Gal', 0.5)]))
+    assert len(inconsistencias) == 1
+    assert {inconsistencias[0]['origen'], inconsistencias[0]['destino']} == {'Gal', 'Oz'}
+    assert factores[('Gal', 'Oz')] == 128.0
+
+def test_inversas_explicitas_consistentes():
+    _, inconsistencias = cierre_conversiones(_conversiones([('Gal', 'Oz', 128.0), ('Oz', 'Gal', 1 / 128)]))
+    assert inconsistencias == []
+
+def test_triangulo_inconsistente():
+    _, inconsistencias = cierre_conversiones(_conversiones([
+        ('Gal', 'L', 3.78541), ('L', 'ml', 1000.0), ('Gal', 'ml', 4000.0)]))
+    assert inconsistencias
+
+def test_triangulo_consistente():
+    factores, inconsistencias = cierre_conversiones(_conversiones([
+        ('Gal', 'L', 3.78541), ('L', 'ml', 1000.0), ('Gal', 'ml', 3785.41)]))
+    assert inconsistencias == []
+    assert abs(factores[('ml', 'Gal')] - 1 / 3785.41) < 1e-12
+
+def test_escenario_con_nombre_reservado():
+    with pytest.raises(ValueError):
+        simular_escenarios(pd.DataFrame(), pd.DataFrame(), {ESCENARIO_BASE: []}, 0, 0, 0, 1)
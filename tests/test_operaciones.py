@@ -0,0 +1,18 @@
+import pandas as pd
+import pytest
+
+from operaciones import COLS_MP, sincronizar_materias_primas
+
+def _pagina(filas):
+    return pd.DataFrame(filas, columns=['id'] + COLS_MP)
+
+def test_fila_nueva_sin_nombre_se_rechaza():
+    original = _pagina([(1, 'MP1', 'Alcohol', 'ALCOHOL', 'Gal', 100.0, True)])
+    editado = pd.concat([original, _pagina([(None, 'MP2', None, 'ENVASE', 'Unidad', 3.0, False)])], ignore_index=True)
+    with pytest.raises(ValueError, match="sin nombre"):
+        sincronizar_materias_primas(None, original, editado)  # falla antes de usar la conexión
+
+def test_fila_nueva_en_blanco_se_ignora():
+    original = _pagina([(1, 'MP1', 'Alcohol', 'ALCOHOL', 'Gal', 100.0, True)])
+    editado = pd.concat([original, _pagina([(None, None, None, None, None, None, None)])], ignore_index=True)
+    assert sincronizar_materias_primas(None, original, editado) == {'insertadas': 0, 'actualizadas': 0, 'eliminadas': 0}